@@ -1,26 +1,39 @@
 import json
 import os
-from typing import Literal
+import time
+import functools
+from typing import Any, Dict, Literal, Optional
 from dotenv import load_dotenv
-from langchain_nvidia_ai_endpoints import ChatNVIDIA
 from langgraph.graph import StateGraph, MessagesState, START, END
 from langgraph.prebuilt import ToolNode, tools_condition
 from langchain_core.messages import HumanMessage, SystemMessage, AIMessage, ToolMessage
-from app.tools.manim import generate_manim_script, execute_manim_with_audio
+from langchain_core.runnables import RunnableConfig
+from app.tools.manim import generate_manim_script, execute_manim_with_audio, get_render_status, repair_manim_script
 from app.tools.search import search_solution
+from app.utils.concepts import CONCEPT_INDEX, concept_cache_enabled
+from app.utils.history import compact_messages
+from app.utils.llm import get_chat_model, record_usage
+from app.utils.tracing import count, span, tracing
 import re
 load_dotenv()
 
-client = ChatNVIDIA(
-    model="meta/llama-3.3-70b-instruct",
-    api_key=os.getenv("NVIDIA_API_KEY"), 
-    temperature=0.2,
-    top_p=0.7,
-    max_completion_tokens=8192,  # Augmenté pour éviter la troncature
-)
+AGENT_MODEL = "meta/llama-3.3-70b-instruct"
+
+# Budgets par requête, modifiables par appel via config["configurable"] (mêmes noms)
+AGENT_BUDGET = {
+    "max_attempts": int(os.getenv("MATHCONCEPT_AGENT_MAX_ATTEMPTS", 4)),
+    "deadline": float(os.getenv("MATHCONCEPT_AGENT_DEADLINE", 900)),
+    "max_tokens": int(os.getenv("MATHCONCEPT_AGENT_MAX_TOKENS", 200_000)),
+}
+
+tools = [generate_manim_script, execute_manim_with_audio, get_render_status, repair_manim_script, search_solution]
+
+
+@functools.lru_cache(maxsize=1)
+def get_llm_with_tools():
+    """Client de l'agent avec ses outils, construit au premier appel via la fabrique partagée."""
+    return get_chat_model(AGENT_MODEL).bind_tools(tools)
 
-tools = [generate_manim_script, execute_manim_with_audio, search_solution]
-llm_with_tools = client.bind_tools(tools)
 
 SYSTEM_PROMPT = """Tu es un assistant spécialisé dans la création de vidéos éducatives Manim (manim-voiceover).
 
@@ -29,15 +42,22 @@ SYSTEM_PROMPT = """Tu es un assistant spécialisé dans la création de vidéos
                     2. ENSUITE appeler l'outil `execute_manim_with_audio` avec les des valeurs retournées:
                     - code: le code Python retourné
                     - math_scene: le class_name retourné
+                    - concept: le concept demandé par l'utilisateur
 
                     IMPORTANT:
                     - Tu DOIS appeler les deux outils dans cet ordre
                     - Ne génère JAMAIS de code toi-même, utilise TOUJOURS generate_manim_script
                     - Après execute_manim_with_audio, indique à l'utilisateur le résultat
                     
+                    Un code déjà vu peut apparaître sous la forme `ref:<id>` : passe cette référence telle quelle
+                    comme `code` aux outils, ne la recopie pas.
+
                     EN CAS D'ERREUR:
-                    - Si l'exécution échoue, utilise l'outil `search_solution` pour trouver comment corriger l'erreur.
-                    - Analyse l'erreur, cherche une solution, puis réessaie avec `generate_manim_script` en appliquant la correction.
+                    - Si l'exécution échoue, appelle `repair_manim_script` avec le code, le class_name et le message d'erreur complet.
+                    - Relance ensuite `execute_manim_with_audio` avec le code corrigé et sections=True.
+                    - Si la réparation échoue encore, utilise `search_solution` pour trouver comment corriger l'erreur.
+                    - En dernier recours seulement, réessaie avec `generate_manim_script` en appliquant la correction
+                      (avec use_cache=False si la demande est identique à la précédente).
                 """
 
 def parse_tool_call_from_content(content: str) -> dict | None:
@@ -53,14 +73,73 @@ def parse_tool_call_from_content(content: str) -> dict | None:
         pass
     return None
 
-def agent(state: MessagesState):
-    messages = state['messages']
+class AgentState(MessagesState):
+    """Historique et compteurs de budget de la requête en cours (remis à zéro par `lookup`)."""
+    started: float
+    attempts: int
+    tokens: int
+    stop_reason: Optional[str]
+
+def agent_budget(config: Optional[RunnableConfig]) -> Dict[str, Any]:
+    overrides = ((config or {}).get("configurable") or {})
+    return {name: overrides.get(name, default) for name, default in AGENT_BUDGET.items()}
+
+def budget_exceeded(state: AgentState, budget: Dict[str, Any]) -> Optional[str]:
+    """Raison de l'arrêt si un budget de la requête est épuisé, sinon None."""
+    if state.get("attempts", 0) >= budget["max_attempts"]:
+        return f"{state['attempts']} essais échoués (maximum {budget['max_attempts']})"
+    elapsed = time.time() - state.get("started", time.time())
+    if elapsed >= budget["deadline"]:
+        return f"délai dépassé ({elapsed:.0f}s, maximum {budget['deadline']:.0f}s)"
+    if state.get("tokens", 0) >= budget["max_tokens"]:
+        return f"budget de tokens épuisé ({state['tokens']}, maximum {budget['max_tokens']})"
+    return None
+
+def lookup(state: AgentState):
+    """Sert directement une vidéo déjà produite pour le même concept, sans génération ni rendu."""
+    # Début d'une nouvelle requête : les budgets repartent de zéro
+    reset = {"started": time.time(), "attempts": 0, "tokens": 0, "stop_reason": None}
+    request = next((msg for msg in reversed(state['messages']) if isinstance(msg, HumanMessage)), None)
+    if request is None or not concept_cache_enabled():
+        return {"messages": [], **reset}
+
+    with span("lookup"):
+        hit = CONCEPT_INDEX.lookup(str(request.content))
+    if hit is None:
+        return {"messages": [], **reset}
+    count("concept_cache_hits")
+    return {**reset, "messages": [AIMessage(content=json.dumps({
+        "success": True,
+        "video_path": hit["path"],
+        "message": f"Vidéo déjà générée pour « {hit['concept']} » ({hit['class_name']})",
+        "metadata": {"cached": True, "match": hit["match"], "score": hit["score"],
+                     "satisfaction": hit["satisfaction"], "sidecars": hit["sidecars"]},
+    }, ensure_ascii=False))]}
+
+def route_lookup(state: AgentState) -> Literal["agent", "__end__"]:
+    return END if isinstance(state['messages'][-1], AIMessage) else "agent"
+
+def agent(state: AgentState, config: RunnableConfig):
+    # Budget épuisé : réponse finale sans appel d'outil, le graphe s'arrête
+    reason = budget_exceeded(state, agent_budget(config))
+    if reason is not None:
+        count("budget_stops")
+        return {"messages": [AIMessage(content=f"Arrêt de la génération : {reason}. "
+                                               "La vidéo n'a pas pu être produite pour ce concept.")],
+                "stop_reason": reason}
+
+    # Les anciens scripts et erreurs sont compactés : le prompt ne grossit plus à chaque essai
+    messages = compact_messages(state['messages'])
     
     # Ajouter le system prompt s'il n'existe pas
     if not any(isinstance(msg, SystemMessage) for msg in messages):
         messages = [SystemMessage(content=SYSTEM_PROMPT)] + messages
     
-    response = llm_with_tools.invoke(messages)
+    with span("agent", messages=len(messages)):
+        response = get_llm_with_tools().invoke(messages)
+        usage = getattr(response, "usage_metadata", None) or {}
+        record_usage(usage)
+    tokens = usage.get("total_tokens") or usage.get("input_tokens", 0) + usage.get("output_tokens", 0)
     
     # Vérifier si le modèle a mis un tool call dans le content au lieu de tool_calls
     if not response.tool_calls and response.content:
@@ -74,9 +153,9 @@ def agent(state: MessagesState):
             }]
             response.content = ""
     
-    return {"messages": [response]}
+    return {"messages": [response], "tokens": state.get("tokens", 0) + tokens}
 
-def sendError(state: MessagesState):
+def sendError(state: AgentState):
     messages = state['messages']
     # recuperer le dernier ToolMessage
     last_tool_message = messages[-1] if messages and isinstance(messages[-1], ToolMessage) else None
@@ -98,23 +177,34 @@ def sendError(state: MessagesState):
             
             if is_error:
                 print(f"Erreur détectée: {content}")        
-                return {"messages": [
+                count("retries")
+                if data.get("success") is False:
+                    # Échec de rendu : réparation ciblée plutôt qu'une régénération complète
+                    details = data.get("message", content)[-1500:]
+                    instruction = """CORRIGER avec repair_manim_script (code, class_name, erreur ci-dessus),
+                            puis relancer execute_manim_with_audio avec sections=True."""
+                else:
+                    details = content
+                    instruction = "REPRENDRE LE PROCESSUS."
+                return {"attempts": state.get("attempts", 0) + 1, "messages": [
                     AIMessage(
                         content=f"""Le résultat de l'exécution de la vidéo est une erreur. 
                             La vidéo n'a pas pu être générée correctement. 
-                            Détails: {content}
-                            REPRENDRE LE PROCESSUS.
+                            Détails: {details}
+                            {instruction}
                             """)]}
         except json.JSONDecodeError:
             pass
         
     return {"messages": []}
 
-builder = StateGraph(MessagesState)
+builder = StateGraph(AgentState)
+builder.add_node("lookup", lookup)
 builder.add_node("agent", agent)
 builder.add_node("tools", ToolNode(tools))
 builder.add_node("sendError", sendError)
-builder.add_edge(START, "agent")
+builder.add_edge(START, "lookup")
+builder.add_conditional_edges("lookup", route_lookup)
 builder.add_conditional_edges(
     "agent",
     tools_condition,
@@ -126,17 +216,31 @@ graph = builder.compile()
 
 if __name__ == "__main__":
     import sys
-    
+    import asyncio
+
+    async def main(concept: str) -> dict:
+        # ainvoke : le rendu ne bloque pas la boucle, la progression de Manim arrive dans le stream `custom`
+        state = None
+        # Trace de la requête complète, exportée dans MATHCONCEPT_TRACE_DIR si défini
+        with tracing(name="agent") as tracer:
+            async for mode, chunk in graph.astream(
+                {"messages": [HumanMessage(content=concept)]},
+                {"recursion_limit": 50},
+                stream_mode=["values", "custom"],
+            ):
+                if mode == "custom":
+                    print(f"[{chunk.get('scene')}] {chunk.get('progress')}")
+                else:
+                    state = chunk
+        print(json.dumps(tracer.summary(), indent=2, ensure_ascii=False))
+        if state and state.get("stop_reason"):
+            print(f"Arrêt sur budget : {state['stop_reason']}")
+        return state
+
     if sys.argv[1]:
-        result = graph.invoke(
-            {"messages": [HumanMessage(content=sys.argv[1])]},
-            {"recursion_limit": 50}
-        )
+        result = asyncio.run(main(sys.argv[1]))
     else:
-        result = graph.invoke(
-            {"messages": [HumanMessage(content="Explique le repere cartesien et la notion de vecteur unitaire")]},
-            {"recursion_limit": 50}
-        )
+        result = asyncio.run(main("Explique le repere cartesien et la notion de vecteur unitaire"))
     
     # Afficher le résultat final
     for msg in result["messages"]:
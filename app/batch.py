@@ -0,0 +1,230 @@
+import os
+import csv
+import json
+import time
+import asyncio
+import argparse
+from pathlib import Path
+from typing import Callable, Dict, Any, Iterator, Optional, Set
+
+from app.tools.manim import forget_failed_script, generate_manim_script
+from app.tools.render import QUALITY_FLAGS, RENDER_SCHEDULER, RenderScheduler, publish_render
+from app.tools.repair import repair_scene
+from app.tools.validation import preflight
+from app.utils.tracing import Tracer, count, record_stages, span, tracing
+
+
+def read_concepts(path: str) -> Iterator[Dict[str, Any]]:
+    """Lit les concepts au fil de l'eau depuis un CSV (colonne `concept`) ou un JSONL ({"concept": ...})."""
+    with open(path, encoding="utf-8", newline="") as f:
+        if path.endswith(".jsonl"):
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    if entry.get("concept"):
+                        yield entry
+        else:
+            for row in csv.DictReader(f, skipinitialspace=True):
+                concept = (row.get("concept") or "").strip()
+                if concept:
+                    yield {**row, "concept": concept}
+
+
+def load_checkpoint(manifest_path: str) -> Set[str]:
+    """Concepts déjà traités avec succès dans un manifeste existant."""
+    done = set()
+    if os.path.exists(manifest_path):
+        with open(manifest_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # ligne tronquée par une interruption
+                if entry.get("success"):
+                    done.add(entry["concept"])
+    return done
+
+
+class BatchRunner:
+    """
+    Génère et rend une liste de concepts :
+    - appels LLM en parallèle, bornés par `llm_concurrency`
+    - rendus dans RENDER_SCHEDULER, sous la même limite que ceux de l'agent tournant dans le processus ;
+      `render_workers` donne un pool privé de cette taille (benchmarks qui comparent des concurrences)
+    - un essai raté est réparé à partir de son erreur plutôt que regénéré à l'identique
+    - chaque résultat est ajouté au manifeste JSONL dès qu'il est connu, ce qui permet la reprise
+    """
+
+    def __init__(self, manifest_path: str, llm_concurrency: int = 4, render_workers: Optional[int] = None,
+                 max_attempts: int = 3, quality: str = "medium"):
+        self.manifest_path = manifest_path
+        self.llm_concurrency = max(1, llm_concurrency)
+        self._owns_scheduler = render_workers is not None
+        self.scheduler = RenderScheduler(max_workers=render_workers) if self._owns_scheduler else RENDER_SCHEDULER
+        self.max_attempts = max_attempts
+        self.quality_flags = QUALITY_FLAGS[quality]
+        self._llm_semaphore: Optional[asyncio.Semaphore] = None
+
+    def _get_llm_semaphore(self) -> asyncio.Semaphore:
+        if self._llm_semaphore is None:
+            self._llm_semaphore = asyncio.Semaphore(self.llm_concurrency)
+        return self._llm_semaphore
+
+    def close(self) -> None:
+        """Arrête le pool de rendus privé ; le pool partagé reste à la disposition du processus."""
+        if self._owns_scheduler:
+            self.scheduler.shutdown(wait=False)
+
+    async def _script(self, concept: str, failed: Optional[Dict[str, Any]], attempt: int,
+                      on_event: Callable[..., None]) -> Dict[str, Any]:
+        """Script de l'essai : réparation du script précédent à partir de son erreur, sinon nouvelle génération."""
+        if failed is not None:
+            on_event("repair", attempt=attempt, class_name=failed["class_name"])
+            async with self._get_llm_semaphore():
+                with span("repair") as attrs:
+                    repaired = await asyncio.to_thread(repair_scene, failed["code"], failed["class_name"],
+                                                       failed["error"])
+                    attrs["strategy"] = repaired["strategy"]
+            if repaired["strategy"] != "none":
+                return repaired
+        on_event("generate", attempt=attempt)
+        async with self._get_llm_semaphore():
+            return await generate_manim_script.ainvoke({"concept": concept})
+
+    async def process_concept(self, entry: Dict[str, Any],
+                              on_event: Optional[Callable[..., None]] = None) -> Dict[str, Any]:
+        """`on_event(stage, **data)` est appelé à chaque étape (génération, validation, rendu) de chaque essai."""
+        with tracing(Tracer("batch")) as tracer:
+            record = await self._process_concept(entry, on_event or (lambda stage, **data: None))
+        record["trace"] = tracer.summary()
+        return record
+
+    async def _process_concept(self, entry: Dict[str, Any], on_event: Callable[..., None]) -> Dict[str, Any]:
+        concept = entry["concept"]
+        quality_flags = QUALITY_FLAGS[entry["quality"]] if entry.get("quality") else self.quality_flags
+        timings: Dict[str, list] = {"generate": [], "validate": [], "render": []}
+        result: Dict[str, Any] = {"success": False, "video_path": None, "message": "aucune tentative"}
+        class_name = None
+        # Script et erreur de l'essai précédent, transmis à la réparation
+        failed: Optional[Dict[str, Any]] = None
+
+        attempt = 0
+        for attempt in range(1, self.max_attempts + 1):
+            if attempt > 1:
+                count("retries")
+            started = time.perf_counter()
+            script = await self._script(concept, failed, attempt, on_event)
+            timings["generate"].append(time.perf_counter() - started)
+            failed = None
+            code, class_name = script["code"], script["class_name"]
+            if code.strip().startswith("# Erreur"):
+                result = {"success": False, "video_path": None, "message": "Réponse du LLM illisible"}
+                continue
+
+            on_event("validate", attempt=attempt, class_name=class_name)
+            started = time.perf_counter()
+            with span("validate"):
+                failure = await asyncio.to_thread(preflight, code, class_name)
+            timings["validate"].append(time.perf_counter() - started)
+            if failure is not None:
+                # Sans cela, l'essai suivant relirait le même script depuis le cache de réponses
+                forget_failed_script(code)
+                result = failure
+                failed = {"code": code, "class_name": class_name, "error": failure["message"]}
+                continue
+
+            on_event("render", attempt=attempt, class_name=class_name)
+            started = time.perf_counter()
+            future = self.scheduler.submit(code, class_name, quality_flags=quality_flags)
+            result = await asyncio.wrap_future(future)
+            timings["render"].append(time.perf_counter() - started)
+            record_stages(result["metadata"].get("stages", []), attempt=attempt)
+            if result["success"]:
+                result = await asyncio.to_thread(publish_render, result, class_name, concept)
+                break
+            forget_failed_script(code)
+            stderr = result["metadata"].get("stderr", "")
+            failed = {"code": code, "class_name": class_name, "error": f"{result['message']}\n{stderr}".strip()}
+
+        return {
+            "concept": concept,
+            "satisfaction": entry.get("satisfaction"),
+            "success": result["success"],
+            "video_path": result.get("video_path"),
+            "class_name": class_name,
+            "attempts": attempt,
+            "message": result.get("message"),
+            "timings": timings,
+        }
+
+    def _record(self, manifest, record: Dict[str, Any]) -> None:
+        manifest.write(json.dumps(record, ensure_ascii=False) + "\n")
+        manifest.flush()
+        os.fsync(manifest.fileno())
+
+    async def run(self, input_path: str) -> Dict[str, int]:
+        self._llm_semaphore = asyncio.Semaphore(self.llm_concurrency)
+        done = load_checkpoint(self.manifest_path)
+        # File bornée : les concepts sont lus au rythme du traitement
+        workers = self.llm_concurrency + self.scheduler.max_workers
+        queue: asyncio.Queue = asyncio.Queue(maxsize=workers * 2)
+        stats = {"skipped": 0, "success": 0, "failed": 0}
+
+        Path(self.manifest_path).parent.mkdir(parents=True, exist_ok=True)
+        with open(self.manifest_path, "a", encoding="utf-8") as manifest:
+
+            async def worker():
+                while True:
+                    entry = await queue.get()
+                    try:
+                        if entry is None:
+                            return
+                        started = time.perf_counter()
+                        try:
+                            record = await self.process_concept(entry)
+                        except Exception as e:
+                            record = {"concept": entry["concept"], "success": False, "message": str(e)[:500]}
+                        record["total_seconds"] = time.perf_counter() - started
+                        self._record(manifest, record)
+                        stats["success" if record["success"] else "failed"] += 1
+                        print(f"[{'OK' if record['success'] else 'ÉCHEC'}] {entry['concept']}")
+                    finally:
+                        queue.task_done()
+
+            tasks = [asyncio.create_task(worker()) for _ in range(workers)]
+            try:
+                for entry in read_concepts(input_path):
+                    if entry["concept"] in done:
+                        stats["skipped"] += 1
+                        continue
+                    done.add(entry["concept"])
+                    await queue.put(entry)
+                for _ in tasks:
+                    await queue.put(None)
+                await asyncio.gather(*tasks)
+            finally:
+                for task in tasks:
+                    task.cancel()
+                self.close()
+        return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Génère les vidéos d'une liste de concepts (CSV ou JSONL)")
+    parser.add_argument("input", nargs="?", default="concepts.txt")
+    parser.add_argument("--manifest", default=None, help="manifeste JSONL des résultats (défaut: <input>.manifest.jsonl)")
+    parser.add_argument("--llm-concurrency", type=int, default=4)
+    parser.add_argument("--render-workers", type=int, default=None,
+                        help="pool de rendus privé de cette taille (défaut: pool partagé, MATHCONCEPT_MAX_CONCURRENT_RENDERS)")
+    parser.add_argument("--max-attempts", type=int, default=3)
+    parser.add_argument("--quality", choices=list(QUALITY_FLAGS), default="medium")
+    args = parser.parse_args()
+
+    runner = BatchRunner(
+        manifest_path=args.manifest or f"{args.input}.manifest.jsonl",
+        llm_concurrency=args.llm_concurrency,
+        render_workers=args.render_workers,
+        max_attempts=args.max_attempts,
+        quality=args.quality,
+    )
+    print(asyncio.run(runner.run(args.input)))
@@ -0,0 +1,249 @@
+import os
+import ast
+import json
+import math
+import time
+import asyncio
+import argparse
+import platform
+import tempfile
+import warnings
+import statistics
+import subprocess
+from pathlib import Path
+from typing import Dict, Any, Iterator, List, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+
+# Corpus par défaut : (concept demandé, fichier, classe) des scènes écrites à la main dans le dépôt
+CORPUS_SOURCES = [
+    ("la dérivée d'une fonction", PROJECT_ROOT / "app" / "tools" / "scene" / "scene.py", "DeriveeFonction"),
+    ("le théorème de Pythagore", PROJECT_ROOT / "app" / "test_voiceover.py", "TheoremePythagore"),
+]
+
+
+class ReplayChatModel(BaseChatModel):
+    """
+    Modèle de chat hors ligne : rejoue la réponse enregistrée dont le concept apparaît
+    dans le dernier message, en morceaux de `chunk_size` caractères (streaming compris).
+    `seconds_per_chunk` simule la latence de génération du vrai modèle.
+    """
+
+    model: str = "replay"
+    responses: Dict[str, str]
+    chunk_size: int = 16
+    seconds_per_chunk: float = 0.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "replay"
+
+    def _response_for(self, messages: List[BaseMessage]) -> str:
+        prompt = str(messages[-1].content)
+        for concept, response in self.responses.items():
+            if concept in prompt:
+                return response
+        raise ValueError(f"Aucune réponse enregistrée pour: {prompt[:200]}")
+
+    def _usage(self, messages: List[BaseMessage], content: str) -> Dict[str, int]:
+        # Estimation à ~4 caractères par token
+        input_tokens = sum(len(str(message.content)) for message in messages) // 4
+        output_tokens = len(content) // 4
+        return {"input_tokens": input_tokens, "output_tokens": output_tokens,
+                "total_tokens": input_tokens + output_tokens}
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager=None, **kwargs) -> ChatResult:
+        content = self._response_for(messages)
+        time.sleep(self.seconds_per_chunk * math.ceil(len(content) / self.chunk_size))
+        message = AIMessage(content=content, usage_metadata=self._usage(messages, content))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager=None, **kwargs) -> Iterator[ChatGenerationChunk]:
+        content = self._response_for(messages)
+        for start in range(0, len(content), self.chunk_size):
+            time.sleep(self.seconds_per_chunk)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=content[start:start + self.chunk_size]))
+
+
+def recorded_response(path: str | os.PathLike, class_name: str) -> str:
+    """
+    Réponse au format de generate_manim_script reconstruite à partir d'une scène du dépôt.
+    Les chaînes LaTeX sont passées en chaînes brutes, comme le ferait la réparation automatique.
+    """
+    from app.tools.repair import fix_raw_latex
+
+    source = Path(path).read_text(encoding="utf-8")
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", SyntaxWarning)
+        tree = ast.parse(source)
+        imports = [ast.get_source_segment(source, node) for node in tree.body
+                   if isinstance(node, (ast.Import, ast.ImportFrom))]
+        scene = next(node for node in tree.body if isinstance(node, ast.ClassDef) and node.name == class_name)
+        code = fix_raw_latex("\n".join(imports) + "\n\n" + ast.get_source_segment(source, scene))
+    return f"===CODE===\n{code}\n===CLASS_NAME===\n{class_name}\n"
+
+
+def load_corpus(path: Optional[str] = None) -> List[Dict[str, str]]:
+    """Corpus JSONL ({"concept", "class_name", "response"}) ou, par défaut, les scènes du dépôt."""
+    if path is None:
+        return [
+            {"concept": concept, "class_name": class_name, "response": recorded_response(source, class_name)}
+            for concept, source, class_name in CORPUS_SOURCES
+        ]
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def git_commit() -> Dict[str, Any]:
+    def git(*args: str) -> str:
+        result = subprocess.run(["git", *args], capture_output=True, text=True, cwd=PROJECT_ROOT)
+        return result.stdout.strip()
+    return {"sha": git("rev-parse", "HEAD") or None, "dirty": bool(git("status", "--porcelain", "--untracked-files=no"))}
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def _summarize(records: List[Dict[str, Any]]) -> Dict[str, Any]:
+    seconds = [record["seconds"] for record in records]
+    return {
+        "runs": len(records),
+        "success": sum(record["success"] for record in records),
+        "mean_seconds": statistics.fmean(seconds) if seconds else None,
+        "p50_seconds": percentile(seconds, 0.5),
+        "p95_seconds": percentile(seconds, 0.95),
+    }
+
+
+class Benchmark:
+    """
+    Mesure la chaîne génération -> validation -> rendu du BatchRunner, sans réseau :
+    - latence par scène à froid, avec caches LaTeX/LLM chauds (cache de rendu désactivé), puis tout à chaud
+    - débit (rendus/heure) à concurrence N, cache de rendu désactivé
+    - répartition par étape issue de la trace de chaque concept
+    """
+
+    def __init__(self, corpus: List[Dict[str, str]], concurrency: int = 2, repeats: int = 2,
+                 quality: str = "low", seconds_per_chunk: float = 0.0):
+        self.corpus = corpus
+        self.concurrency = max(1, concurrency)
+        self.repeats = max(1, repeats)
+        self.quality = quality
+        self.seconds_per_chunk = seconds_per_chunk
+
+    def _runner(self, workers: int, work_dir: str):
+        from app.batch import BatchRunner
+        return BatchRunner(os.path.join(work_dir, "manifest.jsonl"), llm_concurrency=workers,
+                           render_workers=workers, max_attempts=1, quality=self.quality)
+
+    async def _timed(self, runner, entry: Dict[str, str]) -> Dict[str, Any]:
+        started = time.perf_counter()
+        record = await runner.process_concept({"concept": entry["concept"]})
+        return {
+            "class_name": entry["class_name"],
+            "success": record["success"],
+            "seconds": time.perf_counter() - started,
+            "message": None if record["success"] else record.get("message"),
+            "stages": record["trace"]["stages"],
+            "counters": record["trace"]["counters"],
+        }
+
+    async def latency(self, work_dir: str) -> Dict[str, Any]:
+        phases = [("cold", "1"), ("warm_assets", "0"), ("warm", "1")]
+        scenes: Dict[str, Dict[str, Any]] = {entry["class_name"]: {} for entry in self.corpus}
+        for phase, render_cache in phases:
+            # Lu par chaque rendu : les workers du pool, créés ensuite, héritent de la valeur
+            os.environ["MATHCONCEPT_RENDER_CACHE"] = render_cache
+            runner = self._runner(1, work_dir)
+            try:
+                for entry in self.corpus:
+                    scenes[entry["class_name"]][phase] = await self._timed(runner, entry)
+            finally:
+                runner.scheduler.shutdown()
+        return scenes
+
+    async def throughput(self, work_dir: str) -> Dict[str, Any]:
+        os.environ["MATHCONCEPT_RENDER_CACHE"] = "0"
+        runner = self._runner(self.concurrency, work_dir)
+        jobs = [entry for _ in range(self.repeats) for entry in self.corpus]
+        started = time.perf_counter()
+        try:
+            records = await asyncio.gather(*(self._timed(runner, entry) for entry in jobs))
+        finally:
+            runner.scheduler.shutdown()
+        elapsed = time.perf_counter() - started
+        successes = sum(record["success"] for record in records)
+        return {
+            "concurrency": self.concurrency,
+            "jobs": len(jobs),
+            "elapsed_seconds": elapsed,
+            "renders_per_hour": successes / elapsed * 3600 if elapsed else None,
+            **_summarize(records),
+        }
+
+    async def run(self) -> Dict[str, Any]:
+        from app.tools.manim import SCRIPT_MODEL
+        from app.tools.render_cache import package_version
+        from app.utils.llm import register_chat_model
+
+        responses = {entry["concept"]: entry["response"] for entry in self.corpus}
+        register_chat_model(SCRIPT_MODEL, ReplayChatModel(responses=responses,
+                                                          seconds_per_chunk=self.seconds_per_chunk))
+        with tempfile.TemporaryDirectory(prefix="mathconcept_bench_") as work_dir:
+            latency = await self.latency(work_dir)
+            throughput = await self.throughput(work_dir)
+        return {
+            "commit": git_commit(),
+            "timestamp": time.time(),
+            "environment": {
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpu_count": os.cpu_count(),
+                "manim": package_version("manim"),
+                "manim-voiceover": package_version("manim-voiceover"),
+            },
+            "config": {
+                "scenes": [entry["class_name"] for entry in self.corpus],
+                "concurrency": self.concurrency,
+                "repeats": self.repeats,
+                "quality": self.quality,
+                "seconds_per_chunk": self.seconds_per_chunk,
+            },
+            "latency": latency,
+            "throughput": throughput,
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark hors ligne génération -> vidéo (LLM et TTS simulés)")
+    parser.add_argument("--corpus", default=None, help="JSONL {concept, class_name, response} (défaut: scènes du dépôt)")
+    parser.add_argument("--concurrency", type=int, default=2)
+    parser.add_argument("--repeats", type=int, default=2, help="passages du corpus pour la mesure de débit")
+    parser.add_argument("--quality", default="low", choices=["low", "medium", "high", "4k"])
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="secondes simulées par morceau de réponse")
+    parser.add_argument("--cache-dir", default=None, help="dossier de cache (défaut: dossier temporaire vide)")
+    parser.add_argument("--output", default=None, help="fichier JSON de résultats (défaut: sortie standard)")
+    args = parser.parse_args()
+
+    # Avant tout import de `app` : les caches et le service TTS sont choisis à l'import
+    cache_dir = args.cache_dir or tempfile.mkdtemp(prefix="mathconcept_bench_cache_")
+    os.environ["MATHCONCEPT_CACHE_DIR"] = cache_dir
+    os.environ["MATHCONCEPT_TTS_BACKEND"] = "stub"
+
+    benchmark = Benchmark(load_corpus(args.corpus), concurrency=args.concurrency, repeats=args.repeats,
+                          quality=args.quality, seconds_per_chunk=args.llm_latency)
+    results = json.dumps(asyncio.run(benchmark.run()), indent=2, ensure_ascii=False)
+    if args.output:
+        Path(args.output).write_text(results + "\n", encoding="utf-8")
+    else:
+        print(results)
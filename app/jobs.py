@@ -0,0 +1,343 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import sqlite3
+import argparse
+import threading
+from pathlib import Path
+from typing import Dict, Any, AsyncIterator, List, Optional
+
+from app.utils.cache import CACHE_ROOT
+from app.utils.concepts import CONCEPT_INDEX, concept_cache_enabled, normalize_concept
+
+JOBS_DB = Path(os.getenv("MATHCONCEPT_JOBS_DB", CACHE_ROOT / "jobs.sqlite"))
+
+# Classes de priorité : la plus petite valeur passe en premier, à ancienneté égale
+PRIORITIES = {"interactive": 0, "normal": 1, "batch": 2}
+
+# Contrôle d'admission : au-delà, une nouvelle demande est refusée plutôt que de surcharger la machine
+MAX_QUEUED = int(os.getenv("MATHCONCEPT_JOBS_MAX_QUEUED", 1000))
+
+# Intervalle de scrutation de la base quand un autre processus soumet ou traite les jobs
+POLL_INTERVAL = float(os.getenv("MATHCONCEPT_JOBS_POLL_INTERVAL", 1.0))
+
+TERMINAL_STATUSES = ("succeeded", "failed", "cancelled")
+
+
+class QueueFullError(Exception):
+    """La file a atteint MAX_QUEUED jobs en attente."""
+
+
+def job_key(concept: str, quality: str) -> str:
+    """Clé idempotente : deux demandes du même concept (après normalisation) et de même qualité n'en font qu'une."""
+    normalized = normalize_concept(concept) or concept.strip().lower()
+    return hashlib.sha256(f"{normalized}\n{quality}".encode("utf-8")).hexdigest()[:24]
+
+
+class JobQueue:
+    """
+    File de jobs durable dans SQLite, partagée entre les processus qui soumettent et celui qui les traite :
+    - `jobs` : un job par clé, avec son statut, sa priorité et son résultat
+    - `job_events` : événements de progression numérotés, relus par les abonnés
+    """
+
+    def __init__(self, path: str | os.PathLike = JOBS_DB, max_queued: int = MAX_QUEUED):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_queued = max_queued
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY, concept TEXT, quality TEXT, priority INTEGER, status TEXT,
+                submissions INTEGER DEFAULT 1, result TEXT, created REAL, updated REAL)""")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, priority, created)")
+            conn.execute("""CREATE TABLE IF NOT EXISTS job_events (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT, job_id TEXT, time REAL, stage TEXT, data TEXT)""")
+            conn.execute("CREATE INDEX IF NOT EXISTS job_events_job ON job_events (job_id, seq)")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def _row(self, row) -> Dict[str, Any]:
+        return {"id": row[0], "concept": row[1], "quality": row[2], "priority": row[3], "status": row[4],
+                "submissions": row[5], "result": json.loads(row[6]) if row[6] else None,
+                "created": row[7], "updated": row[8]}
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._row(row) if row else None
+
+    def list(self, status: Optional[str] = None, limit: int = 100) -> List[Dict[str, Any]]:
+        where, params = ("WHERE status = ?", [status]) if status else ("", [])
+        with self._connect() as conn:
+            rows = conn.execute(f"SELECT * FROM jobs {where} ORDER BY priority, created LIMIT ?",
+                                [*params, limit]).fetchall()
+        return [self._row(row) for row in rows]
+
+    def counts(self) -> Dict[str, int]:
+        with self._connect() as conn:
+            return dict(conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+    def submit(self, concept: str, priority: str = "normal", quality: str = "medium") -> Dict[str, Any]:
+        """
+        Ajoute un job, ou rattache la demande au job existant de même clé (en attente, en cours ou réussi).
+        Un job échoué ou annulé est remis en file, sans les événements de l'essai précédent :
+        un abonné ne voit que la nouvelle exécution. Une priorité plus haute remonte un job en attente.
+        """
+        if priority not in PRIORITIES:
+            raise ValueError(f"Priorité inconnue: {priority} (choix: {', '.join(PRIORITIES)})")
+        key, rank, now = job_key(concept, quality), PRIORITIES[priority], time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT status FROM jobs WHERE id = ?", (key,)).fetchone()
+                if row is None or row[0] in ("failed", "cancelled"):
+                    queued = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+                    if queued >= self.max_queued:
+                        raise QueueFullError(f"{queued} jobs en attente (maximum {self.max_queued})")
+                if row is None:
+                    conn.execute("""INSERT INTO jobs (id, concept, quality, priority, status, created, updated)
+                                    VALUES (?, ?, ?, ?, 'queued', ?, ?)""", (key, concept, quality, rank, now, now))
+                elif row[0] in ("failed", "cancelled"):
+                    conn.execute("DELETE FROM job_events WHERE job_id = ?", (key,))
+                    conn.execute("""UPDATE jobs SET status = 'queued', priority = ?, result = NULL,
+                                    submissions = submissions + 1, created = ?, updated = ? WHERE id = ?""",
+                                 (rank, now, now, key))
+                else:
+                    conn.execute("""UPDATE jobs SET priority = MIN(priority, ?), submissions = submissions + 1,
+                                    updated = ? WHERE id = ?""", (rank, now, key))
+                if row is None or row[0] in ("failed", "cancelled"):
+                    self._insert_event(conn, key, "queued", {"priority": priority})
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return self.get(key)
+
+    def claim(self) -> Optional[Dict[str, Any]]:
+        """Passe le job en attente le plus prioritaire (puis le plus ancien) en cours, atomiquement."""
+        with self._lock, self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("""SELECT id FROM jobs WHERE status = 'queued'
+                                  ORDER BY priority, created LIMIT 1""").fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            conn.execute("UPDATE jobs SET status = 'running', updated = ? WHERE id = ?", (time.time(), row[0]))
+            self._insert_event(conn, row[0], "running", {})
+            conn.execute("COMMIT")
+        return self.get(row[0])
+
+    def finish(self, job_id: str, result: Dict[str, Any]) -> None:
+        status = "succeeded" if result.get("success") else "failed"
+        with self._lock, self._connect() as conn:
+            conn.execute("UPDATE jobs SET status = ?, result = ?, updated = ? WHERE id = ?",
+                         (status, json.dumps(result, ensure_ascii=False, default=str), time.time(), job_id))
+            self._insert_event(conn, job_id, status, {"video_path": result.get("video_path"),
+                                                      "message": result.get("message")})
+
+    def cancel(self, job_id: str) -> bool:
+        """Annule un job encore en attente ; un job déjà lancé va jusqu'au bout."""
+        with self._lock, self._connect() as conn:
+            updated = conn.execute("UPDATE jobs SET status = 'cancelled', updated = ? WHERE id = ? AND status = 'queued'",
+                                   (time.time(), job_id)).rowcount
+            if updated:
+                self._insert_event(conn, job_id, "cancelled", {})
+        return bool(updated)
+
+    def requeue_running(self) -> int:
+        """Au démarrage : les jobs restés `running` après un arrêt brutal repartent en file."""
+        with self._lock, self._connect() as conn:
+            rows = conn.execute("SELECT id FROM jobs WHERE status = 'running'").fetchall()
+            conn.execute("UPDATE jobs SET status = 'queued', updated = ? WHERE status = 'running'", (time.time(),))
+            for (job_id,) in rows:
+                self._insert_event(conn, job_id, "queued", {"recovered": True})
+        return len(rows)
+
+    def _insert_event(self, conn: sqlite3.Connection, job_id: str, stage: str, data: Dict[str, Any]) -> None:
+        conn.execute("INSERT INTO job_events (job_id, time, stage, data) VALUES (?, ?, ?, ?)",
+                     (job_id, time.time(), stage, json.dumps(data, ensure_ascii=False, default=str)))
+
+    def add_event(self, job_id: str, stage: str, **data) -> None:
+        with self._lock, self._connect() as conn:
+            self._insert_event(conn, job_id, stage, data)
+
+    def events(self, job_id: str, after: int = 0) -> List[Dict[str, Any]]:
+        with self._connect() as conn:
+            rows = conn.execute("""SELECT seq, time, stage, data FROM job_events
+                                   WHERE job_id = ? AND seq > ? ORDER BY seq""", (job_id, after)).fetchall()
+        return [{"seq": seq, "time": at, "stage": stage, **json.loads(data)} for seq, at, stage, data in rows]
+
+
+class JobService:
+    """
+    Traite la file avec la chaîne du BatchRunner (génération -> validation -> rendu) :
+    - au plus `llm_concurrency` générations et `render_workers` rendus en cours (par défaut, la limite partagée de RENDER_SCHEDULER) ;
+      un job n'est retiré de la file que lorsqu'un emplacement se libère (contre-pression)
+    - un concept déjà produit est servi depuis l'index des artefacts, sans génération
+    - la progression de chaque job est publiée dans `job_events` et suivie avec `subscribe`
+    """
+
+    def __init__(self, queue: Optional[JobQueue] = None, llm_concurrency: int = 4,
+                 render_workers: Optional[int] = None, max_attempts: int = 3, quality: str = "medium"):
+        from app.batch import BatchRunner
+
+        self.queue = queue or JobQueue()
+        self.runner = BatchRunner(os.devnull, llm_concurrency=llm_concurrency, render_workers=render_workers,
+                                  max_attempts=max_attempts, quality=quality)
+        self._wakeup: Optional[asyncio.Event] = None
+
+    @property
+    def slots(self) -> int:
+        return self.runner.llm_concurrency + self.runner.scheduler.max_workers
+
+    def submit(self, concept: str, priority: str = "normal", quality: str = "medium") -> Dict[str, Any]:
+        job = self.queue.submit(concept, priority=priority, quality=quality)
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return job
+
+    async def _next_job(self) -> Dict[str, Any]:
+        while True:
+            job = await asyncio.to_thread(self.queue.claim)
+            if job is not None:
+                return job
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _write_event(self, previous: Optional[asyncio.Task], job_id: str, stage: str,
+                           data: Dict[str, Any]) -> None:
+        if previous is not None:
+            await previous
+        await asyncio.to_thread(self.queue.add_event, job_id, stage, **data)
+
+    async def _process(self, job: Dict[str, Any]) -> None:
+        job_id = job["id"]
+        started = time.perf_counter()
+        writes: List[asyncio.Task] = []
+
+        def on_event(stage: str, **data) -> None:
+            # Écriture SQLite hors de la boucle d'événements, dans l'ordre d'émission
+            previous = writes[-1] if writes else None
+            writes.append(asyncio.create_task(self._write_event(previous, job_id, stage, data)))
+
+        try:
+            hit = await asyncio.to_thread(CONCEPT_INDEX.lookup, job["concept"]) if concept_cache_enabled() else None
+            if hit is not None:
+                record = {"concept": job["concept"], "success": True, "video_path": hit["path"],
+                          "class_name": hit["class_name"], "message": "Vidéo déjà générée", "cached": True}
+            else:
+                record = await self.runner.process_concept(
+                    {"concept": job["concept"], "quality": job["quality"]}, on_event=on_event,
+                )
+        except Exception as e:
+            record = {"concept": job["concept"], "success": False, "message": str(e)[:500]}
+        record["total_seconds"] = time.perf_counter() - started
+        # L'état final est écrit après les événements de progression
+        await asyncio.gather(*writes, return_exceptions=True)
+        await asyncio.to_thread(self.queue.finish, job_id, record)
+
+    async def run(self, stop_when_idle: bool = False) -> None:
+        """Boucle de traitement ; avec stop_when_idle, s'arrête dès que la file est vide."""
+        self._wakeup = asyncio.Event()
+        recovered = await asyncio.to_thread(self.queue.requeue_running)
+        if recovered:
+            print(f"{recovered} job(s) interrompu(s) remis en file")
+
+        async def worker():
+            while True:
+                if stop_when_idle:
+                    job = await asyncio.to_thread(self.queue.claim)
+                    if job is None:
+                        return
+                else:
+                    job = await self._next_job()
+                await self._process(job)
+
+        tasks = [asyncio.create_task(worker()) for _ in range(self.slots)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.runner.close()
+
+    async def subscribe(self, job_id: str) -> AsyncIterator[Dict[str, Any]]:
+        """Événements du job depuis sa soumission, jusqu'à son état final."""
+        async for event in subscribe(self.queue, job_id):
+            yield event
+
+
+async def subscribe(queue: JobQueue, job_id: str, poll_interval: float = 0.2) -> AsyncIterator[Dict[str, Any]]:
+    """Relit `job_events` au fil de l'eau ; fonctionne aussi depuis un autre processus que le service."""
+    last = 0
+    while True:
+        for event in await asyncio.to_thread(queue.events, job_id, last):
+            last = event["seq"]
+            yield event
+            if event["stage"] in TERMINAL_STATUSES:
+                return
+        job = await asyncio.to_thread(queue.get, job_id)
+        if job is None:
+            return
+        await asyncio.sleep(poll_interval)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="File de jobs de génération de vidéos")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve = commands.add_parser("serve", help="traite la file")
+    serve.add_argument("--llm-concurrency", type=int, default=4)
+    serve.add_argument("--render-workers", type=int, default=None)
+    serve.add_argument("--max-attempts", type=int, default=3)
+    serve.add_argument("--until-empty", action="store_true", help="s'arrête quand la file est vide")
+
+    submit = commands.add_parser("submit", help="soumet un concept")
+    submit.add_argument("concept")
+    submit.add_argument("--priority", choices=list(PRIORITIES), default="normal")
+    submit.add_argument("--quality", choices=["low", "medium", "high", "4k"], default="medium")
+    submit.add_argument("--wait", action="store_true", help="suit la progression jusqu'à la fin du job")
+
+    status = commands.add_parser("status", help="état d'un job, ou de la file")
+    status.add_argument("job_id", nargs="?")
+
+    watch = commands.add_parser("watch", help="suit la progression d'un job")
+    watch.add_argument("job_id")
+
+    cancel = commands.add_parser("cancel", help="annule un job en attente")
+    cancel.add_argument("job_id")
+
+    args = parser.parse_args()
+    queue = JobQueue()
+
+    async def follow(job_id: str) -> None:
+        async for event in subscribe(queue, job_id):
+            print(json.dumps(event, ensure_ascii=False))
+
+    if args.command == "serve":
+        service = JobService(queue, llm_concurrency=args.llm_concurrency, render_workers=args.render_workers,
+                             max_attempts=args.max_attempts)
+        asyncio.run(service.run(stop_when_idle=args.until_empty))
+    elif args.command == "submit":
+        try:
+            job = queue.submit(args.concept, priority=args.priority, quality=args.quality)
+        except QueueFullError as e:
+            raise SystemExit(f"Demande refusée: {e}")
+        print(json.dumps(job, indent=2, ensure_ascii=False))
+        if args.wait:
+            asyncio.run(follow(job["id"]))
+    elif args.command == "status":
+        result = queue.get(args.job_id) if args.job_id else {"counts": queue.counts(), "queued": queue.list("queued")}
+        print(json.dumps(result, indent=2, ensure_ascii=False))
+    elif args.command == "watch":
+        asyncio.run(follow(args.job_id))
+    elif args.command == "cancel":
+        print("annulé" if queue.cancel(args.job_id) else "job introuvable ou déjà lancé")
@@ -3,31 +3,36 @@ import re
 import glob
 import shutil
 import asyncio
+import threading
 from pathlib import Path
+from collections import OrderedDict
 from typing import Dict, Any
-from langchain_core.tools import tool
+from langchain_core.tools import tool, StructuredTool
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_nvidia_ai_endpoints import ChatNVIDIA
 from dotenv import load_dotenv
-from subprocess import run
+from app.tools.render import (
+    DEFAULT_DRAFT,
+    background_render_status,
+    render_progressive,
+    render_progressive_async,
+)
+from app.tools.validation import preflight
+from app.tools.streaming import stream_script
+from app.tools.repair import describe_failure, format_diagnostic, repair_scene
+from app.utils.cache import hash_key
+from app.utils.history import resolve_code
+from app.utils.llm import RESPONSE_CACHE, cached_invoke, get_chat_model, response_cache_key
+from app.utils.tracing import child_tracing, count, record_stages, span
 load_dotenv()
 
-llm = ChatNVIDIA(
-    model="meta/llama-3.1-70b-instruct",
-    api_key=os.getenv("NVIDIA_API_KEY"), 
-    temperature=0.2,
-    top_p=0.7,
-    max_completion_tokens=8192,
-)
+SCRIPT_MODEL = "meta/llama-3.1-70b-instruct"
 
-@tool
-def generate_manim_script(concept: str) -> Dict[str, str]:
-    """
-    ÉTAPE 1/2 - Génère un script Python Manim(manim-voiceover) avec narration synchronisée.
-    """
-    print("in generate_manim_script")
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", """
+# Génération en streaming avec arrêt dès le nom de classe reçu (MATHCONCEPT_STREAM_GENERATION=0 pour invoke)
+STREAM_GENERATION = os.getenv("MATHCONCEPT_STREAM_GENERATION", "1") not in ("0", "false", "False")
+
+# Prompt construit une seule fois, à l'import
+SCRIPT_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", """
             Vous êtes un expert en visualisation mathématique avec Manim et manim-voiceover.
 
             OBJECTIF :
@@ -107,16 +112,12 @@ def generate_manim_script(concept: str) -> Dict[str, str]:
             ===CLASS_NAME===
             [Nom de classe]
             """),
-                ("user", "Explique ce concept avec Manim : {concept}")
-            ])
+    ("user", "Explique ce concept avec Manim : {concept}")
+])
 
 
-
-    
-    chain = prompt | llm
-    response = chain.invoke({"concept": concept})
-    content = response.content
-    
+def parse_script_response(content: str) -> Dict[str, str]:
+    """Extrait le code et le nom de classe d'une réponse au format ===CODE=== / ===CLASS_NAME===."""
     code_pattern = r"===CODE===\s*(.*?)\s*===CLASS_NAME==="
     class_name_pattern = r"===CLASS_NAME===\s*(\w+)"
     
@@ -157,60 +158,192 @@ def generate_manim_script(concept: str) -> Dict[str, str]:
     }
 
 
+# Clés du cache de réponses des derniers scripts générés (LRU borné), pour oublier ceux dont le rendu échoue
+SCRIPT_CACHE_KEYS_MAX = 1024
+_SCRIPT_CACHE_KEYS: "OrderedDict[str, str]" = OrderedDict()
+_SCRIPT_CACHE_KEYS_LOCK = threading.Lock()
+
+
+def _remember_script(code: str, response_key: str) -> None:
+    code_key = hash_key(code)
+    with _SCRIPT_CACHE_KEYS_LOCK:
+        _SCRIPT_CACHE_KEYS[code_key] = response_key
+        _SCRIPT_CACHE_KEYS.move_to_end(code_key)
+        while len(_SCRIPT_CACHE_KEYS) > SCRIPT_CACHE_KEYS_MAX:
+            _SCRIPT_CACHE_KEYS.popitem(last=False)
+
+
+def forget_failed_script(code: str) -> None:
+    """Retire du cache LLM la réponse qui a produit `code` : une nouvelle demande régénérera le script."""
+    with _SCRIPT_CACHE_KEYS_LOCK:
+        key = _SCRIPT_CACHE_KEYS.pop(hash_key(code), None)
+    if key is not None and RESPONSE_CACHE is not None:
+        RESPONSE_CACHE.delete(key)
+
+
 @tool
-def execute_manim_with_audio(code: str, math_scene: str) -> Dict[str, Any]:
+def generate_manim_script(concept: str, use_cache: bool = True) -> Dict[str, str]:
     """
-    ÉTAPE 2/2 - Exécute le code Python.
+    ÉTAPE 1/2 - Génère un script Python Manim(manim-voiceover) avec narration synchronisée.
+    Une demande identique déjà traitée est servie depuis le cache (use_cache=False pour forcer
+    une nouvelle génération).
     """
+    print("in generate_manim_script")
+    with span("generate_script", stream=STREAM_GENERATION):
+        llm = get_chat_model(SCRIPT_MODEL)
+        messages = SCRIPT_PROMPT.format_messages(concept=concept)
+        producer = (lambda: stream_script(llm, messages)) if STREAM_GENERATION else None
+        content = cached_invoke(llm, messages, use_cache=use_cache, producer=producer)
+    with span("parse_script"):
+        script = parse_script_response(content)
+    _remember_script(script["code"], response_cache_key(llm, messages))
+    if script["code"].startswith("# Erreur"):
+        forget_failed_script(script["code"])
+    return script
+
+
+def _invalid_options(error: ValueError) -> Dict[str, Any]:
+    return {"success": False, "video_path": None, "message": str(error), "metadata": {}}
+
+
+def _with_trace(result: Dict[str, Any], tracer) -> Dict[str, Any]:
+    """
+    Remplace les étapes brutes des rendus par le résumé de la trace de l'appel (durée totale, temps par étape) ;
+    les spans détaillés restent dans le traceur de la requête et son export.
+    """
+    metadata = result["metadata"]
+    record_stages(metadata.pop("draft_stages", []), render_pass="draft")
+    record_stages(metadata.pop("stages", []), render_pass="final")
+    metadata["trace"] = tracer.to_metadata()
+    return result
+
+
+def _with_diagnostic(code: str, math_scene: str, result: Dict[str, Any]) -> Dict[str, Any]:
+    """Ajoute à un échec l'étape, la ligne et l'erreur identifiées, pour une réparation ciblée."""
+    count("failed_renders")
+    forget_failed_script(code)
+    error = describe_failure(code, math_scene, result)
+    result["metadata"]["error"] = error
+    result["message"] = f"{result['message']}\n{format_diagnostic(error)}"
+    return result
+
+
+def _execute_manim_with_audio(code: str, math_scene: str, use_cache: bool = True, quality: str = "medium",
+                              draft: str = DEFAULT_DRAFT, background: bool = False,
+                              sections: bool = False, concept: str = "") -> Dict[str, Any]:
     print("in execute_manim_with_audio")
-    CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
-    OUTPUT_SCENE_DIR = os.path.join(CURRENT_DIR, "scene")
-    
-    for dir_path in [OUTPUT_SCENE_DIR]:
-        os.makedirs(dir_path, exist_ok=True)
-    
-    file_code = os.path.join(OUTPUT_SCENE_DIR, "scene.py")
-    import datetime
-    
-    final_video = os.path.join(OUTPUT_SCENE_DIR, f"{math_scene}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.mp4")
-    
     try:
-        with open(file_code, "w", encoding="utf-8") as f:
-            f.write(code)
-        print(f"Code écrit: {file_code}")
-        
-        manim_cmd = ["manim", "-qm", "-o", final_video, file_code, math_scene]        
-        result = run(manim_cmd, capture_output=True, text=True, cwd=OUTPUT_SCENE_DIR)
-        
-        if result.returncode != 0:
-            return {
-                "success": False,
-                "video_path": None,
-                "message": f"Erreur Manim: {result.stderr[:500]}",
-                "metadata": {}
-            }
-        # zupprimer le dossier media et
-        # os.removedirs(os.path.join(OUTPUT_SCENE_DIR, "media"))
-        shutil.rmtree(os.path.join(OUTPUT_SCENE_DIR, "media"))
-        srt_file = final_video.replace(".mp4", ".srt")
-        wav_file = final_video.replace(".mp4", ".wav")
-        os.remove(os.path.join(OUTPUT_SCENE_DIR, srt_file))
-        os.remove(os.path.join(OUTPUT_SCENE_DIR, wav_file))
-        return {
-            "success": True,
-            "video_path": final_video,
-            "message": "Vidéo générée avec succès",
-            "metadata": {}
-        }
-        
-    except Exception as e:
-        return {
-            "success": False,
-            "video_path": None,
-            "message": f"Erreur Manim: {str(e)[:500]}",
-            "metadata": {}
-         }
-            
+        code = resolve_code(code)
+    except ValueError as e:
+        return _invalid_options(e)
+    with child_tracing("execute_manim_with_audio") as tracer:
+        # Validation statique avant de lancer Manim : quelques millisecondes au lieu d'un rendu raté
+        with span("validate"):
+            failure = preflight(code, math_scene)
+        if failure is not None:
+            return _with_trace(_with_diagnostic(code, math_scene, failure), tracer)
+        # Chaque rendu tourne dans son propre espace de travail, via le pool de rendus borné
+        try:
+            with span("render", quality=quality, draft=draft, sections=sections) as attrs:
+                result = render_progressive(code, math_scene, quality=quality, draft=draft,
+                                            background=background, use_cache=use_cache, sections=sections,
+                                            concept=concept)
+                attrs["cache"] = result["metadata"].get("cache")
+        except ValueError as e:
+            return _invalid_options(e)
+        if not result["success"]:
+            result = _with_diagnostic(code, math_scene, result)
+        return _with_trace(result, tracer)
+
+
+def _progress_writer():
+    """Writer du stream `custom` de LangGraph si l'outil tourne dans le graphe, sinon None."""
+    try:
+        from langgraph.config import get_stream_writer
+        return get_stream_writer()
+    except (ImportError, RuntimeError):
+        return None
+
+
+async def _aexecute_manim_with_audio(code: str, math_scene: str, use_cache: bool = True, quality: str = "medium",
+                                     draft: str = DEFAULT_DRAFT, background: bool = False,
+                                     sections: bool = False, concept: str = "") -> Dict[str, Any]:
+    print("in execute_manim_with_audio (async)")
+    try:
+        code = resolve_code(code)
+    except ValueError as e:
+        return _invalid_options(e)
+    with child_tracing("execute_manim_with_audio") as tracer:
+        with span("validate"):
+            failure = await asyncio.to_thread(preflight, code, math_scene)
+        if failure is not None:
+            return _with_trace(_with_diagnostic(code, math_scene, failure), tracer)
+        writer = _progress_writer()
+
+        def on_progress(line: str) -> None:
+            if writer is not None:
+                writer({"tool": "execute_manim_with_audio", "scene": math_scene, "progress": line})
+
+        try:
+            with span("render", quality=quality, draft=draft, sections=sections) as attrs:
+                result = await render_progressive_async(code, math_scene, quality=quality, draft=draft,
+                                                        background=background, use_cache=use_cache,
+                                                        sections=sections, concept=concept,
+                                                        on_progress=on_progress)
+                attrs["cache"] = result["metadata"].get("cache")
+        except ValueError as e:
+            return _invalid_options(e)
+        if not result["success"]:
+            result = _with_diagnostic(code, math_scene, result)
+        return _with_trace(result, tracer)
+
 
+# Outil exposé en synchrone (graph.invoke) et en asynchrone (graph.ainvoke / langgraph-api)
+execute_manim_with_audio = StructuredTool.from_function(
+    func=_execute_manim_with_audio,
+    coroutine=_aexecute_manim_with_audio,
+    name="execute_manim_with_audio",
+    description="""
+    ÉTAPE 2/2 - Exécute le code Python.
+    Si le même code a déjà été rendu, la vidéo en cache est retournée directement
+    (use_cache=False force un nouveau rendu).
+    quality: "low", "medium" (défaut), "high" ou "4k".
+    draft: passe rapide avant le rendu final ("none", "dry_run" ou "low").
+    background: si True, le rendu final continue en arrière-plan après le brouillon ;
+    suivre son avancement avec get_render_status.
+    sections: si True, chaque "# Étape N" est rendue en parallèle puis les vidéos sont assemblées ;
+    une étape inchangée depuis l'essai précédent n'est pas re-rendue.
+    concept: le concept demandé par l'utilisateur, pour retrouver la vidéo dans l'index des artefacts.
+    code accepte aussi une référence `ref:<id>` vue dans l'historique.
+    """,
+)
 
 
+@tool
+def get_render_status(job_id: str) -> Dict[str, Any]:
+    """
+    Retourne l'état d'un rendu final lancé en arrière-plan par execute_manim_with_audio.
+    """
+    return background_render_status(job_id)
+
+
+@tool
+def repair_manim_script(code: str, class_name: str, error: str) -> Dict[str, Any]:
+    """
+    Corrige un script Manim dont l'exécution a échoué, sans tout régénérer :
+    corrections connues d'abord, puis correctif de la seule étape fautive.
+    error: le message d'erreur complet retourné par execute_manim_with_audio.
+    code accepte aussi une référence `ref:<id>` vue dans l'historique.
+    Relancer ensuite execute_manim_with_audio avec le code corrigé et sections=True
+    pour ne re-rendre que les étapes modifiées.
+    """
+    print("in repair_manim_script")
+    try:
+        code = resolve_code(code)
+    except ValueError as e:
+        # Échec explicite (compté par sendError) plutôt qu'une exception de l'outil
+        return _invalid_options(e)
+    with span("repair") as attrs:
+        repaired = repair_scene(code, class_name, error)
+        attrs["strategy"] = repaired["strategy"]
+    return repaired
@@ -0,0 +1,666 @@
+import os
+import re
+import uuid
+import time
+import atexit
+import signal
+import shutil
+import asyncio
+import tempfile
+import threading
+import multiprocessing
+from pathlib import Path
+from subprocess import Popen
+from contextlib import asynccontextmanager, contextmanager
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, Any, List, Iterator, Optional, Callable, Tuple
+
+from app.tools.render_cache import RENDER_CACHE, render_cache_enabled, render_cache_key
+from app.tools.speech import presynthesize
+from app.tools.voiceover import SCENE_PREAMBLE
+from app.tools.tex_cache import write_manim_config
+from app.tools.worker import WarmWorkerPool, render_job
+from app.utils.artifacts import ARTIFACT_STORE, SIDECAR_SUFFIXES
+from app.utils.cache import CACHE_ROOT
+from app.utils.tracing import STAGE_LOG_ENV, read_stage_log, span, stage_record
+
+# Vidéos rendues en attente de publication dans le magasin d'artefacts (même disque : déplacement sans copie)
+SCRATCH_DIR = CACHE_ROOT / "scratch"
+
+# Racine du dépôt, ajoutée au PYTHONPATH de Manim pour que le préambule des scènes trouve `app`
+PROJECT_ROOT = Path(__file__).resolve().parents[2]
+
+MAX_CONCURRENT_RENDERS = int(os.getenv("MATHCONCEPT_MAX_CONCURRENT_RENDERS", os.cpu_count() or 1))
+
+# Durée maximale d'un rendu asynchrone, en secondes
+RENDER_TIMEOUT = float(os.getenv("MATHCONCEPT_RENDER_TIMEOUT", 900))
+
+DEFAULT_QUALITY_FLAGS = ["-qm"]
+
+# "subprocess" : un processus `manim` par rendu ; "warm" : workers persistants qui gardent Manim importé
+RENDER_BACKEND = os.getenv("MATHCONCEPT_RENDER_BACKEND", "subprocess")
+
+# Fin de la sortie d'erreur conservée dans les métadonnées : la trace Python est à la fin
+STDERR_TAIL = 4000
+
+# Qualités sélectionnables par requête
+QUALITY_FLAGS = {
+    "low": ["-ql"],
+    "medium": ["-qm"],
+    "high": ["-qh"],
+    "4k": ["-qk"],
+}
+
+# Passe de brouillon exécutée avant le rendu final : "dry_run" construit la scène sans écrire de vidéo
+DRAFT_FLAGS = {
+    "none": None,
+    "dry_run": ["-ql", "--dry_run"],
+    "low": ["-ql"],
+}
+DEFAULT_DRAFT = os.getenv("MATHCONCEPT_RENDER_DRAFT", "none")
+
+# Les barres de progression de Manim utilisent \r : on découpe sur les deux
+_LINE_SPLIT = re.compile(r"[\r\n]+")
+
+# Intervalle d'échantillonnage de /proc pendant un rendu asynchrone, en secondes
+USAGE_SAMPLE_INTERVAL = 0.5
+_CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+# Intervalle de scrutation d'un rendu asynchrone qui attend une place dans RENDER_SCHEDULER, en secondes
+SLOT_POLL_INTERVAL = 0.1
+
+
+class RenderWorkspace:
+    """Dossier de travail isolé d'un rendu : module de scène unique et dossier media dédié."""
+
+    def __init__(self, root: str):
+        self.root = root
+        self.module_name = f"scene_{uuid.uuid4().hex[:12]}"
+        self.scene_file = os.path.join(root, f"{self.module_name}.py")
+        self.media_dir = os.path.join(root, "media")
+        self.stage_log = os.path.join(root, "stages.jsonl")
+
+
+@contextmanager
+def render_workspace() -> Iterator[RenderWorkspace]:
+    """Crée un espace de travail temporaire, supprimé quoi qu'il arrive à la sortie."""
+    root = tempfile.mkdtemp(prefix="mathconcept_render_")
+    try:
+        yield RenderWorkspace(root)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def render_env(workspace: Optional[RenderWorkspace] = None) -> Dict[str, str]:
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [str(PROJECT_ROOT), env.get("PYTHONPATH")]))
+    if workspace is not None:
+        env[STAGE_LOG_ENV] = workspace.stage_log
+    return env
+
+
+def run_with_usage(cmd: List[str], cwd: str, env: Dict[str, str]) -> Tuple[int, str, str, Dict[str, Any]]:
+    """
+    Exécute une commande et attend sa fin avec os.wait4 pour relever son temps CPU
+    et son pic de mémoire (processus fils terminés compris).
+    """
+    with tempfile.TemporaryFile("w+", encoding="utf-8", errors="replace") as out, \
+            tempfile.TemporaryFile("w+", encoding="utf-8", errors="replace") as err:
+        process = Popen(cmd, stdout=out, stderr=err, cwd=cwd, env=env)
+        _, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        out.seek(0)
+        err.seek(0)
+        usage = {"cpu_seconds": rusage.ru_utime + rusage.ru_stime, "peak_rss_mb": rusage.ru_maxrss / 1024}
+        return process.returncode, out.read(), err.read(), usage
+
+
+def read_proc_usage(pid: int) -> Optional[Dict[str, Any]]:
+    """Temps CPU (fils terminés compris) et pic de mémoire d'un processus en cours, lus dans /proc."""
+    try:
+        with open(f"/proc/{pid}/status", encoding="utf-8") as f:
+            status = f.read()
+        with open(f"/proc/{pid}/stat", encoding="utf-8") as f:
+            stat = f.read()
+    except OSError:
+        return None
+    hwm = re.search(r"VmHWM:\s+(\d+) kB", status)
+    # Champs 14 à 17 : utime, stime, cutime, cstime (le nom du processus peut contenir des espaces)
+    fields = stat.rsplit(")", 1)[1].split()
+    ticks = sum(int(value) for value in fields[11:15])
+    return {"cpu_seconds": ticks / _CLOCK_TICKS, "peak_rss_mb": int(hwm.group(1)) / 1024 if hwm else None}
+
+
+async def _sample_usage(pid: int, usage: Dict[str, Any]) -> None:
+    """Échantillonne /proc jusqu'à la fin du processus, d'abord souvent puis toutes les USAGE_SAMPLE_INTERVAL s."""
+    interval = 0.02
+    while True:
+        sample = read_proc_usage(pid)
+        if sample is None:
+            return
+        usage["cpu_seconds"] = sample["cpu_seconds"]
+        if sample["peak_rss_mb"] is not None:
+            usage["peak_rss_mb"] = max(usage.get("peak_rss_mb") or 0.0, sample["peak_rss_mb"])
+        await asyncio.sleep(interval)
+        interval = min(interval * 2, USAGE_SAMPLE_INTERVAL)
+
+
+def manim_command(workspace: RenderWorkspace, quality_flags: List[str], final_video: str,
+                  math_scene: str) -> List[str]:
+    """Ligne de commande Manim d'un rendu, avec le cache LaTeX partagé injecté par manim.cfg."""
+    config_file = write_manim_config(workspace.root)
+    return ["manim", *quality_flags, "--config_file", config_file, "--media_dir", workspace.media_dir,
+            "-o", final_video, workspace.scene_file, math_scene]
+
+
+def new_video_path(math_scene: str) -> str:
+    SCRATCH_DIR.mkdir(parents=True, exist_ok=True)
+    return str(SCRATCH_DIR / f"{math_scene}_{uuid.uuid4().hex[:12]}.mp4")
+
+
+def lookup_cached_render(code: str, math_scene: str, quality_flags: List[str]) -> Optional[Dict[str, Any]]:
+    """Retourne le résultat d'un rendu identique déjà en cache, sinon None."""
+    if not render_cache_enabled():
+        return None
+    cached_video = RENDER_CACHE.get(render_cache_key(code, math_scene, quality_flags))
+    if cached_video is None:
+        return None
+    return {
+        "success": True,
+        "video_path": str(cached_video),
+        "message": "Vidéo récupérée depuis le cache",
+        "metadata": {"cache": "hit", "cache_stats": RENDER_CACHE.stats()}
+    }
+
+
+def sidecar_paths(video: str) -> Dict[str, str]:
+    """Fichiers annexes écrits par Manim à côté de la vidéo (sous-titres de manim-voiceover, piste audio)."""
+    sidecars = {}
+    for kind, suffix in SIDECAR_SUFFIXES.items():
+        path = Path(video).with_suffix(suffix)
+        if path.exists():
+            sidecars[kind] = str(path)
+    return sidecars
+
+
+def discard_render(video: str) -> None:
+    """Supprime une vidéo intermédiaire et ses annexes."""
+    Path(video).unlink(missing_ok=True)
+    for path in sidecar_paths(video).values():
+        Path(path).unlink(missing_ok=True)
+
+
+def publish_render(result: Dict[str, Any], math_scene: str, concept: str = "") -> Dict[str, Any]:
+    """
+    Range la vidéo d'un rendu réussi dans le magasin d'artefacts (dédupliquée par contenu, annexes comprises)
+    et fait pointer le résultat vers la copie stockée.
+    """
+    video = result.get("video_path")
+    if not result["success"] or not video:
+        return result
+    with span("publish"):
+        # Une vidéo du dossier de travail est déplacée ; une entrée du cache de rendu est liée
+        scratch = Path(video).parent == SCRATCH_DIR
+        artifact = ARTIFACT_STORE.put(video, class_name=math_scene, concept=concept,
+                                      sidecars=result["metadata"].pop("sidecars", None) or sidecar_paths(video),
+                                      move=scratch)
+    result["video_path"] = artifact["path"]
+    result["metadata"]["artifact"] = {"hash": artifact["hash"], "sidecars": artifact["sidecars"]}
+    return result
+
+
+def is_dry_run(quality_flags: List[str]) -> bool:
+    return "--dry_run" in quality_flags
+
+
+WARM_POOL = WarmWorkerPool(MAX_CONCURRENT_RENDERS)
+atexit.register(WARM_POOL.shutdown)
+
+
+def run_manim(workspace: RenderWorkspace, quality_flags: List[str], final_video: str,
+              math_scene: str) -> Tuple[int, str, Dict[str, Any]]:
+    """Lance le rendu selon RENDER_BACKEND et retourne (code de retour, sortie d'erreur, usage)."""
+    if RENDER_BACKEND == "warm":
+        reply = WARM_POOL.render(render_job(workspace, quality_flags, final_video, math_scene), timeout=RENDER_TIMEOUT)
+        return reply["returncode"], reply["stderr"], reply["usage"]
+    manim_cmd = manim_command(workspace, quality_flags, final_video, math_scene)
+    returncode, _, stderr, usage = run_with_usage(manim_cmd, cwd=workspace.root, env=render_env(workspace))
+    return returncode, stderr, usage
+
+
+def _render_stages(workspace: RenderWorkspace, start: float, wall_seconds: float,
+                   usage: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Étapes consignées par le processus Manim, suivies du rendu complet vu depuis ce processus."""
+    return read_stage_log(workspace.stage_log) + [stage_record("manim_render", start, wall_seconds, **usage)]
+
+
+def _render_success(code: str, math_scene: str, quality_flags: List[str], final_video: str,
+                    use_cache: bool, started: float, stages: List[Dict[str, Any]]) -> Dict[str, Any]:
+    metadata = {"render_seconds": time.perf_counter() - started, "stages": stages}
+    if is_dry_run(quality_flags):
+        return {
+            "success": True,
+            "video_path": None,
+            "message": "Scène construite sans erreur (dry run)",
+            "metadata": metadata
+        }
+    metadata["sidecars"] = sidecar_paths(final_video)
+    if use_cache:
+        RENDER_CACHE.put(render_cache_key(code, math_scene, quality_flags), final_video)
+    metadata["cache"] = "miss" if use_cache else "bypass"
+    return {
+        "success": True,
+        "video_path": final_video,
+        "message": "Vidéo générée avec succès",
+        "metadata": metadata
+    }
+
+
+def _render_error(e: BaseException) -> Dict[str, Any]:
+    return {"success": False, "video_path": None, "message": f"Erreur Manim: {str(e)[:500]}", "metadata": {}}
+
+
+def render_scene(code: str, math_scene: str, quality_flags: Optional[List[str]] = None,
+                 use_cache: bool = True) -> Dict[str, Any]:
+    """Rend une scène dans un espace de travail isolé et retourne le résultat de l'outil."""
+    quality_flags = list(quality_flags or DEFAULT_QUALITY_FLAGS)
+    use_cache = use_cache and render_cache_enabled() and not is_dry_run(quality_flags)
+    if use_cache:
+        cached = lookup_cached_render(code, math_scene, quality_flags)
+        if cached is not None:
+            return cached
+
+    start, started = time.time(), time.perf_counter()
+    final_video = new_video_path(math_scene)
+    try:
+        # Narrations synthétisées en parallèle avant le lancement de Manim
+        tts_stages = [stage for stage in [presynthesize(code)] if stage is not None]
+        with render_workspace() as workspace:
+            with open(workspace.scene_file, "w", encoding="utf-8") as f:
+                f.write(SCENE_PREAMBLE + code)
+            print(f"Code écrit: {workspace.scene_file}")
+
+            returncode, stderr, usage = run_manim(workspace, quality_flags, final_video, math_scene)
+            stages = tts_stages + _render_stages(workspace, start, time.perf_counter() - started, usage)
+
+        if returncode != 0:
+            return {
+                "success": False,
+                "video_path": None,
+                "message": f"Erreur Manim: {stderr[-500:]}",
+                "metadata": {"render_seconds": time.perf_counter() - started,
+                             "stderr": stderr[-STDERR_TAIL:], "stages": stages}
+            }
+        return _render_success(code, math_scene, quality_flags, final_video, use_cache, started, stages)
+
+    except Exception as e:
+        return _render_error(e)
+
+
+def kill_process_tree(pid: int) -> None:
+    """Tue le groupe de processus de Manim (ffmpeg, latex, ... compris)."""
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+async def _pump_stream(stream: asyncio.StreamReader, lines: List[str],
+                       on_progress: Optional[Callable[[str], None]]) -> None:
+    buffer = ""
+    while True:
+        chunk = await stream.read(4096)
+        if not chunk:
+            break
+        buffer += chunk.decode("utf-8", errors="replace")
+        *complete, buffer = _LINE_SPLIT.split(buffer)
+        for line in complete:
+            if line.strip():
+                lines.append(line)
+                if on_progress is not None:
+                    on_progress(line)
+    if buffer.strip():
+        lines.append(buffer)
+        if on_progress is not None:
+            on_progress(buffer)
+
+
+async def render_scene_async(code: str, math_scene: str, quality_flags: Optional[List[str]] = None,
+                             use_cache: bool = True, timeout: Optional[float] = RENDER_TIMEOUT,
+                             on_progress: Optional[Callable[[str], None]] = None) -> Dict[str, Any]:
+    """
+    Variante asynchrone de `render_scene`, sans bloquer la boucle d'événements.
+    Les lignes de progression de Manim sont transmises à `on_progress` au fil de l'eau ;
+    en cas d'annulation ou de dépassement de `timeout`, tout l'arbre de processus est tué.
+    Avec les workers chauds, le rendu passe par le pool (délai géré par le worker, pas de progression).
+    """
+    if RENDER_BACKEND == "warm":
+        return await asyncio.wrap_future(
+            RENDER_SCHEDULER.submit(code, math_scene, quality_flags=quality_flags, use_cache=use_cache))
+    quality_flags = list(quality_flags or DEFAULT_QUALITY_FLAGS)
+    use_cache = use_cache and render_cache_enabled() and not is_dry_run(quality_flags)
+    if use_cache:
+        cached = lookup_cached_render(code, math_scene, quality_flags)
+        if cached is not None:
+            return cached
+
+    try:
+        return await _run_scene_async(code, math_scene, quality_flags, use_cache, timeout, on_progress)
+    except Exception as e:
+        # Comme `render_scene` : manim absent, écriture impossible... deviennent un résultat d'échec
+        return _render_error(e)
+
+
+async def _run_scene_async(code: str, math_scene: str, quality_flags: List[str], use_cache: bool,
+                           timeout: Optional[float], on_progress: Optional[Callable[[str], None]]) -> Dict[str, Any]:
+    start, started = time.time(), time.perf_counter()
+    final_video = new_video_path(math_scene)
+    usage: Dict[str, Any] = {}
+    # Avant de prendre une place : la synthèse (réseau) n'occupe pas une place de rendu
+    tts_stages = [stage for stage in [await asyncio.to_thread(presynthesize, code)] if stage is not None]
+    # Même limite que les rendus du pool : une place de RENDER_SCHEDULER, quelle que soit la boucle d'événements
+    async with RENDER_SCHEDULER.slot():
+        with render_workspace() as workspace:
+            with open(workspace.scene_file, "w", encoding="utf-8") as f:
+                f.write(SCENE_PREAMBLE + code)
+
+            manim_cmd = manim_command(workspace, quality_flags, final_video, math_scene)
+            process = await asyncio.create_subprocess_exec(
+                *manim_cmd,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                cwd=workspace.root,
+                env=render_env(workspace),
+                start_new_session=True,
+            )
+            stdout_lines: List[str] = []
+            stderr_lines: List[str] = []
+            sampler = asyncio.create_task(_sample_usage(process.pid, usage))
+            try:
+                await asyncio.wait_for(
+                    asyncio.gather(
+                        _pump_stream(process.stdout, stdout_lines, on_progress),
+                        _pump_stream(process.stderr, stderr_lines, on_progress),
+                        process.wait(),
+                    ),
+                    timeout=timeout,
+                )
+            except asyncio.TimeoutError:
+                kill_process_tree(process.pid)
+                await process.wait()
+                return {
+                    "success": False,
+                    "video_path": None,
+                    "message": f"Erreur Manim: rendu interrompu après {timeout:.0f}s",
+                    "metadata": {"render_seconds": time.perf_counter() - started}
+                }
+            except asyncio.CancelledError:
+                kill_process_tree(process.pid)
+                await process.wait()
+                raise
+            finally:
+                sampler.cancel()
+            stages = tts_stages + _render_stages(workspace, start, time.perf_counter() - started, usage)
+
+    if process.returncode != 0:
+        stderr = "\n".join(stderr_lines)
+        return {
+            "success": False,
+            "video_path": None,
+            "message": f"Erreur Manim: {stderr[-500:]}",
+            "metadata": {"render_seconds": time.perf_counter() - started,
+                         "stderr": stderr[-STDERR_TAIL:], "stages": stages}
+        }
+    return _render_success(code, math_scene, quality_flags, final_video, use_cache, started, stages)
+
+
+class RenderScheduler:
+    """
+    Pool borné pour les rendus Manim : au plus `max_workers` rendus tournent en parallèle, les autres attendent.
+    La limite est partagée avec les rendus asynchrones (`render_scene_async`), qui prennent une place avec `slot()`.
+    Les threads du pool pilotent un pool de processus, ou directement les workers chauds avec RENDER_BACKEND=warm.
+    """
+
+    def __init__(self, max_workers: int = MAX_CONCURRENT_RENDERS):
+        self.max_workers = max(1, max_workers)
+        self._slots = threading.BoundedSemaphore(self.max_workers)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._processes: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="render")
+            return self._executor
+
+    def _get_processes(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._processes is None:
+                # spawn : pas de fork d'un serveur multi-thread
+                self._processes = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            return self._processes
+
+    def _run(self, code: str, math_scene: str, kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        with self._slots:
+            if RENDER_BACKEND == "warm":
+                # Les rendus tournent déjà dans les workers chauds : le thread suffit à les piloter
+                return render_scene(code, math_scene, **kwargs)
+            return self._get_processes().submit(render_scene, code, math_scene, **kwargs).result()
+
+    @asynccontextmanager
+    async def slot(self):
+        """Place de rendu pour la boucle courante : l'attente ne bloque pas la boucle et s'annule sans fuite."""
+        while not self._slots.acquire(blocking=False):
+            await asyncio.sleep(SLOT_POLL_INTERVAL)
+        try:
+            yield
+        finally:
+            self._slots.release()
+
+    def submit(self, code: str, math_scene: str, **kwargs) -> Future:
+        quality_flags = list(kwargs.get("quality_flags") or DEFAULT_QUALITY_FLAGS)
+        if kwargs.get("use_cache", True) and not is_dry_run(quality_flags):
+            cached = lookup_cached_render(code, math_scene, quality_flags)
+            if cached is not None:
+                future: Future = Future()
+                future.set_result(cached)
+                return future
+        return self._get_executor().submit(self._run, code, math_scene, kwargs)
+
+    def render(self, code: str, math_scene: str, **kwargs) -> Dict[str, Any]:
+        return self.submit(code, math_scene, **kwargs).result()
+
+    def shutdown(self, wait: bool = True) -> None:
+        with self._lock:
+            executors, self._executor, self._processes = [self._executor, self._processes], None, None
+        for executor in executors:
+            if executor is not None:
+                executor.shutdown(wait=wait, cancel_futures=True)
+
+
+RENDER_SCHEDULER = RenderScheduler()
+
+
+# Threads qui orchestrent les rendus par étapes (le travail lourd reste dans le pool de processus)
+_SECTION_THREADS = ThreadPoolExecutor(max_workers=max(1, MAX_CONCURRENT_RENDERS), thread_name_prefix="sections")
+
+# Rendus finaux lancés en arrière-plan : identifiant -> {"future", "metadata", "result", "finished"}
+BACKGROUND_RENDERS: Dict[str, Dict[str, Any]] = {}
+_BACKGROUND_LOCK = threading.Lock()
+# Durée pendant laquelle le résultat d'un rendu terminé reste consultable
+BACKGROUND_RETENTION = float(os.getenv("MATHCONCEPT_BACKGROUND_RETENTION", 3600))
+# Publication des rendus d'arrière-plan (hash du fichier) hors du thread de gestion du pool
+_PUBLISH_THREADS = ThreadPoolExecutor(max_workers=1, thread_name_prefix="publish")
+
+
+def _progressive_flags(quality: str, draft: str):
+    if quality not in QUALITY_FLAGS:
+        raise ValueError(f"Qualité inconnue: {quality} (choix: {', '.join(QUALITY_FLAGS)})")
+    if draft not in DRAFT_FLAGS:
+        raise ValueError(f"Brouillon inconnu: {draft} (choix: {', '.join(DRAFT_FLAGS)})")
+    return DRAFT_FLAGS[draft], QUALITY_FLAGS[quality]
+
+
+def _draft_failed(draft_result: Dict[str, Any], metadata: Dict[str, Any]) -> Dict[str, Any]:
+    metadata["draft_seconds"] = draft_result["metadata"].get("render_seconds")
+    draft_result["metadata"] = {**draft_result["metadata"], **metadata}
+    draft_result["message"] = f"[brouillon] {draft_result['message']}"
+    return draft_result
+
+
+def _discard_draft(draft_result: Dict[str, Any]) -> None:
+    """La vidéo du brouillon -ql ne sert qu'à valider la scène (une entrée du cache de rendu est gardée)."""
+    video = draft_result.get("video_path")
+    if video and Path(video).parent == SCRATCH_DIR:
+        discard_render(video)
+
+
+def _background_pending(job_id: str, metadata: Dict[str, Any]) -> Dict[str, Any]:
+    metadata["final_job_id"] = job_id
+    metadata["final_status"] = "pending"
+    return {
+        "success": True,
+        "video_path": None,
+        "message": f"Brouillon validé, rendu final en cours (job {job_id})",
+        "metadata": metadata
+    }
+
+
+def _with_final_metadata(final_result: Dict[str, Any], metadata: Dict[str, Any]) -> Dict[str, Any]:
+    final_result = publish_render(final_result, metadata["scene"], metadata.get("concept", ""))
+    metadata["final_seconds"] = final_result["metadata"].get("render_seconds")
+    metadata["final_status"] = "done" if final_result["success"] else "failed"
+    final_result["metadata"] = {**final_result["metadata"], **metadata}
+    return final_result
+
+
+def _publish_final(final_result: Dict[str, Any], metadata: Dict[str, Any]) -> Dict[str, Any]:
+    """`_with_final_metadata` qui retourne un échec au lieu de lever si la publication échoue."""
+    try:
+        return _with_final_metadata(final_result, metadata)
+    except Exception as e:
+        metadata["final_status"] = "failed"
+        return {"success": False, "video_path": None, "message": f"Erreur de publication: {str(e)[:500]}",
+                "metadata": metadata}
+
+
+def _finish_background(job_id: str, future: Future) -> None:
+    """Publie le rendu final dès qu'il se termine, puis oublie les jobs terminés depuis plus de BACKGROUND_RETENTION."""
+    with _BACKGROUND_LOCK:
+        entry = BACKGROUND_RENDERS.get(job_id)
+    if entry is None:
+        return
+    try:
+        result = future.result()
+    except BaseException as e:
+        result = _render_error(e)
+    result = _publish_final(result, entry["metadata"])
+    now = time.monotonic()
+    with _BACKGROUND_LOCK:
+        entry["result"], entry["finished"] = result, now
+        for expired in [key for key, other in BACKGROUND_RENDERS.items()
+                        if other["finished"] is not None and now - other["finished"] > BACKGROUND_RETENTION]:
+            del BACKGROUND_RENDERS[expired]
+
+
+def _start_background(future: Future, metadata: Dict[str, Any]) -> Dict[str, Any]:
+    job_id = uuid.uuid4().hex[:12]
+    with _BACKGROUND_LOCK:
+        BACKGROUND_RENDERS[job_id] = {"future": future, "metadata": metadata, "result": None, "finished": None}
+    future.add_done_callback(lambda done: _PUBLISH_THREADS.submit(_finish_background, job_id, done))
+    return _background_pending(job_id, metadata)
+
+
+def _submit_final(code: str, math_scene: str, final_flags: List[str], use_cache: bool, sections: bool) -> Future:
+    if not sections:
+        return RENDER_SCHEDULER.submit(code, math_scene, quality_flags=final_flags, use_cache=use_cache)
+    from app.tools.sections import render_sections  # import circulaire : sections dépend de ce module
+    return _SECTION_THREADS.submit(render_sections, code, math_scene, quality_flags=final_flags, use_cache=use_cache)
+
+
+def render_progressive(code: str, math_scene: str, quality: str = "medium", draft: str = DEFAULT_DRAFT,
+                       background: bool = False, use_cache: bool = True, sections: bool = False,
+                       concept: str = "") -> Dict[str, Any]:
+    """
+    Rendu en deux passes : un brouillon rapide (-ql ou --dry_run), puis le rendu final
+    dans la qualité demandée seulement si le brouillon a réussi.
+    Avec background=True, le rendu final tourne dans le pool et le résultat est suivi
+    via `background_render_status`. Avec sections=True, le rendu final est fait étape par étape
+    en parallèle (voir app.tools.sections).
+    La vidéo finale est publiée dans le magasin d'artefacts, indexée par classe et `concept`.
+    """
+    draft_flags, final_flags = _progressive_flags(quality, draft)
+    metadata: Dict[str, Any] = {"quality": quality, "draft": draft, "scene": math_scene, "concept": concept}
+
+    if draft_flags is not None and lookup_cached_render(code, math_scene, final_flags) is None:
+        draft_result = RENDER_SCHEDULER.render(code, math_scene, quality_flags=draft_flags, use_cache=use_cache)
+        if not draft_result["success"]:
+            return _draft_failed(draft_result, metadata)
+        metadata["draft_seconds"] = draft_result["metadata"].get("render_seconds")
+        metadata["draft_stages"] = draft_result["metadata"].get("stages", [])
+        _discard_draft(draft_result)
+
+    future = _submit_final(code, math_scene, final_flags, use_cache, sections)
+    if background and not future.done():
+        return _start_background(future, metadata)
+    try:
+        final_result = future.result()
+    except Exception as e:
+        final_result = _render_error(e)
+    return _publish_final(final_result, metadata)
+
+
+async def render_progressive_async(code: str, math_scene: str, quality: str = "medium",
+                                   draft: str = DEFAULT_DRAFT, background: bool = False,
+                                   use_cache: bool = True, sections: bool = False, concept: str = "",
+                                   on_progress: Optional[Callable[[str], None]] = None) -> Dict[str, Any]:
+    """Variante asynchrone de `render_progressive`."""
+    draft_flags, final_flags = _progressive_flags(quality, draft)
+    metadata: Dict[str, Any] = {"quality": quality, "draft": draft, "scene": math_scene, "concept": concept}
+
+    if draft_flags is not None and lookup_cached_render(code, math_scene, final_flags) is None:
+        draft_result = await render_scene_async(code, math_scene, quality_flags=draft_flags,
+                                                use_cache=use_cache, on_progress=on_progress)
+        if not draft_result["success"]:
+            return _draft_failed(draft_result, metadata)
+        metadata["draft_seconds"] = draft_result["metadata"].get("render_seconds")
+        metadata["draft_stages"] = draft_result["metadata"].get("stages", [])
+        _discard_draft(draft_result)
+
+    # Comme en synchrone, une erreur devient un résultat d'échec : levée, elle ferait échouer tout le graphe
+    try:
+        if background:
+            # Le rendu final doit survivre à la boucle de la requête : il part dans le pool, pas dans une Task
+            future = _submit_final(code, math_scene, final_flags, use_cache, sections)
+            if not future.done():
+                return _start_background(future, metadata)
+            final_result = future.result()
+        elif sections:
+            from app.tools.sections import render_sections  # import circulaire : sections dépend de ce module
+            final_result = await asyncio.to_thread(render_sections, code, math_scene, quality_flags=final_flags,
+                                                   use_cache=use_cache)
+        else:
+            final_result = await render_scene_async(code, math_scene, quality_flags=final_flags,
+                                                    use_cache=use_cache, on_progress=on_progress)
+    except Exception as e:
+        final_result = _render_error(e)
+    # Publication (hash du fichier) hors de la boucle d'événements
+    return await asyncio.to_thread(_publish_final, final_result, metadata)
+
+
+def background_render_status(job_id: str) -> Dict[str, Any]:
+    """
+    État d'un rendu final lancé en arrière-plan. Le résultat, publié dès la fin du rendu,
+    reste consultable pendant BACKGROUND_RETENTION secondes.
+    """
+    with _BACKGROUND_LOCK:
+        entry = BACKGROUND_RENDERS.get(job_id)
+    if entry is None:
+        return {"success": False, "video_path": None, "message": f"Job inconnu: {job_id}", "metadata": {}}
+    if entry["result"] is None:
+        return {"success": True, "video_path": None, "message": "Rendu final en cours", "metadata": entry["metadata"]}
+    return entry["result"]
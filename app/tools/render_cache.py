@@ -0,0 +1,40 @@
+import os
+from importlib import metadata
+from typing import List
+
+from app.tools.speech import narration_voice
+from app.tools.voiceover import TTS_BACKEND_ENV
+from app.utils.cache import FileCache, hash_key
+
+# Cache des vidéos déjà rendues, indexé par le contenu de la scène
+RENDER_CACHE = FileCache(
+    "renders",
+    suffix=".mp4",
+    max_bytes=int(os.getenv("MATHCONCEPT_RENDER_CACHE_MAX_BYTES", 5 * 1024**3)),
+    max_age=float(os.getenv("MATHCONCEPT_RENDER_CACHE_MAX_AGE", 30 * 24 * 3600)),
+)
+
+
+def render_cache_enabled() -> bool:
+    """Le cache peut être désactivé globalement avec MATHCONCEPT_RENDER_CACHE=0."""
+    return os.getenv("MATHCONCEPT_RENDER_CACHE", "1") not in ("0", "false", "False")
+
+
+def package_version(name: str) -> str:
+    try:
+        return metadata.version(name)
+    except metadata.PackageNotFoundError:
+        return "unknown"
+
+
+def render_cache_key(code: str, class_name: str, flags: List[str]) -> str:
+    """Clé du rendu : source de la scène, classe, options de qualité, moteur TTS et voix, versions de Manim."""
+    return hash_key(
+        code,
+        class_name,
+        " ".join(flags),
+        os.environ.get(TTS_BACKEND_ENV, ""),
+        narration_voice(code),
+        package_version("manim"),
+        package_version("manim-voiceover"),
+    )
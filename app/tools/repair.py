@@ -0,0 +1,285 @@
+import re
+import textwrap
+from typing import Dict, Any, List, Optional
+
+from langchain_core.prompts import ChatPromptTemplate
+
+from app.tools.sections import split_steps
+from app.tools.validation import extract_tex_strings
+from app.tools.voiceover import PREAMBLE_LINES
+from app.utils.llm import cached_invoke, get_chat_model
+
+REPAIR_MODEL = "meta/llama-3.1-70b-instruct"
+
+# Frame de la scène dans une trace Python classique ou dans la trace "rich" affichée par Manim
+_SCENE_FRAME = re.compile(r'File "[^"]*?scene_[0-9a-f]{12}\.py", line (\d+)|scene_[0-9a-f]{12}\.py:(\d+)')
+_EXCEPTION_LINE = re.compile(r"^[\s│|]*(\w+(?:Error|Exception))\s*:\s*(.*?)[\s│|]*$", re.MULTILINE)
+_LATEX_ERROR = re.compile(r"LaTeX compilation error:\s*(.*)")
+# Diagnostic ajouté par execute_manim_with_audio au message d'erreur
+_DIAGNOSTIC = re.compile(r"\[Diagnostic\] Étape (\d+|\?), ligne (\d+|\?)")
+
+# API ManimGL / anciennes versions encore produites par les LLM -> équivalent ManimCE
+DEPRECATED_NAMES = {
+    "ShowCreation": "Create",
+    "TextMobject": "Tex",
+    "TexMobject": "MathTex",
+    "get_graph": "plot",
+}
+
+
+def fix_raw_latex(code: str) -> str:
+    """Transforme les chaînes MathTex / Tex non brutes contenant des backslashs en chaînes r"..."."""
+    try:
+        strings = extract_tex_strings(code)
+    except SyntaxError:
+        return code
+    lines = code.splitlines()
+    for entry in strings:
+        source = entry["source"]
+        prefix = re.match(r"[A-Za-z]*", source).group()
+        body = source[len(prefix):]
+        if entry["raw"] or "\\" not in body or "\n" in source or '\\"' in body or "\\'" in body:
+            continue
+        # "\\frac" valait \frac : en chaîne brute, un seul backslash suffit
+        raw_source = "r" + body.replace("\\\\", "\\")
+        lines[entry["line"] - 1] = lines[entry["line"] - 1].replace(source, raw_source, 1)
+    return "\n".join(lines)
+
+
+def fix_deprecated_names(code: str) -> str:
+    for old, new in DEPRECATED_NAMES.items():
+        code = re.sub(rf"\b{old}\b", new, code)
+    return code
+
+
+# Base locale d'erreurs connues, consultée avant toute recherche web ou appel au LLM
+KNOWN_FIXES = [
+    {
+        "name": "raw_latex",
+        "pattern": r"invalid escape sequence|latex error converting to dvi|LaTeX compilation error|non_raw_latex"
+                   r"|Chaîne LaTeX non brute",
+        "hint": "Écrire toutes les chaînes MathTex/Tex en chaînes brutes r\"...\" (\\frac, \\lim, \\to ...).",
+        "fix": fix_raw_latex,
+    },
+    {
+        "name": "deprecated_names",
+        "pattern": r"name '(?:%s)' is not defined|has no attribute 'get_graph'" % "|".join(DEPRECATED_NAMES),
+        "hint": "Utiliser l'API ManimCE : Create, Tex, MathTex, axes.plot.",
+        "fix": fix_deprecated_names,
+    },
+    {
+        "name": "undefined_control_sequence",
+        "pattern": r"Undefined control sequence",
+        "hint": "Commande LaTeX inexistante : n'utiliser que les commandes de amsmath / amssymb.",
+        "fix": None,
+    },
+    {
+        "name": "missing_dollar",
+        "pattern": r"Missing \$ inserted",
+        "hint": "Formule mathématique dans Tex : utiliser MathTex ou entourer la formule de $...$.",
+        "fix": None,
+    },
+    {
+        "name": "unexpected_keyword",
+        "pattern": r"unexpected keyword argument '\w+'",
+        "hint": "Retirer l'argument nommé inconnu ou utiliser celui de la signature ManimCE.",
+        "fix": None,
+    },
+    {
+        "name": "name_error",
+        "pattern": r"NameError: name '\w+' is not defined",
+        "hint": "Définir l'objet dans l'étape qui l'utilise : chaque étape repart d'une scène vide.",
+        "fix": None,
+    },
+    {
+        "name": "missing_class",
+        "pattern": r"missing_class|n'est pas définie dans le code",
+        "hint": "Passer à execute_manim_with_audio le nom de la classe réellement définie dans le code.",
+        "fix": None,
+    },
+    {
+        "name": "tts_network",
+        "pattern": r"gTTSError|Failed to connect|Max retries exceeded|ConnectionError",
+        "hint": "Erreur réseau du service de voix : relancer le rendu sans modifier le code.",
+        "fix": None,
+    },
+]
+
+
+def known_fixes_for(error: str) -> List[Dict[str, Any]]:
+    return [entry for entry in KNOWN_FIXES if re.search(entry["pattern"], error)]
+
+
+def known_fix_hints(error: str) -> List[str]:
+    return [entry["hint"] for entry in known_fixes_for(error)]
+
+
+def parse_manim_error(stderr: str, code: Optional[str] = None, class_name: Optional[str] = None,
+                      section_step: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Extrait d'une sortie d'erreur de Manim le type d'exception, son message, la ligne fautive
+    dans le code généré (préambule déduit) et l'étape correspondante.
+    `section_step` indique que la trace vient du rendu isolé de cette étape.
+    """
+    error: Dict[str, Any] = {"type": None, "message": stderr.strip()[-300:], "line": None, "step": section_step}
+
+    frames = list(_SCENE_FRAME.finditer(stderr))
+    if frames:
+        last = frames[-1]
+        error["line"] = int(last.group(1) or last.group(2)) - PREAMBLE_LINES
+
+    exceptions = list(_EXCEPTION_LINE.finditer(stderr))
+    if exceptions:
+        error["type"], error["message"] = exceptions[-1].group(1), exceptions[-1].group(2)
+    latex = _LATEX_ERROR.search(stderr)
+    if latex:
+        error["type"] = "LaTeXError"
+        error["message"] = latex.group(1).strip()
+
+    split = split_steps(code, class_name) if code and class_name else None
+    if split is not None and error["line"] is not None:
+        if section_step is not None:
+            index = next((i for i, step in enumerate(split.steps) if step.number == section_step), None)
+            if index is not None:
+                error["line"] = split.code_line(index, error["line"])
+        step = split.step_at(error["line"])
+        if step is not None:
+            error["step"] = step.number
+    return error
+
+
+def describe_failure(code: str, class_name: str, result: Dict[str, Any]) -> Dict[str, Any]:
+    """Diagnostic structuré d'un échec de execute_manim_with_audio (validation ou rendu)."""
+    metadata = result.get("metadata", {})
+    validation_errors = [issue for issue in metadata.get("validation_errors", []) if issue["severity"] == "error"]
+    if validation_errors:
+        issue = validation_errors[0]
+        error = {"type": issue["kind"], "message": issue["message"], "line": issue["line"], "step": None}
+        split = split_steps(code, class_name)
+        if split is not None and issue["line"] is not None:
+            step = split.step_at(issue["line"])
+            error["step"] = step.number if step else None
+    else:
+        error = parse_manim_error(metadata.get("stderr") or result.get("message", ""), code, class_name,
+                                  section_step=metadata.get("failed_step"))
+    error["hints"] = known_fix_hints(f"{error['type']}: {error['message']}")
+    return error
+
+
+def format_diagnostic(error: Dict[str, Any]) -> str:
+    step = error.get("step") or "?"
+    line = error.get("line") or "?"
+    return f"[Diagnostic] Étape {step}, ligne {line} : {error.get('type')}: {error.get('message')}"
+
+
+REPAIR_STEP_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", """
+            Vous corrigez UNE étape d'une scène Manim (manim-voiceover) dont le rendu a échoué.
+            - Modifiez le minimum nécessaire pour corriger l'erreur
+            - Conservez la structure : commentaire "# Étape N", bloc self.voiceover, nettoyage final
+            - Toutes les chaînes MathTex / Tex sont des chaînes brutes r"..."
+            - L'étape ne peut utiliser que les objets qu'elle crée elle-même
+
+            FORMAT DE SORTIE :
+            ===STEP===
+            [code corrigé de l'étape, avec la même indentation]
+            ===END===
+            """),
+    ("user", """Classe : {class_name}
+
+Début de construct() (commun à toutes les étapes) :
+{prefix}
+
+Étape en erreur :
+{step}
+
+Erreur :
+{error}
+
+Indices :
+{hints}"""),
+])
+
+REPAIR_CODE_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", """
+            Vous corrigez une scène Manim (manim-voiceover) dont le rendu a échoué.
+            Modifiez le minimum nécessaire pour corriger l'erreur et gardez le même nom de classe.
+
+            FORMAT DE SORTIE :
+            ===CODE===
+            [code Python complet]
+            ===CLASS_NAME===
+            [Nom de classe]
+            """),
+    ("user", "Code :\n{code}\n\nErreur :\n{error}\n\nIndices :\n{hints}"),
+])
+
+
+def _reindent(block: str, like: List[str]) -> List[str]:
+    """Ré-indente un bloc renvoyé par le LLM comme l'étape d'origine."""
+    reference = next((line for line in like if line.strip()), "")
+    indent = reference[:len(reference) - len(reference.lstrip())]
+    return textwrap.indent(textwrap.dedent(block).strip("\n"), indent).splitlines()
+
+
+def _strip_fences(text: str) -> str:
+    return re.sub(r"^\s*```(?:python)?\s*|\s*```\s*$", "", text)
+
+
+def repair_scene(code: str, class_name: str, error: str) -> Dict[str, Any]:
+    """
+    Répare une scène à partir de son erreur, du moins cher au plus cher :
+    1. corrections automatiques de la base d'erreurs connues
+    2. correctif LLM de la seule étape fautive
+    3. correctif LLM du code complet si l'étape n'a pas pu être identifiée
+    """
+    diagnostic = _DIAGNOSTIC.search(error)
+    if diagnostic:
+        parsed = {
+            "step": int(diagnostic.group(1)) if diagnostic.group(1).isdigit() else None,
+            "line": int(diagnostic.group(2)) if diagnostic.group(2).isdigit() else None,
+        }
+    else:
+        parsed = parse_manim_error(error, code, class_name)
+    hints = known_fix_hints(error)
+
+    fixed, applied = code, []
+    for entry in known_fixes_for(error):
+        if entry["fix"] is not None:
+            patched = entry["fix"](fixed)
+            if patched != fixed:
+                fixed = patched
+                applied.append(entry["name"])
+    if applied:
+        return {"code": fixed, "class_name": class_name, "strategy": "knowledge_base",
+                "fixes": applied, "step": parsed.get("step"), "hints": hints}
+
+    llm = get_chat_model(REPAIR_MODEL)
+    split = split_steps(code, class_name)
+    index = None
+    if split is not None and parsed.get("step") is not None:
+        index = next((i for i, step in enumerate(split.steps) if step.number == parsed["step"]), None)
+
+    if index is not None:
+        messages = REPAIR_STEP_PROMPT.format_messages(
+            class_name=class_name,
+            prefix="\n".join(split.prefix),
+            step=split.steps[index].source,
+            error=error[-2000:],
+            hints="\n".join(hints) or "aucun",
+        )
+        content = cached_invoke(llm, messages, use_cache=False)
+        match = re.search(r"===STEP===\s*\n(.*?)\s*===END===", content, re.DOTALL)
+        if match:
+            lines = _reindent(_strip_fences(match.group(1)), split.steps[index].lines)
+            return {"code": split.with_step(index, lines), "class_name": class_name, "strategy": "step_patch",
+                    "fixes": [], "step": split.steps[index].number, "hints": hints}
+
+    messages = REPAIR_CODE_PROMPT.format_messages(code=code, error=error[-2000:], hints="\n".join(hints) or "aucun")
+    content = cached_invoke(llm, messages, use_cache=False)
+    match = re.search(r"===CODE===\s*(.*?)\s*===CLASS_NAME===\s*(\w+)", content, re.DOTALL)
+    if match:
+        return {"code": _strip_fences(match.group(1)), "class_name": match.group(2), "strategy": "full_patch",
+                "fixes": [], "step": parsed.get("step"), "hints": hints}
+    return {"code": code, "class_name": class_name, "strategy": "none", "fixes": [],
+            "step": parsed.get("step"), "hints": hints}
@@ -1,5 +1,6 @@
 from langchain_community.tools import DuckDuckGoSearchRun
 from langchain_core.tools import tool
+from app.tools.repair import known_fix_hints
 
 @tool
 def search_solution(query: str):
@@ -7,5 +8,9 @@ def search_solution(query: str):
     Utilise cet outil quand l'exécution de Manim échoue pour trouver comment corriger le code.
     Pas besoin de clé API.
     """
+    # La base locale d'erreurs connues évite un aller-retour réseau
+    hints = known_fix_hints(query)
+    if hints:
+        return "\n".join(hints)
     search = DuckDuckGoSearchRun()
     return search.run(query)
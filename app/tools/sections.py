@@ -0,0 +1,253 @@
+import os
+import re
+import ast
+import time
+import shutil
+import tempfile
+import warnings
+import textwrap
+from subprocess import run
+from typing import Dict, Any, List, Optional, Set
+
+from app.tools.render_cache import RENDER_CACHE, render_cache_enabled, render_cache_key
+from app.tools.render import (
+    DEFAULT_QUALITY_FLAGS,
+    RENDER_SCHEDULER,
+    SCRATCH_DIR,
+    discard_render,
+    new_video_path,
+)
+from app.utils.tracing import stage_record
+
+FFMPEG_BIN = shutil.which("ffmpeg")
+
+# Marqueurs d'étape imposés par le prompt de generate_manim_script
+STEP_PATTERN = re.compile(r"^\s*#\s*[ÉEée]tape\s+(\d+)", re.IGNORECASE)
+
+
+class SceneStep:
+    """Une étape `# Étape N` de la méthode construct, avec ses lignes (numérotées à partir de 1)."""
+
+    def __init__(self, number: int, start: int, end: int, lines: List[str]):
+        self.number = number
+        self.start = start
+        self.end = end
+        self.lines = lines
+
+    @property
+    def source(self) -> str:
+        return "\n".join(self.lines)
+
+
+class SplitScene:
+    """Scène découpée : en-tête jusqu'au corps de construct, préambule commun, étapes et fin du module."""
+
+    def __init__(self, head: List[str], prefix: List[str], steps: List[SceneStep], tail: List[str]):
+        self.head = head
+        self.prefix = prefix
+        self.steps = steps
+        self.tail = tail
+
+    def section_code(self, index: int) -> str:
+        """Code d'une scène autonome ne contenant que le préambule et l'étape `index`."""
+        return "\n".join(self.head + self.prefix + self.steps[index].lines + self.tail)
+
+    def code_line(self, index: int, section_line: int) -> int:
+        """Convertit un numéro de ligne de `section_code(index)` en numéro de ligne du code complet."""
+        shared = len(self.head) + len(self.prefix)
+        if section_line <= shared:
+            return section_line
+        return section_line - shared + self.steps[index].start - 1
+
+    def step_at(self, line: int) -> Optional[SceneStep]:
+        """Étape contenant la ligne `line` du code complet (None pour l'en-tête et le préambule)."""
+        for step in self.steps:
+            if step.start <= line <= step.end:
+                return step
+        return None
+
+    def with_step(self, index: int, lines: List[str]) -> str:
+        """Code complet de la scène avec l'étape `index` remplacée."""
+        body = []
+        for i, step in enumerate(self.steps):
+            body.extend(lines if i == index else step.lines)
+        return "\n".join(self.head + self.prefix + body + self.tail)
+
+
+def _parse(code: str) -> ast.Module:
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", SyntaxWarning)
+        return ast.parse(code)
+
+
+def _find_construct(tree: ast.Module, class_name: str) -> Optional[ast.FunctionDef]:
+    for node in ast.walk(tree):
+        if isinstance(node, ast.ClassDef) and node.name == class_name:
+            for item in node.body:
+                if isinstance(item, ast.FunctionDef) and item.name == "construct":
+                    return item
+    return None
+
+
+def _names(source: str) -> Dict[str, Set[str]]:
+    """Noms (et attributs de self) affectés et lus par un bloc de code."""
+    tree = _parse(textwrap.dedent(source) or "pass")
+    stored, loaded = set(), set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            (stored if isinstance(node.ctx, ast.Store) else loaded).add(node.id)
+        elif isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id == "self":
+            (stored if isinstance(node.ctx, ast.Store) else loaded).add(f"self.{node.attr}")
+    return {"stored": stored, "loaded": loaded}
+
+
+def split_steps(code: str, class_name: str) -> Optional[SplitScene]:
+    """
+    Découpe construct() sur les commentaires `# Étape N`.
+    Retourne None si la scène ne se découpe pas proprement : moins de deux étapes,
+    marqueur au milieu d'une instruction, ou étape qui réutilise un objet créé par une étape précédente.
+    """
+    try:
+        tree = _parse(code)
+    except SyntaxError:
+        return None
+    construct = _find_construct(tree, class_name)
+    if construct is None or not construct.body:
+        return None
+
+    lines = code.splitlines()
+    markers = [
+        (lineno, int(match.group(1)))
+        for lineno in range(construct.body[0].lineno, construct.end_lineno + 1)
+        if (match := STEP_PATTERN.match(lines[lineno - 1]))
+    ]
+    # Un marqueur avant la première instruction (pas de préambule) est aussi accepté
+    for lineno in range(construct.lineno + 1, construct.body[0].lineno):
+        match = STEP_PATTERN.match(lines[lineno - 1])
+        if match:
+            markers.insert(0, (lineno, int(match.group(1))))
+    if len(markers) < 2:
+        return None
+
+    for lineno, _ in markers:
+        if any(stmt.lineno <= lineno <= stmt.end_lineno for stmt in construct.body):
+            return None
+
+    first_line = min(construct.body[0].lineno, markers[0][0])
+    head = lines[:first_line - 1]
+    prefix = lines[first_line - 1:markers[0][0] - 1]
+    tail = lines[construct.end_lineno:]
+    bounds = [lineno for lineno, _ in markers] + [construct.end_lineno + 1]
+    steps = [
+        SceneStep(number, bounds[i], bounds[i + 1] - 1, lines[bounds[i] - 1:bounds[i + 1] - 1])
+        for i, (_, number) in enumerate(markers)
+    ]
+
+    prefix_names = _names("\n".join(prefix))["stored"]
+    created: Set[str] = set()
+    for step in steps:
+        names = _names(step.source)
+        if (names["loaded"] - names["stored"] - prefix_names) & created:
+            return None
+        created |= names["stored"]
+    return SplitScene(head, prefix, steps, tail)
+
+
+def _concat_videos(videos: List[str], output: str) -> bool:
+    """Concatène sans réencodage (demuxer concat de ffmpeg, -c copy)."""
+    with tempfile.TemporaryDirectory(prefix="mathconcept_concat_") as tmp_dir:
+        list_file = os.path.join(tmp_dir, "sections.txt")
+        with open(list_file, "w", encoding="utf-8") as f:
+            for video in videos:
+                escaped = video.replace("'", "'\\''")
+                f.write(f"file '{escaped}'\n")
+        result = run([FFMPEG_BIN, "-y", "-loglevel", "error", "-f", "concat", "-safe", "0",
+                      "-i", list_file, "-c", "copy", output], capture_output=True, text=True)
+    return result.returncode == 0
+
+
+def render_sections(code: str, math_scene: str, quality_flags: Optional[List[str]] = None,
+                    use_cache: bool = True) -> Dict[str, Any]:
+    """
+    Rend chaque étape comme une scène indépendante en parallèle dans le pool de rendus,
+    puis assemble les vidéos partielles (image + son) avec ffmpeg.
+    Chaque section passe par le cache de rendu : une étape inchangée entre deux essais n'est pas re-rendue.
+    Si la scène ne se découpe pas ou que l'assemblage échoue, on revient à un rendu complet.
+    """
+    quality_flags = list(quality_flags or DEFAULT_QUALITY_FLAGS)
+    split = split_steps(code, math_scene)
+    # Une étape sans voix-off n'aurait pas de piste audio : la concaténation sans réencodage échouerait
+    if (split is None or FFMPEG_BIN is None or "--dry_run" in quality_flags
+            or any("self.voiceover(" not in step.source for step in split.steps)):
+        return RENDER_SCHEDULER.render(code, math_scene, quality_flags=quality_flags, use_cache=use_cache)
+
+    use_cache = use_cache and render_cache_enabled()
+    full_key = render_cache_key(code, math_scene, quality_flags + ["--sections"])
+    if use_cache:
+        cached_video = RENDER_CACHE.get(full_key)
+        if cached_video is not None:
+            return {
+                "success": True,
+                "video_path": str(cached_video),
+                "message": "Vidéo récupérée depuis le cache",
+                # Même forme qu'après un rendu : une entrée par étape
+                "metadata": {"cache": "hit", "sections": [{"step": step.number, "cache": "hit", "render_seconds": None}
+                                                          for step in split.steps]}
+            }
+
+    started = time.perf_counter()
+    futures = [
+        RENDER_SCHEDULER.submit(split.section_code(i), math_scene, quality_flags=quality_flags, use_cache=use_cache)
+        for i in range(len(split.steps))
+    ]
+    results = [future.result() for future in futures]
+    section_metadata = [
+        {"step": step.number, "cache": result["metadata"].get("cache"),
+         "render_seconds": result["metadata"].get("render_seconds")}
+        for step, result in zip(split.steps, results)
+    ]
+    stages = [
+        {**stage, "step": step.number}
+        for step, result in zip(split.steps, results)
+        for stage in result["metadata"].get("stages", [])
+    ]
+
+    try:
+        for step, result in zip(split.steps, results):
+            if not result["success"]:
+                return {
+                    "success": False,
+                    "video_path": None,
+                    "message": f"[Étape {step.number}] {result['message']}",
+                    "metadata": {"failed_step": step.number, "sections": section_metadata,
+                                 "stderr": result["metadata"].get("stderr", ""), "stages": stages}
+                }
+
+        final_video = new_video_path(math_scene)
+        concat_start, concat_started = time.time(), time.perf_counter()
+        concatenated = _concat_videos([result["video_path"] for result in results], final_video)
+        stages.append(stage_record("ffmpeg_concat", concat_start, time.perf_counter() - concat_started))
+        if not concatenated:
+            discard_render(final_video)
+            # Repli dans le pool de rendus : il reste soumis à la limite de rendus simultanés
+            return RENDER_SCHEDULER.render(code, math_scene, quality_flags=quality_flags, use_cache=use_cache)
+    finally:
+        # Les vidéos partielles hors cache ne servent plus une fois assemblées
+        for result in results:
+            video = result.get("video_path")
+            if video and os.path.dirname(video) == str(SCRATCH_DIR):
+                discard_render(video)
+
+    if use_cache:
+        RENDER_CACHE.put(full_key, final_video)
+    return {
+        "success": True,
+        "video_path": final_video,
+        "message": "Vidéo générée avec succès",
+        "metadata": {
+            "cache": "miss" if use_cache else "bypass",
+            "sections": section_metadata,
+            "render_seconds": time.perf_counter() - started,
+            "stages": stages,
+        }
+    }
@@ -0,0 +1,283 @@
+import io
+import os
+import re
+import ast
+import time
+import shutil
+import asyncio
+import warnings
+import subprocess
+from abc import ABC, abstractmethod
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Tuple
+
+from app.tools.voiceover import AUDIO_CACHE, STUB_SECONDS_PER_CHAR, TTS_BACKEND_ENV, normalize_text, speech_cache_key
+from app.utils.tracing import stage_record
+
+# Synthèses lancées en parallèle avant le rendu (appels réseau ou processus espeak-ng)
+TTS_CONCURRENCY = int(os.getenv("MATHCONCEPT_TTS_CONCURRENCY", 8))
+
+# Service manim-voiceover instancié par la scène -> moteur utilisé par défaut
+NATIVE_BACKENDS = {"GTTSService": "gtts"}
+
+FFMPEG_BIN = shutil.which("ffmpeg")
+ESPEAK_BIN = shutil.which("espeak-ng") or shutil.which("espeak")
+
+_BOOKMARK = re.compile(r"<bookmark\s[^>]*/>")
+
+
+def speech_text(text: str) -> str:
+    """Texte réellement synthétisé par manim-voiceover : sans balises <bookmark/>, espaces normalisés."""
+    return normalize_text(_BOOKMARK.sub("", text))
+
+
+def encode_mp3(data: bytes, input_format: str) -> bytes:
+    """Compresse un flux audio en mp3, de la mémoire vers la mémoire (ffmpeg via des pipes)."""
+    if FFMPEG_BIN is None:
+        raise RuntimeError("ffmpeg introuvable : impossible d'encoder l'audio en mp3")
+    result = subprocess.run([FFMPEG_BIN, "-loglevel", "error", "-f", input_format, "-i", "pipe:0",
+                             "-f", "mp3", "-q:a", "4", "pipe:1"], input=data, capture_output=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg: {result.stderr.decode('utf-8', errors='replace')[-300:]}")
+    return result.stdout
+
+
+class SpeechBackend(ABC):
+    """
+    Moteur de synthèse : `voice` réduit les options du service de la scène (lang, tld, voice...)
+    à un identifiant de voix, `synthesize` retourne le mp3 en mémoire.
+    """
+
+    name = "unknown"
+
+    def voice(self, options: Dict[str, Any]) -> str:
+        return str(options.get("lang", "fr"))
+
+    @abstractmethod
+    def synthesize(self, text: str, voice: str) -> bytes:
+        ...
+
+
+class GTTSBackend(SpeechBackend):
+    """Google Translate TTS (réseau)."""
+
+    name = "gtts"
+
+    def voice(self, options: Dict[str, Any]) -> str:
+        return f"{options.get('lang', 'fr')}|{options.get('tld', 'com')}"
+
+    def synthesize(self, text: str, voice: str) -> bytes:
+        from gtts import gTTS
+
+        lang, tld = voice.split("|")
+        buffer = io.BytesIO()
+        gTTS(text=text, lang=lang, tld=tld).write_to_fp(buffer)
+        return buffer.getvalue()
+
+
+class EdgeBackend(SpeechBackend):
+    """Voix neuronales Microsoft Edge (réseau, sans clé), via edge-tts."""
+
+    name = "edge"
+    DEFAULT_VOICES = {"fr": "fr-FR-DeniseNeural", "en": "en-US-AriaNeural"}
+
+    def voice(self, options: Dict[str, Any]) -> str:
+        lang = str(options.get("lang", "fr"))
+        return str(options.get("voice") or self.DEFAULT_VOICES.get(lang.split("-")[0], self.DEFAULT_VOICES["fr"]))
+
+    def synthesize(self, text: str, voice: str) -> bytes:
+        import edge_tts
+
+        async def collect() -> bytes:
+            chunks = []
+            async for chunk in edge_tts.Communicate(text, voice).stream():
+                if chunk["type"] == "audio":
+                    chunks.append(chunk["data"])
+            return b"".join(chunks)
+
+        return asyncio.run(collect())
+
+
+class EspeakBackend(SpeechBackend):
+    """espeak-ng en local : hors ligne, utilisable sur les nœuds de rendu sans accès réseau."""
+
+    name = "espeak"
+
+    def voice(self, options: Dict[str, Any]) -> str:
+        speed = float(options.get("global_speed", 1.0))
+        return f"{options.get('lang', 'fr')}|{int(175 * speed)}"
+
+    def synthesize(self, text: str, voice: str) -> bytes:
+        if ESPEAK_BIN is None:
+            raise RuntimeError("espeak-ng introuvable (MATHCONCEPT_TTS_BACKEND=espeak)")
+        lang, words_per_minute = voice.split("|")
+        result = subprocess.run([ESPEAK_BIN, "-v", lang, "-s", words_per_minute, "--stdout", text],
+                                capture_output=True)
+        if result.returncode != 0:
+            raise RuntimeError(f"espeak-ng: {result.stderr.decode('utf-8', errors='replace')[-300:]}")
+        return encode_mp3(result.stdout, "wav")
+
+
+class StubBackend(SpeechBackend):
+    """Silence dont la durée suit la longueur du texte (benchmarks, hors ligne)."""
+
+    name = "stub"
+
+    def voice(self, options: Dict[str, Any]) -> str:
+        return "silence"
+
+    def synthesize(self, text: str, voice: str) -> bytes:
+        from pydub import AudioSegment
+
+        duration_ms = int(len(text) * STUB_SECONDS_PER_CHAR * 1000)
+        buffer = io.BytesIO()
+        AudioSegment.silent(duration=max(duration_ms, 500)).export(buffer, format="mp3")
+        return buffer.getvalue()
+
+
+SPEECH_BACKENDS = {backend.name: backend for backend in (GTTSBackend(), EdgeBackend(), EspeakBackend(), StubBackend())}
+
+
+def resolve_backend(service_class: str) -> Optional[SpeechBackend]:
+    """Moteur imposé par MATHCONCEPT_TTS_BACKEND, sinon celui du service de la scène (None : service d'origine)."""
+    name = os.environ.get(TTS_BACKEND_ENV) or NATIVE_BACKENDS.get(service_class)
+    if not name:
+        return None
+    if name not in SPEECH_BACKENDS:
+        raise ValueError(f"Moteur TTS inconnu: {name} (choix: {', '.join(SPEECH_BACKENDS)})")
+    return SPEECH_BACKENDS[name]
+
+
+def synthesize_cached(backend: SpeechBackend, voice: str, text: str) -> Tuple[Path, bool]:
+    """Retourne (fichier du cache audio, True si déjà présent), en synthétisant au besoin."""
+    key = speech_cache_key(backend.name, voice, text)
+    cached_audio = AUDIO_CACHE.get(key)
+    if cached_audio is not None:
+        return cached_audio, True
+    return AUDIO_CACHE.put_bytes(key, backend.synthesize(text, voice)), False
+
+
+def _literal_kwargs(call: ast.Call) -> Dict[str, Any]:
+    options = {}
+    for keyword in call.keywords:
+        try:
+            options[keyword.arg] = ast.literal_eval(keyword.value)
+        except ValueError:
+            continue
+    return options
+
+
+def _scene_speech(code: str) -> Tuple[Optional[str], Dict[str, Any], List[str]]:
+    """(service, options, textes) lus dans le code sans l'exécuter : `set_speech_service(...)` et `voiceover(...)`."""
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", SyntaxWarning)
+            tree = ast.parse(code)
+    except SyntaxError:
+        return None, {}, []
+    service, options = None, {}
+    texts = []
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Call) or not isinstance(node.func, ast.Attribute):
+            continue
+        if node.func.attr == "set_speech_service" and node.args and isinstance(node.args[0], ast.Call):
+            constructor = node.args[0].func
+            service = constructor.id if isinstance(constructor, ast.Name) else getattr(constructor, "attr", None)
+            options = _literal_kwargs(node.args[0])
+        elif node.func.attr == "voiceover":
+            text = next((kw.value for kw in node.keywords if kw.arg == "text"), node.args[0] if node.args else None)
+            if isinstance(text, ast.Constant) and isinstance(text.value, str):
+                texts.append(text.value)
+    return service, options, texts
+
+
+def voiceover_segments(code: str) -> List[Tuple[str, Dict[str, Any], str]]:
+    """
+    (service, options, texte) de chaque `self.voiceover(text=...)` à texte littéral, lus dans le code sans l'exécuter.
+    Le service est celui du `set_speech_service(...)` de la scène.
+    """
+    service, options, texts = _scene_speech(code)
+    if service is None:
+        return []
+    return [(service, options, text) for text in dict.fromkeys(texts)]
+
+
+def narration_voice(code: str) -> str:
+    """Moteur et voix qui narreront la scène ("gtts:fr|com", ...), pour distinguer les rendus en cache."""
+    service, options, _ = _scene_speech(code)
+    try:
+        backend = resolve_backend(service or "")
+    except ValueError:
+        backend = None
+    if backend is None:
+        return f"{os.environ.get(TTS_BACKEND_ENV) or 'native'}:{service}"
+    return f"{backend.name}:{backend.voice(options)}"
+
+
+def presynthesize(code: str, max_workers: int = TTS_CONCURRENCY) -> Optional[Dict[str, Any]]:
+    """
+    Synthétise en parallèle, avant le rendu, toutes les narrations de la scène absentes du cache audio :
+    pendant le rendu, chaque `voiceover` trouve son audio dans le cache au lieu d'attendre le TTS.
+    Retourne l'étape mesurée (None si la scène n'a pas de narration prise en charge).
+    Un échec n'est pas bloquant : le segment sera synthétisé (et l'erreur remontée) pendant le rendu.
+    """
+    segments = voiceover_segments(code)
+    if not segments:
+        return None
+    try:
+        backend = resolve_backend(segments[0][0])
+    except ValueError:
+        return None
+    if backend is None:
+        return None
+    voice = backend.voice(segments[0][1])
+
+    start, started = time.time(), time.perf_counter()
+    texts = [speech_text(text) for _, _, text in segments]
+    results = {"hit": 0, "miss": 0, "error": 0}
+
+    def synthesize(text: str) -> str:
+        try:
+            return "hit" if synthesize_cached(backend, voice, text)[1] else "miss"
+        except Exception:
+            return "error"
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(texts)))) as executor:
+        for outcome in executor.map(synthesize, texts):
+            results[outcome] += 1
+    return stage_record("tts_presynth", start, time.perf_counter() - started, service=backend.name,
+                        segments=len(texts), **results)
+
+
+def backend_service_class(service_class: str, backend: SpeechBackend):
+    """Remplaçant du service `service_class` de manim-voiceover, adossé à `backend` et au cache audio partagé."""
+    from manim_voiceover.services.base import SpeechService
+    from app.utils.tracing import log_stage
+
+    class BackendService(SpeechService):
+        def __init__(self, global_speed: float = 1.0, cache_dir: Optional[str] = None, **kwargs):
+            # Accepte les options des vrais services (lang, tld, voice...) et les traduit pour le moteur
+            SpeechService.__init__(self, global_speed=global_speed, cache_dir=cache_dir)
+            self.voice = backend.voice({"global_speed": global_speed, **kwargs})
+
+        def generate_from_text(self, text: str, cache_dir: Optional[str] = None, path: Optional[str] = None,
+                               **kwargs) -> dict:
+            if cache_dir is None:
+                cache_dir = self.cache_dir
+            text = speech_text(text)
+            start, wall_start = time.time(), time.perf_counter()
+            cached_audio, hit = synthesize_cached(backend, self.voice, text)
+            audio_path = path or cached_audio.name
+            os.makedirs(cache_dir, exist_ok=True)
+            shutil.copyfile(cached_audio, os.path.join(cache_dir, audio_path))
+            log_stage("tts", start, time.perf_counter() - wall_start, service=backend.name,
+                      cache="hit" if hit else "miss")
+            return {
+                "input_text": text,
+                "input_data": {"input_text": text, "service": backend.name, "voice": self.voice},
+                "original_audio": audio_path,
+            }
+
+    BackendService.__name__ = BackendService.__qualname__ = service_class
+    return BackendService
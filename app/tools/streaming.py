@@ -0,0 +1,149 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import BaseMessage
+
+from app.tools.tex_cache import TEX_PREWARMER, TexCall, extract_tex_calls
+from app.tools.validation import TEX_CLASSES, check_latex
+from app.utils.llm import record_usage
+from app.utils.tracing import annotate
+
+CODE_MARKER = "===CODE==="
+CLASS_NAME_MARKER = "===CLASS_NAME==="
+# Le nom de classe est complet dès qu'il est suivi d'un autre caractère
+_CLASS_NAME_DONE = re.compile(re.escape(CLASS_NAME_MARKER) + r"\s*(\w+)[^\w]")
+
+# Préchauffage LaTeX pendant la génération (désactivable avec MATHCONCEPT_STREAM_PREWARM=0)
+STREAM_PREWARM = os.getenv("MATHCONCEPT_STREAM_PREWARM", "1") not in ("0", "false", "False")
+
+_WARMUP_THREADS = ThreadPoolExecutor(max_workers=4, thread_name_prefix="latex-check")
+
+# Derniers appels préchauffés : un appel vu ligne par ligne n'est pas repris avec le code complet
+WARMED_CALLS_MAX = 4096
+_WARMED_CALLS: "OrderedDict[TexCall, None]" = OrderedDict()
+_WARMED_LOCK = threading.Lock()
+
+
+class ScriptStreamParser:
+    """
+    Analyse incrémentale d'une réponse ===CODE=== / ===CLASS_NAME=== reçue token par token.
+    `on_code_line` est appelé pour chaque ligne de code complète, `on_code` une fois le bloc de code terminé.
+    `feed` retourne True dès que le nom de classe est complet : la suite de la réponse est inutile.
+    """
+
+    def __init__(self, on_code_line: Optional[Callable[[str], None]] = None,
+                 on_code: Optional[Callable[[str], None]] = None):
+        self.text = ""
+        self.class_name: Optional[str] = None
+        self.code: Optional[str] = None
+        self.on_code_line = on_code_line
+        self.on_code = on_code
+        self._line_cursor: Optional[int] = None
+
+    def feed(self, chunk: str) -> bool:
+        self.text += chunk
+        if self._line_cursor is None:
+            start = self.text.find(CODE_MARKER)
+            if start == -1:
+                return False
+            self._line_cursor = start + len(CODE_MARKER)
+
+        if self.code is None:
+            end = self.text.find(CLASS_NAME_MARKER, self._line_cursor)
+            limit = end if end != -1 else len(self.text)
+            newline = self.text.rfind("\n", self._line_cursor, limit)
+            if newline != -1:
+                self._emit_lines(self.text[self._line_cursor:newline])
+                self._line_cursor = newline + 1
+            if end == -1:
+                return False
+            self._emit_lines(self.text[self._line_cursor:end])
+            start = self.text.find(CODE_MARKER) + len(CODE_MARKER)
+            self.code = re.sub(r"^\s*```(?:python)?\s*|\s*```\s*$", "", self.text[start:end])
+            if self.on_code is not None:
+                self.on_code(self.code)
+
+        match = _CLASS_NAME_DONE.search(self.text)
+        if match:
+            self.class_name = match.group(1)
+            return True
+        return False
+
+    def _emit_lines(self, block: str) -> None:
+        if self.on_code_line is None:
+            return
+        for line in block.split("\n"):
+            if line.strip() and not line.strip().startswith("```"):
+                self.on_code_line(line)
+
+
+def warm_up_line(line: str) -> None:
+    """Lance la vérification LaTeX et la compilation des formules d'une ligne de code dès sa réception."""
+    if not any(name in line for name in TEX_CLASSES):
+        return
+    try:
+        calls = extract_tex_calls(line.strip())
+    except SyntaxError:
+        return  # appel sur plusieurs lignes : traité avec le code complet
+    _warm_up(calls)
+
+
+def warm_up_code(code: str) -> None:
+    try:
+        calls = extract_tex_calls(code)
+    except SyntaxError:
+        return
+    _warm_up(calls)
+
+
+def _first_seen(call: TexCall) -> bool:
+    with _WARMED_LOCK:
+        if call in _WARMED_CALLS:
+            _WARMED_CALLS.move_to_end(call)
+            return False
+        _WARMED_CALLS[call] = None
+        if len(_WARMED_CALLS) > WARMED_CALLS_MAX:
+            _WARMED_CALLS.popitem(last=False)
+        return True
+
+
+def _warm_up(calls: List[TexCall]) -> None:
+    for kind, args in dict.fromkeys(calls):
+        if not _first_seen((kind, args)):
+            continue
+        # Remplit le cache de check_latex avec la chaîne que vérifie la validation avant rendu (arguments joints)
+        _WARMUP_THREADS.submit(check_latex, " ".join(args), TEX_CLASSES[kind])
+        if STREAM_PREWARM:
+            TEX_PREWARMER.submit((kind, args))
+
+
+def stream_script(llm: BaseChatModel, messages: List[BaseMessage],
+                  on_code_line: Optional[Callable[[str], None]] = warm_up_line,
+                  on_code: Optional[Callable[[str], None]] = warm_up_code) -> str:
+    """
+    Génère la réponse en streaming et coupe la génération dès que ===CLASS_NAME=== et le nom
+    de classe ont été reçus. Retourne le texte reçu.
+    """
+    parser = ScriptStreamParser(on_code_line=on_code_line, on_code=on_code)
+    stream = llm.stream(messages)
+    chunks, usage = 0, {}
+    try:
+        for chunk in stream:
+            chunks += 1
+            for name, value in (getattr(chunk, "usage_metadata", None) or {}).items():
+                if isinstance(value, int):
+                    usage[name] = usage.get(name, 0) + value
+            if parser.feed(chunk.content if isinstance(chunk.content, str) else ""):
+                break
+    finally:
+        # Fermer le générateur interrompt la requête HTTP en cours : plus de tokens facturés
+        stream.close()
+        # Arrêtée tôt, la réponse n'a souvent pas d'usage_metadata : le nombre de chunks en donne une estimation
+        annotate(output_chunks=chunks, early_stop=parser.class_name is not None)
+        record_usage(usage)
+    return parser.text
@@ -0,0 +1,183 @@
+import os
+import ast
+import sys
+import argparse
+import warnings
+import tempfile
+import functools
+import threading
+import multiprocessing
+from pathlib import Path
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Iterable, List, Optional, Tuple
+
+from app.utils.cache import CACHE_ROOT
+from app.tools.validation import TEX_CLASSES, call_name
+
+# Dossier Tex partagé : Manim y nomme chaque fichier par le hash de l'expression et du template,
+# une formule déjà compilée (.svg présent) n'est donc jamais recompilée
+TEX_CACHE_DIR = Path(os.getenv("MATHCONCEPT_TEX_CACHE_DIR", CACHE_ROOT / "tex"))
+
+TexCall = Tuple[str, Tuple[str, ...]]
+
+
+def write_manim_config(directory: str) -> str:
+    """Écrit un manim.cfg qui redirige `tex_dir` vers le cache partagé et retourne son chemin."""
+    TEX_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    config_file = os.path.join(directory, "manim.cfg")
+    with open(config_file, "w", encoding="utf-8") as f:
+        f.write(f"[CLI]\ntex_dir = {TEX_CACHE_DIR}\n")
+    return config_file
+
+
+def atomic_tex_to_svg_file(func):
+    """
+    Enveloppe `tex_to_svg_file` de Manim : la formule est compilée dans un dossier privé puis le .svg
+    est publié dans le cache partagé par os.replace. Deux rendus qui compilent la même formule ne
+    s'écrasent plus, et aucun ne lit un .svg à moitié écrit.
+    """
+    @functools.wraps(func)
+    def wrapper(expression, environment=None, tex_template=None):
+        from manim import config
+        from manim.utils.tex_file_writing import generate_tex_file
+
+        shared_dir = Path(config.get_dir("tex_dir"))
+        shared_dir.mkdir(parents=True, exist_ok=True)
+        with tempfile.TemporaryDirectory(dir=shared_dir, prefix=".build_") as private_dir:
+            config.tex_dir = private_dir
+            try:
+                # Même nom que Manim : hash du document généré
+                tex_file = generate_tex_file(expression, environment, tex_template)
+                shared_svg = shared_dir / tex_file.with_suffix(".svg").name
+                if shared_svg.exists():
+                    return shared_svg
+                svg_file = func(expression, environment=environment, tex_template=tex_template)
+            finally:
+                config.tex_dir = str(shared_dir)
+            os.replace(svg_file, shared_svg)
+        return shared_svg
+
+    wrapper.__atomic__ = True
+    return wrapper
+
+
+def install_atomic_tex() -> None:
+    """Remplace `tex_to_svg_file` (module d'origine et import de tex_mobject) par sa version atomique."""
+    try:
+        from manim.utils import tex_file_writing
+        from manim.mobject.text import tex_mobject
+    except ImportError:
+        return
+    original = tex_file_writing.tex_to_svg_file
+    if getattr(original, "__atomic__", False):
+        return
+    atomic = atomic_tex_to_svg_file(original)
+    for module in (tex_file_writing, tex_mobject):
+        if getattr(module, "tex_to_svg_file", None) is original:
+            module.tex_to_svg_file = atomic
+
+
+def extract_tex_calls(code: str) -> List[TexCall]:
+    """Appels MathTex / Tex dont tous les arguments positionnels sont des chaînes littérales."""
+    calls = []
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", SyntaxWarning)
+        tree = ast.parse(code)
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Call) or call_name(node) not in TEX_CLASSES or not node.args:
+            continue
+        if all(isinstance(arg, ast.Constant) and isinstance(arg.value, str) for arg in node.args):
+            calls.append((call_name(node), tuple(arg.value for arg in node.args)))
+    return calls
+
+
+def _warm_tex_call(call: TexCall) -> Optional[str]:
+    """Instancie le Mobject dans un worker pour produire le .svg dans le cache. Retourne l'erreur éventuelle."""
+    import manim
+    install_atomic_tex()
+    kind, args = call
+    try:
+        with manim.tempconfig({"tex_dir": str(TEX_CACHE_DIR)}):
+            getattr(manim, kind)(*args)
+    except Exception as e:
+        return f"{kind}{args}: {e}"
+    return None
+
+
+def prewarm_tex(calls: Iterable[TexCall], workers: Optional[int] = None) -> List[str]:
+    """Compile en parallèle, sur tous les cœurs, les formules absentes du cache. Retourne les erreurs."""
+    unique_calls = list(dict.fromkeys(calls))
+    if not unique_calls:
+        return []
+    TEX_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    with ProcessPoolExecutor(
+        max_workers=workers or os.cpu_count() or 1,
+        mp_context=multiprocessing.get_context("spawn"),
+    ) as pool:
+        return [error for error in pool.map(_warm_tex_call, unique_calls) if error is not None]
+
+
+class TexPrewarmer:
+    """
+    Pool de processus persistant qui compile des formules en tâche de fond,
+    par exemple pendant que le LLM est encore en train d'écrire la scène.
+    Les `memory` derniers appels soumis ne sont pas resoumis ; un appel en échec peut l'être.
+    """
+
+    def __init__(self, workers: int = 2, memory: int = 4096):
+        self.workers = workers
+        self.memory = memory
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._submitted: "OrderedDict[TexCall, None]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _forget_failed(self, call: TexCall, future: Future) -> None:
+        if future.cancelled() or future.exception() is not None or future.result() is not None:
+            with self._lock:
+                self._submitted.pop(call, None)
+
+    def submit(self, call: TexCall) -> Optional[Future]:
+        with self._lock:
+            if call in self._submitted:
+                self._submitted.move_to_end(call)
+                return None
+            self._submitted[call] = None
+            if len(self._submitted) > self.memory:
+                self._submitted.popitem(last=False)
+            if self._executor is None:
+                TEX_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            future = self._executor.submit(_warm_tex_call, call)
+        future.add_done_callback(functools.partial(self._forget_failed, call))
+        return future
+
+
+TEX_PREWARMER = TexPrewarmer(workers=int(os.getenv("MATHCONCEPT_TEX_PREWARM_WORKERS", 2)))
+
+
+def load_corpus(paths: Iterable[str]) -> List[TexCall]:
+    """Fichiers .py : appels MathTex/Tex extraits du code ; autres fichiers : une formule MathTex par ligne."""
+    calls = []
+    for path in paths:
+        content = Path(path).read_text(encoding="utf-8")
+        if path.endswith(".py"):
+            calls.extend(extract_tex_calls(content))
+        else:
+            calls.extend(("MathTex", (line.strip(),)) for line in content.splitlines() if line.strip())
+    return calls
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Préchauffe le cache LaTeX partagé des rendus Manim")
+    parser.add_argument("corpus", nargs="+", help="scènes .py ou fichiers de formules (une par ligne)")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    errors = prewarm_tex(load_corpus(args.corpus), workers=args.workers)
+    for error in errors:
+        print(error, file=sys.stderr)
+    print(f"Cache LaTeX : {TEX_CACHE_DIR}")
@@ -0,0 +1,221 @@
+import os
+import re
+import ast
+import shutil
+import warnings
+import tempfile
+import functools
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional
+
+# Classes Manim dont les arguments texte sont compilés par LaTeX, et leur mode
+TEX_CLASSES = {"MathTex": "math", "SingleStringMathTex": "math", "Tex": "text"}
+
+LATEX_BIN = shutil.which("latex")
+LATEX_TIMEOUT = float(os.getenv("MATHCONCEPT_LATEX_TIMEOUT", 10))
+
+# Préambule proche du TexTemplate par défaut de Manim
+LATEX_PREAMBLE = r"""\documentclass[preview]{standalone}
+\usepackage[english]{babel}
+\usepackage{amsmath}
+\usepackage{amssymb}
+\begin{document}
+"""
+
+# Caractères produits par des échappements Python involontaires ("\f" de \frac, "\b" de \beta, ...) :
+# \a, \b, \t, \v et \f. Les retours à la ligne, légitimes dans une chaîne triple, n'en font pas partie.
+_CONTROL_CHARS = re.compile(r"[\x07-\x09\x0b\x0c]")
+
+
+def _issue(kind: str, message: str, line: Optional[int] = None, severity: str = "error") -> Dict[str, Any]:
+    return {"kind": kind, "severity": severity, "line": line, "message": message}
+
+
+def _base_names(node: ast.ClassDef) -> List[str]:
+    names = []
+    for base in node.bases:
+        if isinstance(base, ast.Name):
+            names.append(base.id)
+        elif isinstance(base, ast.Attribute):
+            names.append(base.attr)
+    return names
+
+
+def _is_voiceover_scene(classes: Dict[str, ast.ClassDef], class_name: str) -> bool:
+    """Remonte l'héritage des classes du module jusqu'à VoiceoverScene."""
+    seen = set()
+    pending = [class_name]
+    while pending:
+        name = pending.pop()
+        if name == "VoiceoverScene":
+            return True
+        if name in seen or name not in classes:
+            continue
+        seen.add(name)
+        pending.extend(_base_names(classes[name]))
+    return False
+
+
+def call_name(node: ast.Call) -> Optional[str]:
+    if isinstance(node.func, ast.Name):
+        return node.func.id
+    if isinstance(node.func, ast.Attribute):
+        return node.func.attr
+    return None
+
+
+def extract_tex_strings(code: str, tree: Optional[ast.AST] = None) -> List[Dict[str, Any]]:
+    """
+    Liste les chaînes littérales passées à MathTex / Tex, avec leur ligne et leur préfixe.
+    `call` numérote l'appel d'origine, `complete` indique si tous ses arguments positionnels sont littéraux.
+    """
+    tree = tree or ast.parse(code)
+    strings = []
+    calls = (node for node in ast.walk(tree) if isinstance(node, ast.Call) and call_name(node) in TEX_CLASSES)
+    for index, node in enumerate(calls):
+        complete = all(isinstance(arg, ast.Constant) and isinstance(arg.value, str) for arg in node.args)
+        for arg in node.args:
+            if not (isinstance(arg, ast.Constant) and isinstance(arg.value, str)):
+                continue
+            source = ast.get_source_segment(code, arg) or ""
+            prefix = re.match(r"[A-Za-z]*", source).group().lower()
+            strings.append({
+                "tex": arg.value,
+                "mode": TEX_CLASSES[call_name(node)],
+                "line": arg.lineno,
+                "raw": "r" in prefix,
+                "source": source,
+                "call": index,
+                "complete": complete,
+            })
+    return strings
+
+
+def joined_tex(entries: List[Dict[str, Any]]) -> str:
+    """Chaîne compilée par Manim pour un appel : les arguments joints par des espaces."""
+    return " ".join(entry["tex"] for entry in entries)
+
+
+def _static_latex_error(tex: str) -> Optional[str]:
+    depth = 0
+    for match in re.finditer(r"\\.|[{}]", tex):
+        token = match.group()
+        if token == "{":
+            depth += 1
+        elif token == "}":
+            depth -= 1
+            if depth < 0:
+                return "accolade fermante sans ouvrante"
+    if depth != 0:
+        return "accolades non équilibrées"
+    if len(re.findall(r"\\left\b", tex)) != len(re.findall(r"\\right\b", tex)):
+        return "\\left et \\right non appariés"
+    return None
+
+
+def _latex_document(tex: str, mode: str) -> str:
+    if mode == "math":
+        return LATEX_PREAMBLE + "\\begin{align*}\n" + tex + "\n\\end{align*}\n\\end{document}\n"
+    return LATEX_PREAMBLE + tex + "\n\\end{document}\n"
+
+
+@functools.lru_cache(maxsize=4096)
+def check_latex(tex: str, mode: str = "math") -> Optional[str]:
+    """
+    Vérifie qu'une chaîne compile avec LaTeX. Retourne None si elle est valide, sinon le message d'erreur.
+    Le résultat est mis en cache : une même formule n'est compilée qu'une fois par processus.
+    """
+    static_error = _static_latex_error(tex)
+    if static_error is not None:
+        return static_error
+    if LATEX_BIN is None or os.getenv("MATHCONCEPT_LATEX_CHECK", "1") in ("0", "false", "False"):
+        return None
+
+    with tempfile.TemporaryDirectory(prefix="mathconcept_tex_") as tmp_dir:
+        tex_file = os.path.join(tmp_dir, "check.tex")
+        with open(tex_file, "w", encoding="utf-8") as f:
+            f.write(_latex_document(tex, mode))
+        try:
+            result = subprocess.run(
+                [LATEX_BIN, "-interaction=nonstopmode", "-halt-on-error", "check.tex"],
+                capture_output=True, text=True, cwd=tmp_dir, timeout=LATEX_TIMEOUT,
+            )
+        except subprocess.TimeoutExpired:
+            return "compilation LaTeX trop longue"
+    if result.returncode == 0:
+        return None
+    errors = [line for line in result.stdout.splitlines() if line.startswith("!")]
+    return errors[0] if errors else "erreur de compilation LaTeX"
+
+
+def validate_scene(code: str, class_name: str, latex: bool = True) -> List[Dict[str, Any]]:
+    """
+    Validation statique d'une scène générée, sans lancer Manim.
+    Retourne la liste des problèmes trouvés ; ceux de sévérité "error" empêchent le rendu.
+    """
+    issues = []
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        try:
+            tree = ast.parse(code)
+        except SyntaxError as e:
+            return [_issue("syntax", f"SyntaxError: {e.msg}", e.lineno)]
+    for warning in caught:
+        if issubclass(warning.category, SyntaxWarning):
+            issues.append(_issue("syntax_warning", str(warning.message), warning.lineno, severity="warning"))
+
+    classes = {node.name: node for node in ast.walk(tree) if isinstance(node, ast.ClassDef)}
+    if class_name not in classes:
+        issues.append(_issue("missing_class", f"La classe {class_name} n'est pas définie dans le code"))
+    elif not _is_voiceover_scene(classes, class_name):
+        issues.append(_issue("not_voiceover_scene", f"La classe {class_name} doit hériter de VoiceoverScene",
+                             classes[class_name].lineno))
+
+    tex_strings = extract_tex_strings(code, tree)
+    for entry in tex_strings:
+        if entry["raw"] or "\\" not in entry["source"]:
+            continue
+        # Un échappement qui a modifié la chaîne (\f, \b, \t, ...) casse la formule, sinon c'est un risque
+        broken = bool(_CONTROL_CHARS.search(entry["tex"]))
+        issues.append(_issue(
+            "non_raw_latex",
+            f"Chaîne LaTeX non brute {entry['source'][:80]} : utiliser r\"...\"",
+            entry["line"],
+            severity="error" if broken else "warning",
+        ))
+
+    if latex:
+        # Manim joint les arguments d'un appel par des espaces avant de compiler : MathTex(r"\frac{", "a}{b}")
+        # n'est valide qu'une fois assemblé, c'est donc la chaîne jointe de chaque appel qui est vérifiée
+        calls: Dict[int, List[Dict[str, Any]]] = {}
+        for entry in tex_strings:
+            if entry["complete"]:
+                calls.setdefault(entry["call"], []).append(entry)
+        candidates = [entries for entries in calls.values()
+                      if not any(_CONTROL_CHARS.search(entry["tex"]) for entry in entries)]
+        with ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1)) as pool:
+            results = pool.map(lambda entries: check_latex(joined_tex(entries), entries[0]["mode"]), candidates)
+            for entries, error in zip(candidates, results):
+                if error is not None:
+                    source = ", ".join(entry["source"] for entry in entries)
+                    issues.append(_issue("latex", f"{source[:80]} : {error}", entries[0]["line"]))
+    return issues
+
+
+def preflight(code: str, math_scene: str) -> Optional[Dict[str, Any]]:
+    """Retourne un résultat d'échec au format de execute_manim_with_audio si la scène est invalide."""
+    issues = validate_scene(code, math_scene)
+    errors = [issue for issue in issues if issue["severity"] == "error"]
+    if not errors:
+        return None
+    details = "; ".join(
+        f"ligne {issue['line']}: {issue['message']}" if issue["line"] else issue["message"]
+        for issue in errors
+    )
+    return {
+        "success": False,
+        "video_path": None,
+        "message": f"Erreur de validation: {details[:500]}",
+        "metadata": {"validation_errors": issues}
+    }
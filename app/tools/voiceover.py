@@ -0,0 +1,146 @@
+import os
+import time
+import shutil
+import importlib
+from pathlib import Path
+from typing import Optional
+
+from app.utils.cache import FileCache, hash_key
+from app.utils.tracing import STAGE_LOG_ENV, log_stage, timed
+
+# Cache audio partagé entre rendus et workers, hors du dossier `media` supprimé après chaque rendu
+AUDIO_CACHE = FileCache(
+    "tts",
+    suffix=".mp3",
+    max_bytes=int(os.getenv("MATHCONCEPT_TTS_CACHE_MAX_BYTES", 2 * 1024**3)),
+)
+
+# Ligne ajoutée en tête de chaque scène pour installer les hooks dans le processus Manim
+SCENE_PREAMBLE = "from app.tools.voiceover import install_render_hooks; install_render_hooks()\n"
+PREAMBLE_LINES = SCENE_PREAMBLE.count("\n")
+
+# (module, classe, nom du service) des services manim-voiceover mis en cache
+CACHED_SERVICES = [
+    ("manim_voiceover.services.gtts", "GTTSService", "gtts"),
+    ("manim_voiceover.services.azure", "AzureService", "azure"),
+]
+
+# Moteur TTS imposé à toutes les scènes (voir app.tools.speech) : "gtts", "edge", "espeak" (local, hors ligne)
+# ou "stub" (silence, benchmarks). Sans valeur, chaque scène garde le moteur de son service.
+TTS_BACKEND_ENV = "MATHCONCEPT_TTS_BACKEND"
+# Débit de parole simulé par le moteur "stub"
+STUB_SECONDS_PER_CHAR = 0.06
+
+# (module, attribut, étape) des fonctions de Manim chronométrées pendant le rendu
+TIMED_FUNCTIONS = [
+    ("manim.utils.tex_file_writing", "tex_to_svg_file", "latex"),
+    ("manim.mobject.text.tex_mobject", "tex_to_svg_file", "latex"),
+    ("manim.scene.scene_file_writer", "SceneFileWriter.combine_to_movie", "ffmpeg_mux"),
+]
+
+_installed = False
+
+
+def normalize_text(text: str) -> str:
+    """Même normalisation que manim-voiceover : espaces multiples et retours à la ligne réduits."""
+    return " ".join(text.split())
+
+
+def speech_cache_key(service: str, voice: str, text: str) -> str:
+    return hash_key(service, voice, normalize_text(text))
+
+
+class SharedAudioCacheMixin:
+    """Consulte le cache audio partagé avant d'appeler le vrai service TTS."""
+
+    service_name = "unknown"
+
+    def voice_id(self) -> str:
+        attrs = ("lang", "tld", "voice", "style", "global_speed")
+        return "|".join(f"{attr}={getattr(self, attr)}" for attr in attrs if hasattr(self, attr))
+
+    def generate_from_text(self, text: str, cache_dir: Optional[str] = None, path: Optional[str] = None, **kwargs) -> dict:
+        if cache_dir is None:
+            cache_dir = self.cache_dir
+        key = speech_cache_key(self.service_name, self.voice_id(), text)
+        start, wall_start = time.time(), time.perf_counter()
+
+        cached_audio = AUDIO_CACHE.get(key)
+        if cached_audio is not None:
+            audio_path = path or f"{key}.mp3"
+            Path(cache_dir).mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(cached_audio, Path(cache_dir) / audio_path)
+            log_stage("tts", start, time.perf_counter() - wall_start, service=self.service_name, cache="hit")
+            return {
+                "input_text": text,
+                "input_data": {"input_text": text, "service": self.service_name},
+                "original_audio": audio_path,
+            }
+
+        result = super().generate_from_text(text, cache_dir=cache_dir, path=path, **kwargs)
+        AUDIO_CACHE.put(key, Path(cache_dir) / result["original_audio"])
+        log_stage("tts", start, time.perf_counter() - wall_start, service=self.service_name, cache="miss")
+        return result
+
+
+def install_tts_cache() -> None:
+    """Remplace les services manim-voiceover connus par leur version avec cache partagé."""
+    for module_name, class_name, service_name in CACHED_SERVICES:
+        try:
+            module = importlib.import_module(module_name)
+        except ImportError:
+            continue
+        service_cls = getattr(module, class_name)
+        if issubclass(service_cls, SharedAudioCacheMixin):
+            continue
+        cached_cls = type(class_name, (SharedAudioCacheMixin, service_cls), {"service_name": service_name})
+        setattr(module, class_name, cached_cls)
+
+
+def install_speech_backends() -> None:
+    """
+    Remplace les services des scènes par les moteurs de app.tools.speech (cache audio partagé, narrations
+    pré-synthétisées avant le rendu). Un service sans moteur équivalent garde sa version avec cache.
+    """
+    from app.tools.speech import backend_service_class, resolve_backend
+
+    for module_name, class_name, _ in CACHED_SERVICES:
+        backend = resolve_backend(class_name)
+        if backend is None:
+            continue
+        try:
+            module = importlib.import_module(module_name)
+        except ImportError:
+            continue
+        setattr(module, class_name, backend_service_class(class_name, backend))
+
+
+def install_stage_timers() -> None:
+    """Chronomètre la compilation LaTeX et l'assemblage ffmpeg de Manim (voir app.utils.tracing)."""
+    for module_name, attr_path, stage in TIMED_FUNCTIONS:
+        try:
+            owner = importlib.import_module(module_name)
+        except ImportError:
+            continue
+        *parents, attr = attr_path.split(".")
+        for parent in parents:
+            owner = getattr(owner, parent, None)
+        func = getattr(owner, attr, None)
+        if func is None or getattr(func, "__traced__", False):
+            continue
+        setattr(owner, attr, timed(stage)(func))
+
+
+def install_render_hooks() -> None:
+    """Point d'entrée appelé par SCENE_PREAMBLE dans le processus de rendu."""
+    global _installed
+    if _installed:
+        return
+    from app.tools.tex_cache import install_atomic_tex
+
+    install_tts_cache()
+    install_speech_backends()
+    install_atomic_tex()
+    if os.environ.get(STAGE_LOG_ENV):
+        install_stage_timers()
+    _installed = True
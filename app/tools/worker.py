@@ -0,0 +1,239 @@
+import os
+import gc
+import time
+import types
+import queue
+import shutil
+import signal
+import resource
+import threading
+import traceback
+import multiprocessing
+from pathlib import Path
+from typing import Dict, Any, List, Optional
+
+from app.tools.tex_cache import TEX_CACHE_DIR
+from app.utils.tracing import STAGE_LOG_ENV
+
+# Un worker chaud est remplacé après ce nombre de rendus ou au-delà de cette mémoire résidente (fuites)
+WORKER_MAX_JOBS = int(os.getenv("MATHCONCEPT_WORKER_MAX_JOBS", 50))
+WORKER_MAX_RSS_MB = float(os.getenv("MATHCONCEPT_WORKER_MAX_RSS_MB", 2048))
+
+# Options de la ligne de commande Manim -> valeur de `config.quality`
+QUALITY_NAMES = {
+    "-ql": "low_quality",
+    "-qm": "medium_quality",
+    "-qh": "high_quality",
+    "-qk": "fourk_quality",
+}
+
+
+def _current_rss_mb() -> float:
+    try:
+        with open("/proc/self/statm", encoding="utf-8") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 1024**2
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _cpu_seconds() -> float:
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def _job_config(job: Dict[str, Any]) -> Dict[str, Any]:
+    flags = job["quality_flags"]
+    dry_run = "--dry_run" in flags
+    config = {
+        "media_dir": job["media_dir"],
+        "tex_dir": str(TEX_CACHE_DIR),
+        "input_file": job["scene_file"],
+        "scene_names": [job["math_scene"]],
+        "dry_run": dry_run,
+        "write_to_movie": not dry_run,
+    }
+    quality = next((QUALITY_NAMES[flag] for flag in flags if flag in QUALITY_NAMES), None)
+    if quality is not None:
+        config["quality"] = quality
+    return config
+
+
+def _run_job(job: Dict[str, Any]) -> Dict[str, Any]:
+    """Exécute la scène dans un module neuf, avec la configuration et le dossier media propres au job."""
+    import manim
+
+    os.environ[STAGE_LOG_ENV] = job["stage_log"]
+    cwd = os.getcwd()
+    cpu_start = _cpu_seconds()
+    returncode, stderr = 0, ""
+    try:
+        os.chdir(job["root"])
+        with manim.tempconfig(_job_config(job)):
+            with open(job["scene_file"], encoding="utf-8") as f:
+                source = f.read()
+            module = types.ModuleType(job["module_name"])
+            module.__file__ = job["scene_file"]
+            # Nom de fichier réel : les traces pointent vers scene_<id>.py comme avec la CLI
+            exec(compile(source, job["scene_file"], "exec"), module.__dict__)
+            scene = getattr(module, job["math_scene"])()
+            scene.render()
+            movie = None if "--dry_run" in job["quality_flags"] else scene.renderer.file_writer.movie_file_path
+        if movie is not None:
+            shutil.move(str(movie), job["final_video"])
+            # Sous-titres et piste audio suivent la vidéo, comme avec `manim -o`
+            for suffix in (".srt", ".wav"):
+                sidecar = Path(movie).with_suffix(suffix)
+                if sidecar.exists():
+                    shutil.move(str(sidecar), str(Path(job["final_video"]).with_suffix(suffix)))
+    except (Exception, SystemExit):
+        returncode, stderr = 1, traceback.format_exc()
+    finally:
+        os.chdir(cwd)
+        gc.collect()
+    rss = _current_rss_mb()
+    return {
+        "returncode": returncode,
+        "stderr": stderr,
+        "usage": {"cpu_seconds": _cpu_seconds() - cpu_start, "rss_mb": rss,
+                  "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024},
+    }
+
+
+def _worker_main(conn, max_jobs: int, max_rss_mb: float) -> None:
+    """Boucle du worker : imports chargés une fois, puis un rendu par message reçu."""
+    # Groupe de processus propre : un timeout tue aussi latex et ffmpeg
+    os.setsid()
+    os.environ[STAGE_LOG_ENV] = os.devnull
+    import manim  # noqa: F401  (le coût d'import est payé ici, une seule fois)
+    import manim_voiceover  # noqa: F401
+    from app.tools.voiceover import install_render_hooks
+    install_render_hooks()
+
+    jobs = 0
+    while True:
+        try:
+            job = conn.recv()
+        except (EOFError, OSError):
+            return
+        if job is None:
+            return
+        reply = _run_job(job)
+        jobs += 1
+        reply["recycle"] = jobs >= max_jobs or reply["usage"]["rss_mb"] > max_rss_mb
+        conn.send(reply)
+        if reply["recycle"]:
+            return
+
+
+class WarmWorker:
+    """Processus de rendu persistant, redémarré s'il plante, dépasse son délai ou doit être recyclé."""
+
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.process = None
+        self.conn = None
+
+    def _start(self) -> None:
+        parent_conn, child_conn = self.ctx.Pipe()
+        self.process = self.ctx.Process(target=_worker_main, args=(child_conn, WORKER_MAX_JOBS, WORKER_MAX_RSS_MB),
+                                        daemon=True, name="manim-worker")
+        self.process.start()
+        child_conn.close()
+        self.conn = parent_conn
+
+    def stop(self, kill: bool = True) -> None:
+        """Arrête le worker ; avec kill=False, lui laisse le temps de terminer de lui-même."""
+        if self.process is None:
+            return
+        if not kill:
+            self.process.join(timeout=5)
+        if self.process.is_alive():
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except (ProcessLookupError, PermissionError):
+                self.process.kill()
+        self.process.join(timeout=5)
+        self.conn.close()
+        self.process, self.conn = None, None
+
+    def render(self, job: Dict[str, Any], timeout: Optional[float]) -> Dict[str, Any]:
+        if self.process is None or not self.process.is_alive():
+            self.stop()
+            self._start()
+        try:
+            self.conn.send(job)
+            if not self.conn.poll(timeout):
+                self.stop()
+                return {"returncode": -signal.SIGKILL, "stderr": f"rendu interrompu après {timeout:.0f}s",
+                        "usage": {}, "timeout": True}
+            reply = self.conn.recv()
+        except (EOFError, OSError, BrokenPipeError):
+            # La scène a fait tomber le worker (segfault, mémoire...) : seul ce job échoue
+            self.process.join(timeout=1)
+            exitcode = self.process.exitcode
+            self.stop()
+            return {"returncode": exitcode or 1, "stderr": f"Worker de rendu arrêté (code de sortie {exitcode})",
+                    "usage": {}}
+        if reply.get("recycle"):
+            self.stop(kill=False)
+        return reply
+
+
+class WarmWorkerPool:
+    """
+    `size` workers chauds partagés par les threads de rendu.
+    Chaque rendu emprunte un worker libre, l'attend au besoin, puis le rend au pool.
+    """
+
+    def __init__(self, size: int):
+        self.size = max(1, size)
+        self._ctx = multiprocessing.get_context("spawn")
+        self._idle: "queue.Queue[WarmWorker]" = queue.Queue()
+        self._workers: List[WarmWorker] = []
+        self._lock = threading.Lock()
+
+    def _acquire(self) -> WarmWorker:
+        with self._lock:
+            if self._idle.empty() and len(self._workers) < self.size:
+                worker = WarmWorker(self._ctx)
+                self._workers.append(worker)
+                return worker
+        return self._idle.get()
+
+    def render(self, job: Dict[str, Any], timeout: Optional[float] = None) -> Dict[str, Any]:
+        worker = self._acquire()
+        started = time.perf_counter()
+        try:
+            reply = worker.render(job, timeout)
+        finally:
+            self._idle.put(worker)
+        reply["wall_seconds"] = time.perf_counter() - started
+        return reply
+
+    def shutdown(self) -> None:
+        with self._lock:
+            for worker in self._workers:
+                if worker.conn is not None:
+                    try:
+                        worker.conn.send(None)
+                    except (OSError, BrokenPipeError):
+                        pass
+                worker.stop(kill=False)
+            self._workers.clear()
+            self._idle = queue.Queue()
+
+
+def render_job(workspace, quality_flags: List[str], final_video: str, math_scene: str) -> Dict[str, Any]:
+    """Description d'un rendu envoyée au worker (picklable)."""
+    return {
+        "root": workspace.root,
+        "module_name": workspace.module_name,
+        "scene_file": workspace.scene_file,
+        "media_dir": workspace.media_dir,
+        "stage_log": workspace.stage_log,
+        "quality_flags": list(quality_flags),
+        "final_video": final_video,
+        "math_scene": math_scene,
+    }
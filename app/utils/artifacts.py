@@ -0,0 +1,259 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import sqlite3
+import tempfile
+import threading
+import subprocess
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Dict, Any, List, Optional, Tuple
+
+from app.utils.cache import CACHE_ROOT
+
+ARTIFACT_ROOT = Path(os.getenv("MATHCONCEPT_ARTIFACT_DIR", CACHE_ROOT / "artifacts"))
+
+# Rétention, appliquée périodiquement par un thread d'arrière-plan
+ARTIFACT_MAX_BYTES = int(os.getenv("MATHCONCEPT_ARTIFACT_MAX_BYTES", 20 * 1024**3))
+ARTIFACT_MAX_AGE = float(os.getenv("MATHCONCEPT_ARTIFACT_MAX_AGE", 90 * 24 * 3600))
+RETENTION_INTERVAL = float(os.getenv("MATHCONCEPT_ARTIFACT_RETENTION_INTERVAL", 600))
+
+# Fichiers annexes conservés à côté de la vidéo : sous-titres, piste audio, vignette
+SIDECAR_SUFFIXES = {"srt": ".srt", "audio": ".wav", "thumbnail": ".jpg"}
+
+FFMPEG_BIN = shutil.which("ffmpeg")
+
+
+def file_digest(path: str | os.PathLike) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def place_file(source: str | os.PathLike, dest: Path, move: bool = False) -> None:
+    """Place `source` en `dest` de façon atomique : déplacement, sinon lien physique, sinon copie."""
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    if move:
+        try:
+            os.replace(source, dest)
+            return
+        except OSError:
+            pass  # autre système de fichiers
+    fd, tmp_path = tempfile.mkstemp(dir=dest.parent, suffix=".tmp")
+    os.close(fd)
+    try:
+        os.unlink(tmp_path)
+        try:
+            os.link(source, tmp_path)
+        except OSError:
+            shutil.copyfile(source, tmp_path)
+        os.replace(tmp_path, dest)
+    except BaseException:
+        Path(tmp_path).unlink(missing_ok=True)
+        raise
+    if move:
+        Path(source).unlink(missing_ok=True)
+
+
+def make_thumbnail(video: Path, dest: Path) -> bool:
+    """Vignette : première image après une seconde de vidéo (ffmpeg requis)."""
+    if FFMPEG_BIN is None:
+        return False
+    result = subprocess.run([FFMPEG_BIN, "-y", "-loglevel", "error", "-ss", "1", "-i", str(video),
+                             "-frames:v", "1", str(dest)], capture_output=True)
+    return result.returncode == 0 and dest.exists()
+
+
+class ArtifactStore(ABC):
+    """Magasin des vidéos produites. `put` range une vidéo et ses annexes, `find` interroge l'index."""
+
+    @abstractmethod
+    def put(self, video: str | os.PathLike, class_name: str, concept: str = "",
+            sidecars: Optional[Dict[str, str]] = None, move: bool = False) -> Dict[str, Any]:
+        ...
+
+    @abstractmethod
+    def get(self, digest: str) -> Optional[Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    def find(self, concept: Optional[str] = None, class_name: Optional[str] = None,
+             digest: Optional[str] = None) -> List[Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    def enforce_retention(self) -> int:
+        ...
+
+    @abstractmethod
+    def revision(self) -> Tuple:
+        """Change quand une vidéo est publiée ou supprimée, pas quand elle est simplement lue."""
+        ...
+
+
+class LocalArtifactStore(ArtifactStore):
+    """
+    Magasin sur disque local, adressé par le sha256 de la vidéo :
+    - `objects/ab/<sha256>.mp4` et ses annexes `<sha256>.srt`, `.wav`, `.jpg`
+    - une vidéo identique n'est stockée qu'une fois, chaque publication ajoute une référence (concept, classe)
+    - index SQLite pour retrouver les vidéos par concept, classe ou hash
+    - rétention (taille totale, âge depuis le dernier accès) appliquée par un thread d'arrière-plan démarré avec le magasin
+    """
+
+    def __init__(self, root: str | os.PathLike = ARTIFACT_ROOT, max_bytes: Optional[int] = ARTIFACT_MAX_BYTES,
+                 max_age: Optional[float] = ARTIFACT_MAX_AGE, retention_interval: float = RETENTION_INTERVAL):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.root / "index.sqlite"
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.retention_interval = retention_interval
+        self._retention_thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS artifacts (
+                hash TEXT PRIMARY KEY, path TEXT, bytes INTEGER, sidecars TEXT, created REAL, accessed REAL)""")
+            conn.execute("""CREATE TABLE IF NOT EXISTS artifact_refs (
+                hash TEXT, concept TEXT, class_name TEXT, created REAL, UNIQUE (hash, concept, class_name))""")
+            conn.execute("CREATE INDEX IF NOT EXISTS artifact_refs_concept ON artifact_refs (concept)")
+            conn.execute("CREATE INDEX IF NOT EXISTS artifact_refs_class ON artifact_refs (class_name)")
+        self.start_retention()
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.index_path, timeout=30)
+
+    def object_path(self, digest: str) -> Path:
+        return self.root / "objects" / digest[:2] / f"{digest}.mp4"
+
+    def put(self, video: str | os.PathLike, class_name: str, concept: str = "",
+            sidecars: Optional[Dict[str, str]] = None, move: bool = False) -> Dict[str, Any]:
+        """
+        Range `video` (déplacée si move=True, sinon liée ou copiée) et ses annexes existantes.
+        Une vidéo déjà présente n'est pas réécrite : seules les annexes manquantes et la référence sont ajoutées.
+        """
+        digest = file_digest(video)
+        dest = self.object_path(digest)
+        if dest.exists():
+            if move:
+                Path(video).unlink(missing_ok=True)
+        else:
+            place_file(video, dest, move=move)
+
+        stored = {}
+        for kind, suffix in SIDECAR_SUFFIXES.items():
+            target = dest.with_suffix(suffix)
+            source = (sidecars or {}).get(kind)
+            if not target.exists() and source and os.path.exists(source):
+                place_file(source, target, move=move)
+            elif source and move:
+                Path(source).unlink(missing_ok=True)
+            if kind == "thumbnail" and not target.exists():
+                make_thumbnail(dest, target)
+            if target.exists():
+                stored[kind] = str(target)
+
+        now = time.time()
+        size = sum(path.stat().st_size for path in [dest, *map(Path, stored.values())])
+        with self._connect() as conn:
+            conn.execute(
+                """INSERT INTO artifacts (hash, path, bytes, sidecars, created, accessed) VALUES (?, ?, ?, ?, ?, ?)
+                   ON CONFLICT (hash) DO UPDATE SET bytes = excluded.bytes, sidecars = excluded.sidecars,
+                   accessed = excluded.accessed""",
+                (digest, str(dest), size, json.dumps(stored), now, now),
+            )
+            conn.execute("INSERT OR IGNORE INTO artifact_refs (hash, concept, class_name, created) VALUES (?, ?, ?, ?)",
+                         (digest, concept or "", class_name, now))
+        return {"hash": digest, "path": str(dest), "bytes": size, "sidecars": stored}
+
+    def _row(self, row) -> Dict[str, Any]:
+        return {"hash": row[0], "path": row[1], "bytes": row[2], "sidecars": json.loads(row[3] or "{}"),
+                "created": row[4], "accessed": row[5]}
+
+    def get(self, digest: str) -> Optional[Dict[str, Any]]:
+        with self._connect() as conn:
+            row = conn.execute("SELECT hash, path, bytes, sidecars, created, accessed FROM artifacts WHERE hash = ?",
+                               (digest,)).fetchone()
+            if row is None or not os.path.exists(row[1]):
+                return None
+            conn.execute("UPDATE artifacts SET accessed = ? WHERE hash = ?", (time.time(), digest))
+        return self._row(row)
+
+    def find(self, concept: Optional[str] = None, class_name: Optional[str] = None,
+             digest: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Artefacts publiés pour ce concept / cette classe / ce hash, du plus récent au plus ancien."""
+        clauses, params = [], []
+        for column, value in (("r.concept", concept), ("r.class_name", class_name), ("a.hash", digest)):
+            if value is not None:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self._connect() as conn:
+            rows = conn.execute(
+                f"""SELECT a.hash, a.path, a.bytes, a.sidecars, a.created, a.accessed, r.concept, r.class_name
+                    FROM artifacts a JOIN artifact_refs r ON r.hash = a.hash {where}
+                    ORDER BY r.created DESC""",
+                params,
+            ).fetchall()
+        return [{**self._row(row), "concept": row[6], "class_name": row[7]} for row in rows]
+
+    def revision(self) -> Tuple:
+        with self._connect() as conn:
+            return conn.execute("""SELECT (SELECT COUNT(*) FROM artifacts), (SELECT COUNT(*) FROM artifact_refs),
+                                          (SELECT MAX(created) FROM artifact_refs)""").fetchone()
+
+    def _delete(self, conn: sqlite3.Connection, digest: str, path: str) -> None:
+        dest = Path(path)
+        for suffix in [dest.suffix, *SIDECAR_SUFFIXES.values()]:
+            dest.with_suffix(suffix).unlink(missing_ok=True)
+        conn.execute("DELETE FROM artifacts WHERE hash = ?", (digest,))
+        conn.execute("DELETE FROM artifact_refs WHERE hash = ?", (digest,))
+
+    def enforce_retention(self) -> int:
+        """Supprime les artefacts trop anciens, puis les moins récemment utilisés au-delà de max_bytes."""
+        removed = 0
+        with self._lock, self._connect() as conn:
+            rows = conn.execute("SELECT hash, path, bytes, accessed FROM artifacts ORDER BY accessed").fetchall()
+            now = time.time()
+            kept = []
+            for digest, path, size, accessed in rows:
+                if (self.max_age is not None and now - accessed > self.max_age) or not os.path.exists(path):
+                    self._delete(conn, digest, path)
+                    removed += 1
+                else:
+                    kept.append((digest, path, size))
+            if self.max_bytes is not None:
+                total = sum(size for _, _, size in kept)
+                for digest, path, size in kept:
+                    if total <= self.max_bytes:
+                        break
+                    self._delete(conn, digest, path)
+                    total -= size
+                    removed += 1
+        return removed
+
+    def _retention_loop(self) -> None:
+        while not self._stop.wait(self.retention_interval):
+            try:
+                self.enforce_retention()
+            except sqlite3.Error:
+                continue
+
+    def start_retention(self) -> None:
+        """Démarre (une fois) le thread de rétention."""
+        with self._lock:
+            if self._retention_thread is None or not self._retention_thread.is_alive():
+                self._stop.clear()
+                self._retention_thread = threading.Thread(target=self._retention_loop, daemon=True,
+                                                          name="artifact-retention")
+                self._retention_thread.start()
+
+    def stop_retention(self) -> None:
+        self._stop.set()
+
+
+ARTIFACT_STORE = LocalArtifactStore()
@@ -0,0 +1,155 @@
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+from pathlib import Path
+from typing import Optional, Dict, Any
+
+# Racine des caches persistants, hors du dossier du package et des dossiers de rendu
+CACHE_ROOT = Path(os.getenv("MATHCONCEPT_CACHE_DIR", Path.home() / ".cache" / "mathconcept"))
+
+
+def hash_key(*parts: Any) -> str:
+    """Calcule une clé sha256 stable à partir de plusieurs valeurs."""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class FileCache:
+    """
+    Cache disque adressé par contenu : un fichier par clé dans `CACHE_ROOT/<name>`.
+
+    - écritures atomiques (fichier temporaire + os.replace), sûres entre processus
+    - éviction par âge (date d'écriture) et par taille totale (LRU sur la date d'accès)
+    - compteurs de hits / misses pour le processus courant
+    """
+
+    def __init__(self, name: str, suffix: str = "", max_bytes: Optional[int] = None,
+                 max_age: Optional[float] = None):
+        self.root = CACHE_ROOT / name
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.suffix = suffix
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def path_for(self, key: str) -> Path:
+        return self.root / f"{key}{self.suffix}"
+
+    def get(self, key: str) -> Optional[Path]:
+        """Retourne le chemin de l'entrée si elle existe et n'a pas expiré."""
+        path = self.path_for(key)
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            self._count(hit=False)
+            return None
+
+        now = time.time()
+        if self.max_age is not None and now - stat.st_mtime > self.max_age:
+            path.unlink(missing_ok=True)
+            self._count(hit=False)
+            return None
+
+        # La date d'accès sert d'horloge LRU (mise à jour explicite : montages noatime)
+        try:
+            os.utime(path, (now, stat.st_mtime))
+        except FileNotFoundError:
+            self._count(hit=False)
+            return None
+        self._count(hit=True)
+        return path
+
+    def put(self, key: str, source: str | os.PathLike) -> Path:
+        """
+        Stocke `source` dans le cache de façon atomique et retourne le chemin stocké.
+        Un lien physique est utilisé quand c'est possible : une vidéo aussi publiée n'occupe le disque qu'une fois.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        try:
+            os.close(fd)
+            try:
+                os.unlink(tmp_path)
+                os.link(source, tmp_path)
+            except OSError:
+                shutil.copyfile(source, tmp_path)
+            os.replace(tmp_path, self.path_for(key))
+        except BaseException:
+            Path(tmp_path).unlink(missing_ok=True)
+            raise
+        self.evict()
+        return self.path_for(key)
+
+    def put_bytes(self, key: str, data: bytes) -> Path:
+        """Comme `put`, à partir d'un contenu en mémoire."""
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as tmp:
+                tmp.write(data)
+            os.replace(tmp_path, self.path_for(key))
+        except BaseException:
+            Path(tmp_path).unlink(missing_ok=True)
+            raise
+        self.evict()
+        return self.path_for(key)
+
+    def evict(self) -> int:
+        """Supprime les entrées expirées puis les moins récemment utilisées. Retourne le nombre supprimé."""
+        if self.max_age is None and self.max_bytes is None:
+            return 0
+
+        entries = []
+        for path in self.root.glob(f"*{self.suffix}"):
+            if path.name.endswith(".tmp"):
+                continue
+            try:
+                entries.append((path, path.stat()))
+            except FileNotFoundError:
+                continue
+
+        removed = 0
+        now = time.time()
+        if self.max_age is not None:
+            kept = []
+            for path, stat in entries:
+                if now - stat.st_mtime > self.max_age:
+                    path.unlink(missing_ok=True)
+                    removed += 1
+                else:
+                    kept.append((path, stat))
+            entries = kept
+
+        if self.max_bytes is not None:
+            total = sum(stat.st_size for _, stat in entries)
+            for path, stat in sorted(entries, key=lambda entry: entry[1].st_atime):
+                if total <= self.max_bytes:
+                    break
+                path.unlink(missing_ok=True)
+                total -= stat.st_size
+                removed += 1
+        return removed
+
+    def stats(self) -> Dict[str, Any]:
+        sizes = [p.stat().st_size for p in self.root.glob(f"*{self.suffix}") if not p.name.endswith(".tmp")]
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": len(sizes),
+            "bytes": sum(sizes),
+        }
+
+    def _count(self, hit: bool) -> None:
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
@@ -0,0 +1,177 @@
+import os
+import re
+import csv
+import math
+import threading
+import unicodedata
+from pathlib import Path
+from collections import Counter
+from typing import Dict, Any, List, Optional, Tuple
+
+from app.utils.artifacts import ARTIFACT_STORE, ArtifactStore
+
+# Fichier des vidéos notées : colonnes `concept`, `satisfaction` et, optionnelle, `hash` (sha256 de la vidéo)
+CONCEPT_RATINGS = Path(os.getenv("MATHCONCEPT_CONCEPT_RATINGS", Path(__file__).resolve().parents[2] / "concepts.txt"))
+
+# Second niveau, désactivé par défaut : similarité entre trigrammes de caractères au-delà du seuil
+CONCEPT_SIMILARITY = os.getenv("MATHCONCEPT_CONCEPT_SIMILARITY", "0") not in ("0", "false", "False")
+CONCEPT_THRESHOLD = float(os.getenv("MATHCONCEPT_CONCEPT_THRESHOLD", 0.85))
+
+# Mots sans contenu des demandes : articles, prépositions, formules de politesse et consignes
+STOP_WORDS = frozenset("""
+    a au aux avec ce ces cet cette comment d de des du en et est l la le les leur leurs ma mes mon
+    moi nous notre ou par pour qu que qui sa se ses son sur ta te tes ton un une vos votre vous
+    explique expliquer expliquez montre montrer presente presenter video animation
+    stp svp merci peux peut pourrais pourriez notion concept
+""".split())
+
+SATISFIED = ("true", "1", "oui", "yes", "ok")
+UNSATISFIED = ("false", "0", "non", "no", "ko")
+
+
+def concept_cache_enabled() -> bool:
+    return os.getenv("MATHCONCEPT_CONCEPT_CACHE", "1") not in ("0", "false", "False")
+
+
+def normalize_concept(text: str) -> str:
+    """'Explique le Repère cartésien !' -> 'repere cartesien' : sans accents, casse ni mots vides."""
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(char for char in text if not unicodedata.combining(char)).lower()
+    return " ".join(word for word in re.findall(r"\w+", text) if word not in STOP_WORDS)
+
+
+def trigrams(text: str) -> Counter:
+    padded = f"  {text} "
+    return Counter(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+def similarity(a: Counter, b: Counter) -> float:
+    """Cosinus entre deux vecteurs de trigrammes."""
+    dot = sum(count * b[gram] for gram, count in a.items())
+    norm = math.sqrt(sum(v * v for v in a.values())) * math.sqrt(sum(v * v for v in b.values()))
+    return dot / norm if norm else 0.0
+
+
+def parse_satisfaction(value: Any) -> Optional[float]:
+    """True/oui -> 1, False/non -> 0, une note numérique est gardée telle quelle, sinon None."""
+    if value is None:
+        return None
+    text = str(value).strip().lower()
+    if text in SATISFIED:
+        return 1.0
+    if text in UNSATISFIED:
+        return 0.0
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+
+def load_ratings(path: str | os.PathLike) -> Tuple[Dict[str, float], Dict[str, float]]:
+    """
+    Satisfaction par hash de vidéo, et par concept normalisé pour les lignes sans `hash`
+    (note par défaut des vidéos de ce concept). La dernière note l'emporte.
+    """
+    by_hash, by_concept = {}, {}
+    if not os.path.exists(path):
+        return by_hash, by_concept
+    with open(path, encoding="utf-8", newline="") as f:
+        for row in csv.DictReader(f, skipinitialspace=True):
+            rating = parse_satisfaction(row.get("satisfaction"))
+            if rating is None:
+                continue
+            digest = (row.get("hash") or "").strip().lower()
+            concept = normalize_concept(row.get("concept") or "")
+            if digest:
+                by_hash[digest] = rating
+            elif concept:
+                by_concept[concept] = rating
+    return by_hash, by_concept
+
+
+class ConceptIndex:
+    """
+    Retrouve une vidéo déjà produite pour un concept demandé autrement :
+    - correspondance exacte sur le concept normalisé, puis (option) similarité de trigrammes
+    - les vidéos mal notées dans `concepts.txt` ne sont jamais resservies, les mieux notées passent en premier ;
+      la note d'une vidéo (par hash) prime sur celle de son concept
+    L'index des artefacts n'est relu que lorsqu'une vidéo est publiée ou supprimée, les notes quand leur fichier change.
+    """
+
+    def __init__(self, store: ArtifactStore = ARTIFACT_STORE, ratings_path: str | os.PathLike = CONCEPT_RATINGS,
+                 use_similarity: bool = CONCEPT_SIMILARITY, threshold: float = CONCEPT_THRESHOLD):
+        self.store = store
+        self.ratings_path = Path(ratings_path)
+        self.use_similarity = use_similarity
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._revision: Optional[Tuple] = None
+        self._ratings_mtime: Optional[float] = None
+        self._entries: Dict[str, List[Dict[str, Any]]] = {}
+        self._vectors: Dict[str, Counter] = {}
+        self._hash_ratings: Dict[str, float] = {}
+        self._concept_ratings: Dict[str, float] = {}
+
+    def _mtime(self, path: Path) -> float:
+        try:
+            return path.stat().st_mtime
+        except OSError:
+            return 0.0
+
+    def _refresh(self) -> None:
+        # Révision du magasin plutôt que date du fichier d'index : un accès (`get`) ne provoque pas de relecture
+        revision = self.store.revision()
+        if revision != self._revision:
+            entries: Dict[str, List[Dict[str, Any]]] = {}
+            for artifact in self.store.find():
+                normalized = normalize_concept(artifact.get("concept") or "")
+                if normalized:
+                    entries.setdefault(normalized, []).append(artifact)
+            self._entries = entries
+            self._vectors = {concept: trigrams(concept) for concept in entries} if self.use_similarity else {}
+            self._revision = revision
+        ratings_mtime = self._mtime(self.ratings_path)
+        if ratings_mtime != self._ratings_mtime:
+            self._hash_ratings, self._concept_ratings = load_ratings(self.ratings_path)
+            self._ratings_mtime = ratings_mtime
+
+    def _rating(self, artifact: Dict[str, Any], concept: str) -> Optional[float]:
+        """Note de la vidéo si elle a été notée, sinon celle de son concept."""
+        rating = self._hash_ratings.get(artifact["hash"])
+        return rating if rating is not None else self._concept_ratings.get(concept)
+
+    def _candidates(self, normalized: str) -> List[Tuple[float, str]]:
+        if normalized in self._entries:
+            return [(1.0, normalized)]
+        if not self.use_similarity:
+            return []
+        vector = trigrams(normalized)
+        scored = [(similarity(vector, other), concept) for concept, other in self._vectors.items()]
+        return sorted((item for item in scored if item[0] >= self.threshold), reverse=True)
+
+    def lookup(self, concept: str) -> Optional[Dict[str, Any]]:
+        """Meilleure vidéo publiée pour ce concept (avec `match`, `score` et `satisfaction`), sinon None."""
+        normalized = normalize_concept(concept)
+        if not normalized:
+            return None
+        with self._lock:
+            self._refresh()
+            ranked = []
+            for score, matched in self._candidates(normalized):
+                for artifact in self._entries[matched]:
+                    rating = self._rating(artifact, matched)
+                    if rating is not None and rating <= 0:
+                        continue
+                    # Note connue d'abord, puis proximité, puis la plus récente
+                    ranked.append(((rating if rating is not None else 0.5, score, artifact["created"]),
+                                   matched, score, rating, artifact))
+        for _, matched, score, rating, artifact in sorted(ranked, key=lambda item: item[0], reverse=True):
+            # `get` vérifie que le fichier existe encore et rafraîchit sa date d'accès (rétention)
+            stored = self.store.get(artifact["hash"])
+            if stored is not None:
+                return {**stored, "concept": artifact["concept"], "class_name": artifact["class_name"],
+                        "match": matched, "score": score, "satisfaction": rating}
+        return None
+
+
+CONCEPT_INDEX = ConceptIndex()
@@ -0,0 +1,112 @@
+import os
+import json
+from typing import Any, Dict, List
+
+from langchain_core.messages import AIMessage, BaseMessage, ToolMessage
+
+from app.utils.cache import FileCache, hash_key
+
+# Scripts remplacés par une référence `ref:<id>` dans l'historique de l'agent
+CODE_STORE = FileCache("code", suffix=".py", max_age=7 * 24 * 3600)
+CODE_REF_PREFIX = "ref:"
+
+# Messages les plus récents laissés intacts ; les plus anciens sont compactés avant d'être renvoyés au modèle
+KEEP_RECENT_MESSAGES = int(os.getenv("MATHCONCEPT_AGENT_KEEP_MESSAGES", 4))
+MAX_OLD_TEXT = 400
+
+
+def store_code(code: str) -> str:
+    """Range le script et retourne sa référence courte."""
+    key = hash_key(code)[:16]
+    if CODE_STORE.get(key) is None:
+        CODE_STORE.put_bytes(key, code.encode("utf-8"))
+    return f"{CODE_REF_PREFIX}{key}"
+
+
+def resolve_code(code: str) -> str:
+    """Retourne le script d'une référence `ref:<id>`, ou `code` tel quel."""
+    if not code.strip().startswith(CODE_REF_PREFIX):
+        return code
+    # La référence peut être recopiée avec son résumé : "ref:<id> (N lignes)"
+    key = code.strip()[len(CODE_REF_PREFIX):].split(" ")[0]
+    path = CODE_STORE.get(key) if key else None
+    if path is None:
+        raise ValueError(f"Référence de code inconnue ou expirée: {code.strip()}")
+    return path.read_text(encoding="utf-8")
+
+
+def _code_summary(code: str) -> str:
+    return f"{store_code(code)} ({len(code.splitlines())} lignes)"
+
+
+def _tail(text: str, limit: int = MAX_OLD_TEXT) -> str:
+    return text if len(text) <= limit else f"[...] {text[-limit:]}"
+
+
+def _compact_tool_message(message: ToolMessage) -> ToolMessage:
+    try:
+        data = json.loads(message.content)
+    except (TypeError, json.JSONDecodeError):
+        return message.model_copy(update={"content": _tail(str(message.content))})
+    if not isinstance(data, dict):
+        return message
+    compact: Dict[str, Any] = {}
+    for name, value in data.items():
+        if name == "code" and isinstance(value, str) and not value.startswith("# Erreur"):
+            compact[name] = _code_summary(value)
+        elif name == "metadata":
+            continue  # traces et étapes de rendu : inutiles au modèle
+        elif isinstance(value, str):
+            compact[name] = _tail(value)
+        else:
+            compact[name] = value
+    return message.model_copy(update={"content": json.dumps(compact, ensure_ascii=False)})
+
+
+def _compact_args(args: Dict[str, Any]) -> Dict[str, Any]:
+    return {name: _code_summary(value) if name == "code" and isinstance(value, str) else value
+            for name, value in args.items()}
+
+
+def _compact_raw_tool_call(raw: Dict[str, Any]) -> Dict[str, Any]:
+    """Appel d'outil au format OpenAI (`function.arguments` en JSON) avec le script remplacé par sa référence."""
+    function = raw.get("function") or {}
+    try:
+        args = json.loads(function.get("arguments") or "{}")
+    except (TypeError, json.JSONDecodeError):
+        return raw
+    if not isinstance(args, dict):
+        return raw
+    return {**raw, "function": {**function, "arguments": json.dumps(_compact_args(args), ensure_ascii=False)}}
+
+
+def _compact_ai_message(message: AIMessage) -> AIMessage:
+    tool_calls = [{**call, "args": _compact_args(call["args"])} for call in message.tool_calls]
+    content = _tail(message.content) if isinstance(message.content, str) else message.content
+    update: Dict[str, Any] = {"tool_calls": tool_calls, "content": content}
+    raw_calls = message.additional_kwargs.get("tool_calls")
+    if raw_calls:
+        # ChatNVIDIA construit la requête depuis additional_kwargs["tool_calls"], pas depuis `tool_calls`
+        update["additional_kwargs"] = {**message.additional_kwargs,
+                                       "tool_calls": [_compact_raw_tool_call(raw) for raw in raw_calls]}
+    return message.model_copy(update=update)
+
+
+def compact_messages(messages: List[BaseMessage], keep_recent: int = KEEP_RECENT_MESSAGES) -> List[BaseMessage]:
+    """
+    Copie de l'historique à envoyer au modèle : hors des `keep_recent` derniers messages,
+    les scripts deviennent des références `ref:<id>` (acceptées par les outils), les messages
+    d'erreur sont tronqués et les métadonnées de rendu retirées. L'état du graphe n'est pas modifié.
+    """
+    cutoff = max(0, len(messages) - keep_recent)
+    compacted = []
+    for index, message in enumerate(messages):
+        if index >= cutoff:
+            compacted.append(message)
+        elif isinstance(message, ToolMessage):
+            compacted.append(_compact_tool_message(message))
+        elif isinstance(message, AIMessage):
+            compacted.append(_compact_ai_message(message))
+        else:
+            compacted.append(message)
+    return compacted
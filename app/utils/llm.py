@@ -0,0 +1,243 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from pathlib import Path
+from collections import OrderedDict
+from typing import Dict, Any, Callable, List, Optional, Tuple
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import BaseMessage
+
+from app.utils.cache import CACHE_ROOT, hash_key
+from app.utils.tracing import annotate, count, span
+
+DEFAULT_SAMPLING = {
+    "temperature": 0.2,
+    "top_p": 0.7,
+    "max_completion_tokens": 8192,
+}
+
+# Taille du pool de connexions HTTP de chaque client
+HTTP_POOL_SIZE = int(os.getenv("MATHCONCEPT_HTTP_POOL_SIZE", 16))
+
+_clients: Dict[Tuple, BaseChatModel] = {}
+_overrides: Dict[str, BaseChatModel] = {}
+_clients_lock = threading.Lock()
+
+
+def _pooled_session_fn(create_session: Callable):
+    """
+    Enveloppe la fabrique de session du client : elle n'est appelée qu'une fois, et la session qu'elle
+    configure (verify_ssl...) est réutilisée par tous les appels, avec un pool HTTP de HTTP_POOL_SIZE connexions.
+    """
+    lock = threading.Lock()
+    session = None
+
+    def get_session():
+        nonlocal session
+        with lock:
+            if session is None:
+                from requests.adapters import HTTPAdapter
+                session = create_session()
+                adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+            return session
+
+    return get_session
+
+
+def get_chat_model(model: str, **params) -> BaseChatModel:
+    """
+    Client de chat partagé, construit à la première utilisation (pas à l'import).
+    Les clients d'un même modèle et de mêmes paramètres sont réutilisés, chacun avec une session HTTP persistante.
+    """
+    if model in _overrides:
+        return _overrides[model]
+    params = {**DEFAULT_SAMPLING, **params}
+    key = (model, tuple(sorted(params.items())))
+    with _clients_lock:
+        if key not in _clients:
+            from langchain_nvidia_ai_endpoints import ChatNVIDIA
+            client = ChatNVIDIA(model=model, api_key=os.getenv("NVIDIA_API_KEY"), **params)
+            # ChatNVIDIA ouvre une session requests par appel : sa propre fabrique est mise en cache
+            inner = getattr(client, "_client", None)
+            if inner is not None and hasattr(inner, "get_session_fn"):
+                inner.get_session_fn = _pooled_session_fn(inner.get_session_fn)
+            _clients[key] = client
+        return _clients[key]
+
+
+def register_chat_model(model: str, chat_model: Optional[BaseChatModel]) -> None:
+    """Remplace un modèle par une autre implémentation (faux modèle hors ligne pour tests et benchmarks)."""
+    if chat_model is None:
+        _overrides.pop(model, None)
+    else:
+        _overrides[model] = chat_model
+
+
+class MemoryCacheBackend:
+    """LRU en mémoire, limité à `max_entries`."""
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Tuple[str, float]]:
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def set(self, key: str, value: str, created: float) -> None:
+        with self._lock:
+            self._entries[key] = (value, created)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class SQLiteCacheBackend:
+    """Cache persistant sur disque, partagé entre processus."""
+
+    def __init__(self, path: str | os.PathLike):
+        self.path = str(path)
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, value TEXT, created REAL)")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self, key: str) -> Optional[Tuple[str, float]]:
+        with self._connect() as conn:
+            row = conn.execute("SELECT value, created FROM llm_cache WHERE key = ?", (key,)).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def set(self, key: str, value: str, created: float) -> None:
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO llm_cache (key, value, created) VALUES (?, ?, ?)",
+                         (key, value, created))
+
+    def delete(self, key: str) -> None:
+        with self._connect() as conn:
+            conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+
+
+class ResponseCache:
+    """Cache des réponses LLM, clé (modèle, messages du prompt, paramètres d'échantillonnage), avec TTL."""
+
+    def __init__(self, backend, ttl: Optional[float] = None):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # Accès au backend et compteurs : appelé depuis des threads, le runner batch et les outils asynchrones
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(model: str, messages: List[BaseMessage], params: Dict[str, Any]) -> str:
+        serialized = json.dumps([(message.type, message.content) for message in messages], ensure_ascii=False)
+        return hash_key(model, serialized, json.dumps(params, sort_keys=True, default=str))
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self.backend.get(key)
+            if entry is not None and (self.ttl is None or time.time() - entry[1] <= self.ttl):
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                self.backend.delete(key)
+            self.misses += 1
+            return None
+
+    def set(self, key: str, value: str) -> None:
+        with self._lock:
+            self.backend.set(key, value, time.time())
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self.backend.delete(key)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        total = hits + misses
+        return {"hits": hits, "misses": misses, "hit_rate": hits / total if total else 0.0}
+
+
+def _default_response_cache() -> Optional[ResponseCache]:
+    backend_name = os.getenv("MATHCONCEPT_LLM_CACHE", "sqlite")
+    ttl = float(os.getenv("MATHCONCEPT_LLM_CACHE_TTL", 7 * 24 * 3600))
+    if backend_name == "memory":
+        return ResponseCache(MemoryCacheBackend(), ttl=ttl)
+    if backend_name == "sqlite":
+        return ResponseCache(SQLiteCacheBackend(CACHE_ROOT / "llm_cache.sqlite"), ttl=ttl)
+    return None
+
+
+RESPONSE_CACHE = _default_response_cache()
+
+
+def sampling_params(llm: BaseChatModel) -> Dict[str, Any]:
+    """Paramètres qui influencent la réponse, lus sur le client."""
+    return {
+        name: getattr(llm, name)
+        for name in ("temperature", "top_p", "max_completion_tokens", "max_tokens", "seed")
+        if getattr(llm, name, None) is not None
+    }
+
+
+def model_name(llm: BaseChatModel) -> str:
+    return getattr(llm, "model", None) or getattr(llm, "model_name", None) or type(llm).__name__
+
+
+def response_cache_key(llm: BaseChatModel, messages: List[BaseMessage]) -> str:
+    return ResponseCache.key(model_name(llm), messages, sampling_params(llm))
+
+
+def record_usage(usage: Optional[Dict[str, Any]]) -> None:
+    """Reporte les tokens consommés (usage_metadata) sur l'étape en cours et les compteurs du traceur actif."""
+    tokens = {name: (usage or {}).get(name) for name in ("input_tokens", "output_tokens")}
+    tokens = {name: value for name, value in tokens.items() if value}
+    annotate(**tokens)
+    for name, value in tokens.items():
+        count(name, value)
+
+
+def _invoke_content(llm: BaseChatModel, messages: List[BaseMessage]) -> str:
+    response = llm.invoke(messages)
+    record_usage(getattr(response, "usage_metadata", None))
+    return response.content
+
+
+def cached_invoke(llm: BaseChatModel, messages: List[BaseMessage], cache: Optional[ResponseCache] = None,
+                  use_cache: bool = True, producer: Optional[Callable[[], str]] = None) -> str:
+    """
+    Appelle le modèle et retourne le texte de la réponse, en passant par le cache de réponses.
+    `producer` remplace l'appel `llm.invoke` par défaut (génération en streaming par exemple).
+    """
+    producer = producer or (lambda: _invoke_content(llm, messages))
+    cache = cache if cache is not None else RESPONSE_CACHE
+    with span("llm", model=model_name(llm)) as attrs:
+        if cache is None or not use_cache:
+            attrs["cache"] = "bypass"
+            return producer()
+
+        key = response_cache_key(llm, messages)
+        cached = cache.get(key)
+        if cached is not None:
+            attrs["cache"] = "hit"
+            return cached
+        attrs["cache"] = "miss"
+        content = producer()
+        cache.set(key, content)
+        return content
@@ -0,0 +1,233 @@
+import os
+import json
+import time
+import uuid
+import threading
+import functools
+import contextvars
+from pathlib import Path
+from contextlib import contextmanager
+from typing import Dict, Any, Callable, Iterator, List, Optional
+
+# Dossier d'export automatique des traces (JSONL + format Chrome), désactivé si vide
+TRACE_DIR = os.getenv("MATHCONCEPT_TRACE_DIR", "")
+
+# Fichier où le processus de rendu (Manim) consigne ses propres étapes : TTS, LaTeX, mux ffmpeg
+STAGE_LOG_ENV = "MATHCONCEPT_STAGE_LOG"
+
+
+class Tracer:
+    """
+    Collecte les étapes d'une requête (génération LLM, validation, TTS, LaTeX, rendu, mux, nettoyage...)
+    avec temps réel, temps CPU et attributs libres (tokens, mémoire, cache...), plus des compteurs.
+    """
+
+    def __init__(self, name: str = "request"):
+        self.name = name
+        self.trace_id = uuid.uuid4().hex[:12]
+        self.spans: List[Dict[str, Any]] = []
+        self.counters: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name: str, **attrs) -> Iterator[Dict[str, Any]]:
+        """Mesure un bloc ; le dict retourné (ou `annotate`) permet d'ajouter des attributs pendant l'exécution."""
+        start = time.time()
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        token = _current_attrs.set(attrs)
+        try:
+            yield attrs
+        finally:
+            _current_attrs.reset(token)
+            self.add(name, start, time.perf_counter() - wall_start,
+                     cpu_seconds=time.thread_time() - cpu_start, **attrs)
+
+    def add(self, name: str, start: float, wall_seconds: float, **attrs) -> None:
+        """Enregistre une étape mesurée ailleurs (processus de rendu, worker...)."""
+        with self._lock:
+            self.spans.append({
+                "name": name,
+                "start": start,
+                "wall_seconds": wall_seconds,
+                "pid": attrs.pop("pid", os.getpid()),
+                "tid": attrs.pop("tid", threading.get_ident()),
+                **attrs,
+            })
+
+    def count(self, name: str, increment: int = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + increment
+
+    def merge(self, other: "Tracer") -> None:
+        with self._lock:
+            self.spans.extend(other.spans)
+            for name, value in other.counters.items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self) -> Dict[str, Any]:
+        """Totaux par étape : nombre d'appels, temps réel, temps CPU."""
+        stages: Dict[str, Dict[str, float]] = {}
+        for span in self.spans:
+            stage = stages.setdefault(span["name"], {"count": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0})
+            stage["count"] += 1
+            stage["wall_seconds"] += span["wall_seconds"]
+            stage["cpu_seconds"] += span.get("cpu_seconds") or 0.0
+        return {"trace_id": self.trace_id, "stages": stages, "counters": dict(self.counters)}
+
+    def to_metadata(self) -> Dict[str, Any]:
+        """
+        Résumé compact pour les résultats d'outils, renvoyés au modèle à chaque tour : durée totale
+        et temps réel par étape. Le détail des spans part dans l'export (MATHCONCEPT_TRACE_DIR).
+        """
+        summary = self.summary()
+        total = (max(span["start"] + span["wall_seconds"] for span in self.spans)
+                 - min(span["start"] for span in self.spans)) if self.spans else 0.0
+        return {
+            "trace_id": self.trace_id,
+            "total_seconds": round(total, 3),
+            "stages": {name: round(stage["wall_seconds"], 3) for name, stage in summary["stages"].items()},
+        }
+
+    def export_jsonl(self, path: str | os.PathLike) -> None:
+        with open(path, "a", encoding="utf-8") as f:
+            for span in self.spans:
+                f.write(json.dumps({"trace_id": self.trace_id, **span}, ensure_ascii=False, default=str) + "\n")
+
+    def export_chrome_trace(self, path: str | os.PathLike) -> None:
+        """Format Trace Event de Chrome (chrome://tracing, Perfetto)."""
+        events = []
+        for span in self.spans:
+            args = {k: v for k, v in span.items() if k not in ("name", "start", "wall_seconds", "pid", "tid")}
+            events.append({
+                "name": span["name"],
+                "ph": "X",
+                "ts": span["start"] * 1e6,
+                "dur": span["wall_seconds"] * 1e6,
+                "pid": span["pid"],
+                "tid": span["tid"],
+                "args": args,
+            })
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "otherData": {"trace_id": self.trace_id, **self.counters}},
+                      f, ensure_ascii=False, default=str)
+
+    def export(self, directory: str | os.PathLike) -> None:
+        Path(directory).mkdir(parents=True, exist_ok=True)
+        self.export_jsonl(Path(directory) / "spans.jsonl")
+        self.export_chrome_trace(Path(directory) / f"{self.name}_{self.trace_id}.trace.json")
+
+
+_current_tracer: contextvars.ContextVar[Optional[Tracer]] = contextvars.ContextVar("tracer", default=None)
+_current_attrs: contextvars.ContextVar[Optional[Dict[str, Any]]] = contextvars.ContextVar("span_attrs", default=None)
+
+
+def current_tracer() -> Optional[Tracer]:
+    return _current_tracer.get()
+
+
+@contextmanager
+def tracing(tracer: Optional[Tracer] = None, name: str = "request") -> Iterator[Tracer]:
+    """
+    Active un traceur pour le contexte courant ; réutilise celui déjà actif s'il y en a un.
+    La trace racine est exportée dans MATHCONCEPT_TRACE_DIR à la sortie, si ce dossier est défini.
+    """
+    outer = current_tracer()
+    tracer = tracer or outer or Tracer(name)
+    token = _current_tracer.set(tracer)
+    try:
+        yield tracer
+    finally:
+        _current_tracer.reset(token)
+        if outer is None and TRACE_DIR:
+            tracer.export(TRACE_DIR)
+
+
+@contextmanager
+def child_tracing(name: str) -> Iterator[Tracer]:
+    """
+    Traceur propre à un appel d'outil (pour ses métadonnées), fusionné à la sortie
+    dans le traceur de la requête s'il y en a un.
+    """
+    outer = current_tracer()
+    with tracing(Tracer(name)) as tracer:
+        yield tracer
+    if outer is not None:
+        outer.merge(tracer)
+
+
+@contextmanager
+def span(name: str, **attrs) -> Iterator[Dict[str, Any]]:
+    """Mesure un bloc dans le traceur actif ; sans traceur actif, ne fait rien."""
+    tracer = current_tracer()
+    if tracer is None:
+        yield attrs
+        return
+    with tracer.span(name, **attrs) as span_attrs:
+        yield span_attrs
+
+
+def annotate(**attrs) -> None:
+    """Ajoute des attributs à l'étape en cours (tokens consommés, statut du cache...)."""
+    current = _current_attrs.get()
+    if current is not None:
+        current.update(attrs)
+
+
+def count(name: str, increment: int = 1) -> None:
+    tracer = current_tracer()
+    if tracer is not None:
+        tracer.count(name, increment)
+
+
+def stage_record(name: str, start: float, wall_seconds: float, **attrs) -> Dict[str, Any]:
+    """Étape mesurée hors traceur (autre processus), au format attendu par `Tracer.add`."""
+    return {"name": name, "start": start, "wall_seconds": wall_seconds, "pid": os.getpid(), **attrs}
+
+
+def record_stages(stages: List[Dict[str, Any]], **attrs) -> None:
+    """Ajoute au traceur actif les étapes remontées dans les métadonnées d'un rendu."""
+    tracer = current_tracer()
+    if tracer is None:
+        return
+    for stage in stages:
+        tracer.add(**{**stage, **attrs})
+
+
+def log_stage(name: str, start: float, wall_seconds: float, **attrs) -> None:
+    """Consigne une étape dans le fichier désigné par MATHCONCEPT_STAGE_LOG (sans effet s'il n'est pas défini)."""
+    path = os.environ.get(STAGE_LOG_ENV)
+    if not path:
+        return
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(stage_record(name, start, wall_seconds, **attrs), default=str) + "\n")
+
+
+def timed(name: str) -> Callable[[Callable], Callable]:
+    """Décorateur : consigne chaque appel de la fonction avec `log_stage`."""
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start, wall_start, cpu_start = time.time(), time.perf_counter(), time.process_time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                log_stage(name, start, time.perf_counter() - wall_start,
+                          cpu_seconds=time.process_time() - cpu_start)
+        wrapper.__traced__ = True
+        return wrapper
+    return decorator
+
+
+def read_stage_log(path: str | os.PathLike) -> List[Dict[str, Any]]:
+    """Étapes enregistrées par les hooks du processus de rendu (une ligne JSON par appel)."""
+    if not os.path.exists(path):
+        return []
+    stages = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                stages.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return stages
@@ -0,0 +1,44 @@
+import json
+
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+from langchain_nvidia_ai_endpoints._utils import convert_message_to_dict
+
+from app.utils.history import compact_messages, resolve_code
+
+CODE = "from manim import *\n\n" + "\n".join(f"# ligne {i} " + "x" * 60 for i in range(500))
+
+
+def _render_call(call_id: str) -> AIMessage:
+    """Message tel que le produit ChatNVIDIA : appels parsés et appels bruts dans additional_kwargs."""
+    args = {"code": CODE, "math_scene": "Scene1"}
+    return AIMessage(
+        content="",
+        tool_calls=[{"name": "execute_manim_with_audio", "args": args, "id": call_id}],
+        additional_kwargs={"tool_calls": [{
+            "id": call_id,
+            "type": "function",
+            "function": {"name": "execute_manim_with_audio", "arguments": json.dumps(args)},
+        }]},
+    )
+
+
+def test_compacted_tool_call_payload_drops_the_script():
+    messages = [
+        HumanMessage(content="le cercle"),
+        _render_call("call_1"),
+        ToolMessage(content=json.dumps({"success": False, "message": "Erreur"}), tool_call_id="call_1"),
+        HumanMessage(content="encore"),
+    ]
+    compacted = compact_messages(messages, keep_recent=1)
+
+    payload = convert_message_to_dict(compacted[1])
+    assert len(json.dumps(payload)) < 1000
+    args = json.loads(payload["tool_calls"][0]["function"]["arguments"])
+    assert args["math_scene"] == "Scene1"
+    assert resolve_code(args["code"]) == CODE
+    assert compacted[1].tool_calls[0]["args"]["code"] == args["code"]
+
+
+def test_recent_messages_are_untouched():
+    message = _render_call("call_2")
+    assert compact_messages([message], keep_recent=1) == [message]
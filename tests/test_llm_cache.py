@@ -0,0 +1,85 @@
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+from langchain_core.messages import HumanMessage
+
+from app.tools import manim as manim_tools
+from app.utils import llm
+from app.utils.llm import MemoryCacheBackend, ResponseCache, cached_invoke, register_chat_model
+
+SCRIPT = """===CODE===
+from manim import *
+
+class {name}(VoiceoverScene):
+    def construct(self):
+        pass
+===CLASS_NAME===
+{name}
+"""
+
+
+def _fake_model(*responses: str) -> FakeListChatModel:
+    return FakeListChatModel(responses=list(responses))
+
+
+def _use_cache(monkeypatch) -> ResponseCache:
+    """Cache en mémoire à la place du cache SQLite partagé."""
+    cache = ResponseCache(MemoryCacheBackend())
+    monkeypatch.setattr(llm, "RESPONSE_CACHE", cache)
+    monkeypatch.setattr(manim_tools, "RESPONSE_CACHE", cache)
+    return cache
+
+
+def test_miss_then_hit(monkeypatch):
+    cache = _use_cache(monkeypatch)
+    model = _fake_model("première", "seconde")
+    messages = [HumanMessage(content="le cercle")]
+
+    assert cached_invoke(model, messages) == "première"
+    assert cached_invoke(model, messages) == "première"
+    assert model.i == 1  # un seul appel au modèle
+    assert cache.stats() == {"hits": 1, "misses": 1, "hit_rate": 0.5}
+
+
+def test_other_prompt_is_a_miss(monkeypatch):
+    cache = _use_cache(monkeypatch)
+    model = _fake_model("première", "seconde")
+
+    assert cached_invoke(model, [HumanMessage(content="le cercle")]) == "première"
+    assert cached_invoke(model, [HumanMessage(content="la droite")]) == "seconde"
+    assert cache.misses == 2 and cache.hits == 0
+
+
+def test_use_cache_false_bypasses_cache(monkeypatch):
+    cache = _use_cache(monkeypatch)
+    model = _fake_model("première", "seconde")
+    messages = [HumanMessage(content="le cercle")]
+
+    assert cached_invoke(model, messages) == "première"
+    assert cached_invoke(model, messages, use_cache=False) == "seconde"
+    # Ni lu ni écrit : l'entrée en cache reste la première réponse
+    assert cache.hits == 0 and cache.misses == 1
+    assert cached_invoke(model, messages) == "première"
+
+
+def test_forget_failed_script_invalidates_response(monkeypatch):
+    _use_cache(monkeypatch)
+    monkeypatch.setattr(manim_tools, "STREAM_GENERATION", False)
+    model = _fake_model(SCRIPT.format(name="Premier"), SCRIPT.format(name="Second"))
+    register_chat_model(manim_tools.SCRIPT_MODEL, model)
+    try:
+        first = manim_tools.generate_manim_script.invoke({"concept": "le cercle"})
+        assert manim_tools.generate_manim_script.invoke({"concept": "le cercle"}) == first
+        assert model.i == 1
+
+        manim_tools.forget_failed_script(first["code"])
+        retry = manim_tools.generate_manim_script.invoke({"concept": "le cercle"})
+        assert retry["class_name"] == "Second"
+    finally:
+        register_chat_model(manim_tools.SCRIPT_MODEL, None)
+
+
+def test_script_cache_keys_are_bounded(monkeypatch):
+    monkeypatch.setattr(manim_tools, "SCRIPT_CACHE_KEYS_MAX", 2)
+    monkeypatch.setattr(manim_tools, "_SCRIPT_CACHE_KEYS", manim_tools.OrderedDict())
+    for index in range(5):
+        manim_tools._remember_script(f"# script {index}", f"clé {index}")
+    assert list(manim_tools._SCRIPT_CACHE_KEYS.values()) == ["clé 3", "clé 4"]